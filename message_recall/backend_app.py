@@ -31,6 +31,8 @@ app = webapp2.WSGIApplication([
      backend_views.Phase1RecallMessagesHandler),
     (r'/backend/retrieve_domain_users',
      backend_views.Phase2RetrieveDomainUsersHandler),
+    (r'/backend/retrieve_recipient_users',
+     backend_views.Phase2RetrieveRecipientUsersHandler),
     (r'/backend/recall_user_messages',
      backend_views.Phase3RecallUserMessagesHandler),
     (r'/backend/wait_for_task_completion',
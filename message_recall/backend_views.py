@@ -17,19 +17,30 @@
 The backend is organized in 4 phases with corresponding handlers:
   1. Phase1RecallMessagesHandler()
   2. Phase2RetrieveDomainUsersHandler()
+     (or Phase2RetrieveRecipientUsersHandler() for a targeted recall)
   3. Phase3RecallUserMessagesHandler()
   4. Phase4WaitForTaskCompletionHandler()
 
+Tasks normally complete when the last user reaches a terminal user state.
+Phase4 is an infrequent, self-rescheduling watchdog that catches a missed
+completion without holding a backend instance.
+
 Resource tuning discussion:
 https://developers.google.com/appengine/articles/managing-resources
 """
 
+import collections
+import sys
+import threading
 import time
 
+import credentials_utils
 import log_utils
 import mail_api
+from models import directory_snapshot
 from models import domain_user
 from models import error_reason
+from models import prefix_user_count
 from models import recall_task
 from models import sharded_counter
 import recall_errors
@@ -42,37 +53,217 @@ from google.appengine.api import runtime
 from google.appengine.api.taskqueue import Error as TaskQueueError
 from google.appengine.api.taskqueue import Queue
 from google.appengine.api.taskqueue import Task
+from google.appengine.api.taskqueue import TaskAlreadyExistsError
+from google.appengine.api.taskqueue import TombstonedTaskError
 from google.appengine.ext import ndb
 
 
+# User retrieval is partitioned by email prefix. Prefixes seen holding many
+# users on earlier recalls are split into longer prefixes, plus an exact
+# match ('s@domain') for the user named just the prefix.
+_EMAIL_PREFIX_EXACT_SUFFIX = '@'
+_EMAIL_PREFIX_FIRST_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+_EMAIL_PREFIX_MAX_LENGTH = 3
+_EMAIL_PREFIX_NEXT_CHARS = _EMAIL_PREFIX_FIRST_CHARS + ".-_'"
+_EMAIL_PREFIX_SPLIT_USER_COUNT = 2000  # 4 Admin SDK pages.
+
 _LOG = log_utils.GetLogger('messagerecall.views')
-_MONITOR_SLEEP_PERIOD_S = 10
+_MONITOR_CHECK_PERIOD_S = 60
+# Counters of users that stopped progressing for this many watchdog checks
+# are recounted with queries.
+_MONITOR_IDLE_CHECKS_MAX = 10
+
+# A recall targeted at the recipients of the sender's copy recalls from all
+# domain users instead when the recipients are more users than this.
+_RECIPIENT_USERS_MAX_COUNT = 1000
+
+# Queue.add() accepts at most 100 tasks at once.
+_TASK_ADD_BATCH_SIZE = 100
+
+# Access tokens for the users of each page are minted (concurrently) before
+# their recall tasks are enqueued so user recalls find them cached.
+_TOKEN_PREMINT_MAX_THREADS = 10
+
+# Users read from a directory snapshot are added in pages like this (the
+# Admin SDK page size).
+_SNAPSHOT_PAGE_SIZE = 500
+
+# Each user recall task carries a chunk of users to save task dispatches.
+# The users of a chunk are recalled concurrently using a bounded number of
+# threads (each thread holds one IMAP session at a time).
+_USER_RECALL_BATCH_SIZE = 50
+_USER_RECALL_MAX_THREADS = 10
+
 
-# Write users to the db in batches to save time/rpcs.
-_USER_PUT_MULTI_BATCH_SIZE = 100
+def _SplitEmailPrefix(email_prefix, prefix_user_counts):
+  """Split a prefix holding many users into prefixes holding fewer.
 
+  Args:
+    email_prefix: String with the first n characters of an email address.
+    prefix_user_counts: Dictionary of String email prefix to Integer user
+                        count observed on earlier recalls.
 
-def PartitionEmailPrefixes():
+  Returns:
+    List of Strings which are prefixes covering the same users.
+  """
+  if (len(email_prefix) >= _EMAIL_PREFIX_MAX_LENGTH or
+      prefix_user_counts.get(email_prefix, 0) <=
+      _EMAIL_PREFIX_SPLIT_USER_COUNT):
+    return [email_prefix]
+  email_prefixes = [email_prefix + _EMAIL_PREFIX_EXACT_SUFFIX]
+  for next_char in _EMAIL_PREFIX_NEXT_CHARS:
+    email_prefixes.extend(_SplitEmailPrefix(email_prefix + next_char,
+                                            prefix_user_counts))
+  return email_prefixes
+
+
+def PartitionEmailPrefixes(user_domain=None):
   """Divide the domain email namespace to allow concurrent tasks to search.
 
   The rules for gmail usernames are:
   a) Letters, numbers and . are allowed.
   b) The first character must be a letter or number.
 
+  Google Apps usernames may also hold - _ and ' after the first character.
+
+  Prefixes which held more than _EMAIL_PREFIX_SPLIT_USER_COUNT users in the
+  domain on earlier recalls are split so the user retrieval tasks are of
+  similar size.  A prefix ending in _EMAIL_PREFIX_EXACT_SUFFIX is matched
+  exactly (the user named the prefix) rather than as a prefix.
+
+  Args:
+    user_domain: String domain of the users or None for the basic prefixes.
+
   Returns:
     List of Strings which are the valid prefixes the user search tasks will
     use.
   """
-  return list('abcdefghijklmnopqrstuvwxyz0123456789')
-
-
-def GetEmailPartitionCount():
+  prefix_user_counts = {}
+  if user_domain:
+    prefix_user_counts = (
+        prefix_user_count.EmailPrefixUserCountModel.GetPrefixUserCounts(
+            user_domain))
+  email_prefixes = []
+  for first_char in _EMAIL_PREFIX_FIRST_CHARS:
+    email_prefixes.extend(_SplitEmailPrefix(first_char, prefix_user_counts))
+  return email_prefixes
+
+
+def GetEmailPartitionCount(task):
   """Helper to track partitioned tasks.
 
+  Args:
+    task: RecallTaskModel entity of the recall.
+
   Returns:
     Integer count of the number of (minimum) expected tasks.
   """
-  return len(PartitionEmailPrefixes())
+  return task.email_partition_count or len(_EMAIL_PREFIX_FIRST_CHARS)
+
+
+def _RunInThreadPool(work_function, work_items, max_threads):
+  """Apply work_function to each work item using a bounded pool of threads.
+
+  The first unexpected exception raised by any thread is re-raised in the
+  calling thread after all threads finish so the task may be retried.
+
+  Args:
+    work_function: Callable accepting one work item.
+    work_items: List of work items to process.
+    max_threads: Integer maximum number of concurrent threads.
+  """
+  pending_items = list(work_items)
+  pending_lock = threading.Lock()
+  exc_infos = []
+
+  def _Worker():
+    while True:
+      with pending_lock:
+        if not pending_items or exc_infos:
+          return
+        work_item = pending_items.pop(0)
+      try:
+        work_function(work_item)
+      except Exception:  # pylint: disable=broad-except
+        with pending_lock:
+          exc_infos.append(sys.exc_info())
+
+  threads = [threading.Thread(target=_Worker)
+             for _ in xrange(min(max_threads, len(pending_items)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if exc_infos:
+    exc_type, exc_value, exc_traceback = exc_infos[0]
+    raise exc_type, exc_value, exc_traceback
+
+
+def _IterateAhead(iterator):
+  """Iterate while the next item is computed in a thread.
+
+  The caller processes each item while the following item is produced, e.g.
+  storing a page of users while the next page is retrieved.  Exceptions of
+  the iterator are re-raised in the calling thread.
+
+  Args:
+    iterator: Iterator (not thread-safe: advanced by one thread at a time).
+
+  Yields:
+    The items of iterator.
+  """
+  next_item = {}
+
+  def _FetchNext():
+    try:
+      next_item['item'] = next(iterator)
+    except StopIteration:
+      pass
+    except Exception:  # pylint: disable=broad-except
+      next_item['exc_info'] = sys.exc_info()
+
+  fetch_thread = threading.Thread(target=_FetchNext)
+  fetch_thread.start()
+  try:
+    while True:
+      fetch_thread.join()
+      if 'exc_info' in next_item:
+        exc_type, exc_value, exc_traceback = next_item['exc_info']
+        raise exc_type, exc_value, exc_traceback
+      if 'item' not in next_item:
+        return
+      item = next_item.pop('item')
+      fetch_thread = threading.Thread(target=_FetchNext)
+      fetch_thread.start()
+      yield item
+  finally:
+    fetch_thread.join()
+
+
+def _AddTaskToMonitorRecallTaskCompletion(task_key_id, owner_email,
+                                          countdown=_MONITOR_CHECK_PERIOD_S,
+                                          users_terminal_count=0,
+                                          idle_check_count=0):
+  """Adds the watchdog task which checks a recall task for completion.
+
+  Args:
+    task_key_id: Int unique id of the parent task.
+    owner_email: String email address of user running this recall.
+    countdown: Int seconds to wait before the check runs.
+    users_terminal_count: Integer #users in a terminal state at this check.
+    idle_check_count: Integer #checks in a row without users finishing.
+  """
+  Queue('user-recall-queue').add(task=Task(
+      countdown=countdown,
+      name='%s_monitor_%s' % (
+          view_utils.CreateSafeUserEmailForTaskName(owner_email),
+          view_utils.GetCurrentDateTimeForTaskName()),
+      params={'idle_check_count': idle_check_count,
+              'owner_email': owner_email,
+              'task_key_id': task_key_id,
+              'users_terminal_count': users_terminal_count},
+      target='recall-backend',
+      url='/backend/wait_for_task_completion'))
 
 
 def MessageRecallShutdownHook():
@@ -159,7 +350,8 @@ class Phase1RecallMessagesHandler(BackendBaseHandler):
           reason_string='Failed to enqueue retrieve users tasks.')
       raise
 
-  def _EnqueueUserRetrievalTasks(self, message_criteria, owner_email):
+  def _EnqueueUserRetrievalTasks(self, message_criteria, owner_email,
+                                 email_prefixes):
     """Efficiently add tasks to enumerate domain users as a list (bulk add).
 
     Bulk add() saves roundtrips (rpc calls).
@@ -167,17 +359,15 @@ class Phase1RecallMessagesHandler(BackendBaseHandler):
     Args:
       message_criteria: String criteria (message-id) to recall.
       owner_email: String email address of user running this recall.
+      email_prefixes: List of String email prefixes; 1 task for each.
     """
     user_retrieval_tasks = []
-    # Use countdown to space out these requests a little.
-    # There is a 15 request/s quota on the Admin SDK API.
-    limit_requests_s = 15
-    for prefix_counter, email_prefix in enumerate(PartitionEmailPrefixes()):
+    # The Admin SDK request quota is respected by user_retriever itself.
+    for email_prefix in email_prefixes:
       user_retrieval_tasks.append(
-          Task(countdown=(prefix_counter / limit_requests_s),
-               name='%s_%s_%s' % (
+          Task(name='%s_%s_%s' % (
                    view_utils.CreateSafeUserEmailForTaskName(owner_email),
-                   email_prefix,
+                   view_utils.CreateSafeUserEmailForTaskName(email_prefix),
                    view_utils.GetCurrentDateTimeForTaskName()),
                params={'email_prefix': email_prefix,
                        'message_criteria': message_criteria,
@@ -185,20 +375,98 @@ class Phase1RecallMessagesHandler(BackendBaseHandler):
                        'task_key_id': self._task_key_id},
                target='recall-backend',
                url='/backend/retrieve_domain_users'))
-    self._AddUserRetrievalTask(task=user_retrieval_tasks)
+    for batch_start in xrange(0, len(user_retrieval_tasks),
+                              _TASK_ADD_BATCH_SIZE):
+      self._AddUserRetrievalTask(
+          task=user_retrieval_tasks[batch_start:
+                                    batch_start + _TASK_ADD_BATCH_SIZE])
+
+  def _RetrieveRecipientUsers(self, message_criteria, owner_email,
+                              sender_email):
+    """Find the users who received the messages from the sender's copy.
+
+    Args:
+      message_criteria: String criteria (message-id) to recall.
+      owner_email: String email address of user running this recall.
+      sender_email: String email address of the user who sent the messages.
+
+    Returns:
+      List of tuples (1 for each user) with a String email address and the
+      suspended status of the users to check or None if the messages must be
+      recalled from all domain users.
+    """
+    recipient_emails = mail_api.GetMessageRecipients(
+        user_email=sender_email, message_criteria=message_criteria)
+    if recipient_emails is None:
+      return None
+    recipient_emails.add(sender_email.lower())
+    return user_retriever.RecipientUserRetriever(
+        owner_email=owner_email,
+        user_domain=view_utils.GetUserDomain(owner_email)
+        ).RetrieveRecipientUsers(recipient_emails=recipient_emails,
+                                 max_user_count=_RECIPIENT_USERS_MAX_COUNT)
+
+  def _EnqueueRecipientUsersTask(self, message_criteria, owner_email,
+                                 user_tuples):
+    """Add the single task to add the recipient users of a targeted recall.
+
+    Args:
+      message_criteria: String criteria (message-id) to recall.
+      owner_email: String email address of user running this recall.
+      user_tuples: List of tuples (1 for each user) with a String email
+                   address and the suspended status of the users to check.
+    """
+    self._AddUserRetrievalTask(task=Task(
+        name='%s_recipients_%s' % (
+            view_utils.CreateSafeUserEmailForTaskName(owner_email),
+            view_utils.GetCurrentDateTimeForTaskName()),
+        params={'message_criteria': message_criteria,
+                'owner_email': owner_email,
+                'task_key_id': self._task_key_id,
+                'user_email': [user_email for user_email, unused_suspended
+                               in user_tuples],
+                'user_suspended': [int(is_suspended) for unused_user_email,
+                                   is_suspended in user_tuples]},
+        target='recall-backend',
+        url='/backend/retrieve_recipient_users'))
 
   def post(self):  # pylint: disable=g-bad-name
     """Handler for /backend/recall_messages post requests.
 
-    These tasks handled by Phase2RetrieveDomainUsersHandler().
+    When the task names the sender of the messages, only the recipients read
+    from the sender's copy are recalled (Phase2RetrieveRecipientUsersHandler).
+    Otherwise, or if the recipients cannot be resolved, all domain users are
+    recalled (Phase2RetrieveDomainUsersHandler).
     """
     super(Phase1RecallMessagesHandler, self).post()
+    message_criteria = self.request.get('message_criteria')
+    owner_email = self.request.get('owner_email')
+    sender_email = self.request.get('sender_email')
+    if sender_email:
+      user_tuples = self._RetrieveRecipientUsers(
+          message_criteria=message_criteria, owner_email=owner_email,
+          sender_email=sender_email)
+      if user_tuples is not None:
+        recall_task.RecallTaskModel.SetTaskState(
+            task_key_id=self._task_key_id,
+            new_state=recall_task.TASK_GETTING_USERS,
+            email_partition_count=1)
+        self._EnqueueRecipientUsersTask(
+            message_criteria=message_criteria, owner_email=owner_email,
+            user_tuples=user_tuples)
+        return
+      _LOG.info('[%s] Recipients from %s not resolved: recalling from all '
+                'domain users.', owner_email, sender_email)
+    email_prefixes = PartitionEmailPrefixes(
+        user_domain=view_utils.GetUserDomain(owner_email))
     recall_task.RecallTaskModel.SetTaskState(
         task_key_id=self._task_key_id,
-        new_state=recall_task.TASK_GETTING_USERS)
+        new_state=recall_task.TASK_GETTING_USERS,
+        email_partition_count=len(email_prefixes))
     self._EnqueueUserRetrievalTasks(
-        message_criteria=self.request.get('message_criteria'),
-        owner_email=self.request.get('owner_email'))
+        message_criteria=message_criteria,
+        owner_email=owner_email,
+        email_prefixes=email_prefixes)
 
 
 class Phase2RetrieveDomainUsersHandler(BackendBaseHandler):
@@ -216,77 +484,95 @@ class Phase2RetrieveDomainUsersHandler(BackendBaseHandler):
     if self._was_incremented:
       self._DecrementRetrievalStartedTasksCount()
 
-  def _AddUserRecordsToDB(self, users_to_add):
-    """Helper to perform ndb put() with error handling.
-
-    Args:
-      users_to_add: List of user (DomainUserToCheckModel) entities to add.
-    """
-    ndb.put_multi(users_to_add)
-
   def _AddUserRecordsPage(self, user_tuples):
     """Helper to add a user record to the data model for this recall task.
 
     User retrieval is optimized for minimum rpc's.  Users are retrieved using
-    the API by the largest possible page size (500 users).  But, users are
-    efficiently added to NDB in batches of 100.
+    the API by the largest possible page size (500 users).  User keys are
+    derived from the task and user email so users already added (e.g. by a
+    retried task) are found with a single batch get per page.  New users are
+    efficiently added to NDB in concurrent batches of 100 and counted once
+    per page.  Suspended users are added in a terminal state so they are
+    counted as already finished.  An abort is checked once per page.
 
     Args:
       user_tuples: List of tuples (1 for each user) with a String email
                    address and the suspended status of the users to check.
+
+    Returns:
+      List of user (DomainUserToCheckModel) entities of the page, existing or
+      new, in page order.
     """
-    current_user_index = 0
-    user_count = len(user_tuples)
-    users_to_add = []
+    if recall_task.RecallTaskModel.IsTaskAborted(self._task_key_id):
+      return []
+    users = collections.OrderedDict()
     for user_email, is_suspended in user_tuples:
-      if recall_task.RecallTaskModel.IsTaskAborted(self._task_key_id):
-        return
-      if domain_user.DomainUserToCheckModel.IsUserEmailEntityInTask(
-          self._task_key_id, user_email):
-        user_count -= 1
-        continue
-      user_to_add = domain_user.DomainUserToCheckModel(
-          recall_task_id=self._task_key_id, user_email=user_email)
+      user_to_add = domain_user.DomainUserToCheckModel.CreateUserForTask(
+          task_key_id=self._task_key_id, user_email=user_email)
       if is_suspended:
         user_to_add.message_state = domain_user.MESSAGE_UNKNOWN
         user_to_add.user_state = domain_user.USER_SUSPENDED
-      users_to_add.append(user_to_add)
-      if (len(users_to_add) == _USER_PUT_MULTI_BATCH_SIZE or
-          (current_user_index == (user_count - 1) and users_to_add)):
-        self._AddUserRecordsToDB(users_to_add)
-        users_to_add = []
-      current_user_index += 1
-    if users_to_add:
-      view_utils.FailRecallTask(
-          task_key_id=self._task_key_id,
-          reason_string='Unexpectedly found %s users not stored.' %
-          len(users_to_add),
-          raise_exception=True)
+      users[user_email] = user_to_add
+    existing_users = ndb.get_multi([user.key for user in users.itervalues()])
+    users_to_add = [user for user, existing_user
+                    in zip(users.itervalues(), existing_users)
+                    if not existing_user]
+    domain_user.DomainUserToCheckModel.PutNewUsers(users_to_add)
+    return [existing_user or user for user, existing_user
+            in zip(users.itervalues(), existing_users)]
 
-  def _AddUserRecallTasks(self, user_recall_tasks):
-    """Helper to enqueue list of user recall tasks in batches.
+  def _PreMintAccessTokens(self, users):
+    """Mint and cache the access tokens the users' recalls will need.
 
-    Args:
-      user_recall_tasks: Task or list of Tasks; one for each user.
+    Errors are only logged: user recalls mint tokens missing from the cache.
 
-    Raises:
-      re-raises any errors with task queue.
+    Args:
+      users: List of user (DomainUserToCheckModel) entities.
     """
-    Queue('user-recall-queue').add(task=user_recall_tasks)
+    user_emails = credentials_utils.GetUncachedUserEmails(
+        [user.user_email for user in users
+         if user.user_state not in domain_user.TERMINAL_USER_STATES])
+    access_token_entries = {}
+
+    def _MintAccessToken(user_email):
+      try:
+        access_token_entries[user_email] = (
+            credentials_utils.MintUserAccessToken(user_email))
+      except Exception as e:  # pylint: disable=broad-except
+        _LOG.warning('[%s] Unable to pre-mint access token: %s.',
+                     user_email, e)
+
+    _RunInThreadPool(_MintAccessToken, user_emails,
+                     _TOKEN_PREMINT_MAX_THREADS)
+    if access_token_entries:
+      credentials_utils.SetUserAccessTokens(access_token_entries)
+
+  def _AddUserRecallTasks(self, user_recall_tasks):
+    """Helper to enqueue list of user recall tasks in batches.
 
-  def _AddTaskToMonitorUserRecallTasksHaveCompleted(self, owner_email):
-    """Adds final task which monitors user recall tasks for completion.
+    Recall tasks are named so a retried user retrieval task adds the same
+    tasks again: those already added are skipped.  A batch add which found
+    one of its tasks already added may not have added the others so they are
+    then added one by one.
 
     Args:
-      owner_email: String email address of user running this recall.
+      user_recall_tasks: List of Tasks; one for each chunk of users.
+
+    Raises:
+      re-raises any other errors with task queue.
     """
-    self._AddUserRecallTasks(user_recall_tasks=Task(
-        name='%s_monitor_%s' % (
-            view_utils.CreateSafeUserEmailForTaskName(owner_email),
-            view_utils.GetCurrentDateTimeForTaskName()),
-        params={'task_key_id': self._task_key_id},
-        target='recall-backend',
-        url='/backend/wait_for_task_completion'))
+    queue = Queue('user-recall-queue')
+    try:
+      queue.add(task=user_recall_tasks)
+      return
+    except (TaskAlreadyExistsError, TombstonedTaskError):
+      pass
+    for user_recall_task in user_recall_tasks:
+      try:
+        queue.add(task=user_recall_task)
+      except (TaskAlreadyExistsError, TombstonedTaskError):
+        _LOG.debug('Skipped adding user recall task %s again.',
+                   user_recall_task.name)
 
   def _AreUserRetrievalTasksCompleted(self):
     """Helper to increment a counter and check if expected count is reached.
@@ -302,41 +588,45 @@ class Phase2RetrieveDomainUsersHandler(BackendBaseHandler):
         name=view_utils.MakeRetrievalStartedCounterName(self._task_key_id))
     task = recall_task.RecallTaskModel.GetTaskByKey(self._task_key_id)
     return ((task.task_state == recall_task.TASK_GETTING_USERS) and
-            (retrieval_started_count >= GetEmailPartitionCount()) and
-            (retrieval_ended_count >= GetEmailPartitionCount()))
+            (retrieval_started_count >= GetEmailPartitionCount(task)) and
+            (retrieval_ended_count >= GetEmailPartitionCount(task)))
 
-  def _EnqueueUserRecallTasks(self, message_criteria, owner_email):
-    """Efficiently add tasks for each user to recall messages (bulk add).
+  def _EnqueueUserRecallTasks(self, message_criteria, users):
+    """Efficiently add tasks to recall messages for chunks of users.
 
-    Bulk add() saves roundtrips (rpc calls).
+    Each task carries up to _USER_RECALL_BATCH_SIZE users which saves task
+    dispatches, abort checks and handler setups.
+
+    Chunks are cut from every user of the page (including those already in a
+    terminal state which are then left out) so each chunk keeps its name
+    when a retried user retrieval task stores the page again.  The name is
+    derived from the first user's key (which holds the task id) and the
+    chunk's index in the page.
 
     Args:
       message_criteria: String criteria (message-id) to recall.
-      owner_email: String email address of user running this recall.
+      users: List of user (DomainUserToCheckModel) entities of a page.
     """
-    if recall_task.RecallTaskModel.IsTaskAborted(self._task_key_id):
-      return
-    cursor = None
-    while True:
-      user_recall_tasks = []
-      results, cursor, unused_more = (
-          domain_user.DomainUserToCheckModel.FetchOnePageOfActiveUsersForTask(
-              task_key_id=self._task_key_id,
-              cursor=cursor))
-      for user in results:
-        user_recall_tasks.append(Task(
-            name='%s_%s_%s' % (
-                view_utils.CreateSafeUserEmailForTaskName(owner_email),
-                view_utils.CreateSafeUserEmailForTaskName(user.user_email),
-                view_utils.GetCurrentDateTimeForTaskName()),
-            params={'message_criteria': message_criteria,
-                    'task_key_id': self._task_key_id,
-                    'user_email': user.user_email,
-                    'user_key_id': user.key.id()},
-            target='recall-backend',
-            url='/backend/recall_user_messages'))
-      if not user_recall_tasks:
-        break
+    user_recall_tasks = []
+    for batch_start in xrange(0, len(users), _USER_RECALL_BATCH_SIZE):
+      batch_users = users[batch_start:batch_start + _USER_RECALL_BATCH_SIZE]
+      recall_users = [user for user in batch_users
+                      if user.user_state not in
+                      domain_user.TERMINAL_USER_STATES]
+      if not recall_users:
+        continue
+      user_recall_tasks.append(Task(
+          name='%s_%s' % (
+              view_utils.CreateSafeUserEmailForTaskName(
+                  batch_users[0].key.id()),
+              batch_start // _USER_RECALL_BATCH_SIZE),
+          params={'message_criteria': message_criteria,
+                  'task_key_id': self._task_key_id,
+                  'user_email': [user.user_email for user in recall_users],
+                  'user_key_id': [user.key.id() for user in recall_users]},
+          target='recall-backend',
+          url='/backend/recall_user_messages'))
+    if user_recall_tasks:
       self._AddUserRecallTasks(user_recall_tasks=user_recall_tasks)
 
   def _IncrementRetrievalStartedTasksCount(self):
@@ -378,54 +668,143 @@ class Phase2RetrieveDomainUsersHandler(BackendBaseHandler):
           raise_exception=True)
     return retrieval_ended_count
 
-  def _RetrieveAndAddUsers(self, email_prefix, owner_email):
-    """Search domain users and add returned users to the data store.
+  def _RetrieveUserPages(self, owner_email):
+    """Search domain users with the email prefix of this task.
 
-    Each tasks searches a domain user subset based on the email_prefix.
+    Each tasks searches a domain user subset based on the email_prefix
+    (or the full username if it ends with '@').  The #users found with a
+    prefix is recorded to partition later recalls.
+
+    Users are read from a fresh directory snapshot shared by recent recalls
+    when available. Otherwise the Admin SDK is searched and the users found
+    are kept as the new snapshot of the prefix.
 
     Args:
-      email_prefix: String with the first n characters of an email address.
       owner_email: String email address of the user who owns the task.
                    The search will occur in this users domain.
+
+    Yields:
+      List of tuples (1 for each user) with a String email address and the
+      suspended status of the users to check.
     """
+    email_prefix = self.request.get('email_prefix')
+    user_domain = view_utils.GetUserDomain(owner_email)
+    is_exact_match = email_prefix.endswith(_EMAIL_PREFIX_EXACT_SUFFIX)
+    user_tuples = (
+        directory_snapshot.DirectorySnapshotModel.GetFreshUserTuples(
+            user_domain=user_domain, email_prefix=email_prefix))
+    if user_tuples is not None:
+      for page_start in xrange(0, len(user_tuples), _SNAPSHOT_PAGE_SIZE):
+        yield user_tuples[page_start:page_start + _SNAPSHOT_PAGE_SIZE]
+      return
+
+    user_tuples = []
+    for user_tuples_page in user_retriever.DomainUserRetriever(
+        owner_email=owner_email,
+        user_domain=user_domain,
+        email_query_prefix=(email_prefix + user_domain if is_exact_match
+                            else email_prefix),
+        use_glob=not is_exact_match).RetrieveDomainUsers():
+      yield user_tuples_page
+      user_tuples.extend(user_tuples_page)
+    directory_snapshot.DirectorySnapshotModel.SetUserTuples(
+        user_domain=user_domain, email_prefix=email_prefix,
+        user_tuples=user_tuples)
+    if not is_exact_match:
+      prefix_user_count.EmailPrefixUserCountModel.SetPrefixUserCount(
+          user_domain=user_domain, email_prefix=email_prefix,
+          user_count=len(user_tuples))
+
+  def _RetrieveAndAddUsers(self, message_criteria, owner_email):
+    """Retrieve users, add them to the data store and start recalling.
+
+    Recall tasks for each page of users are enqueued as soon as the page is
+    stored so recalling overlaps the rest of the user retrieval.  The next
+    page is retrieved (in a thread) while a page is stored and the access
+    tokens of a page are minted (in a thread) while the next page is stored.
+    A recall task starting before its users' tokens are cached mints them
+    itself.
+
+    Args:
+      message_criteria: String criteria (message-id) to recall.
+      owner_email: String email address of the user who owns the task.
+    """
+    mint_thread = None
     try:
-      for user_tuples_page in user_retriever.DomainUserRetriever(
-          owner_email=owner_email,
-          user_domain=view_utils.GetUserDomain(owner_email),
-          email_query_prefix=email_prefix,
-          use_glob=True).RetrieveDomainUsers():
-        self._AddUserRecordsPage(user_tuples=user_tuples_page)
+      for user_tuples_page in _IterateAhead(
+          self._RetrieveUserPages(owner_email)):
+        users = self._AddUserRecordsPage(user_tuples=user_tuples_page)
+        self._EnqueueUserRecallTasks(message_criteria=message_criteria,
+                                     users=users)
+        if mint_thread:
+          mint_thread.join()
+        mint_thread = threading.Thread(target=self._PreMintAccessTokens,
+                                       args=(users,))
+        mint_thread.start()
     except recall_errors.MessageRecallError:
       view_utils.FailRecallTask(
           task_key_id=self._task_key_id,
           reason_string='Failure retrieving users.')
       raise
+    finally:
+      if mint_thread:
+        mint_thread.join()
 
   def post(self):  # pylint: disable=g-bad-name
     """Handler for /backend/retrieve_domain_users post requests.
 
     Generates tasks handled by Phase3RecallUserMessagesHandler().
+
+    The last retrieval task to end moves the task to TASK_RECALLING which
+    allows the last user to reach a terminal state to complete the task.
     """
     super(Phase2RetrieveDomainUsersHandler, self).post()
     self._was_incremented = False
     self._IncrementRetrievalStartedTasksCount()
     owner_email = self.request.get('owner_email')
-    self._RetrieveAndAddUsers(email_prefix=self.request.get('email_prefix'),
-                              owner_email=owner_email)
+    self._RetrieveAndAddUsers(
+        message_criteria=self.request.get('message_criteria'),
+        owner_email=owner_email)
     if self._AreUserRetrievalTasksCompleted():
       recall_task.RecallTaskModel.SetTaskState(
           task_key_id=self._task_key_id,
           new_state=recall_task.TASK_RECALLING)
-      self._EnqueueUserRecallTasks(
-          message_criteria=self.request.get('message_criteria'),
-          owner_email=owner_email)
-      self._AddTaskToMonitorUserRecallTasksHaveCompleted(owner_email)
+      # Users may all have finished already (e.g. all suspended or recalled
+      # while users were still being retrieved).
+      if not recall_task.RecallTaskModel.CompleteTaskIfUsersFinished(
+          self._task_key_id):
+        _AddTaskToMonitorRecallTaskCompletion(
+            task_key_id=self._task_key_id, owner_email=owner_email)
+
+
+class Phase2RetrieveRecipientUsersHandler(Phase2RetrieveDomainUsersHandler):
+  """Handle '/backend/retrieve_recipient_users to add the recipients found.
+
+  Replaces the domain user retrieval of a recall targeted at the recipients
+  Phase1 read from the sender's copy.  It is the only user retrieval task of
+  its recall.
+  """
+
+  def _RetrieveUserPages(self, unused_owner_email):
+    """Provide the recipient users carried by the task.
+
+    Args:
+      unused_owner_email: String email address of the user who owns the task.
+
+    Yields:
+      List of tuples (1 for each user) with a String email address and the
+      suspended status of the users to check.
+    """
+    yield zip(self.request.get_all('user_email'),
+              [user_suspended == '1'
+               for user_suspended in self.request.get_all('user_suspended')])
 
 
 class Phase3RecallUserMessagesHandler(BackendBaseHandler):
-  """Handle '/backend/recall_user_messages - check/recall messages for one user.
+  """Handle '/backend/recall_user_messages - check/recall messages for users.
 
-  Interfaces with gmail via imap for an individual user.
+  Interfaces with gmail via imap for a chunk of users.  Each user's state is
+  tracked separately in its own DomainUserToCheckModel entity.
   """
 
   def _RecallUserMessages(self, message_criteria, user_email, user_key_id):
@@ -436,7 +815,7 @@ class Phase3RecallUserMessagesHandler(BackendBaseHandler):
     Args:
       message_criteria: String criteria (message-id) to recall.
       user_email: String email address of the user to check.
-      user_key_id: Int unique id of the user entity to update state.
+      user_key_id: String unique id of the user entity to update state.
     """
     try:
       with mail_api.GmailHelper(self._task_key_id, user_key_id, user_email,
@@ -449,33 +828,70 @@ class Phase3RecallUserMessagesHandler(BackendBaseHandler):
           error_reason=str(e),
           user_email=user_email)
 
+  def _RecallUsersMessages(self, message_criteria, user_tuples):
+    """Helper to recall messages for a chunk of users concurrently.
+
+    Users already in a terminal state (e.g. from an earlier attempt of this
+    task) are skipped.
+
+    Args:
+      message_criteria: String criteria (message-id) to recall.
+      user_tuples: List of tuples (1 for each user) with a String email
+                   address and the String unique id of the user entity.
+    """
+    unfinished_user_key_ids = (
+        domain_user.DomainUserToCheckModel.GetUnfinishedUserKeyIds(
+            [user_key_id for unused_user_email, user_key_id in user_tuples]))
+    _RunInThreadPool(
+        work_function=lambda user_tuple: self._RecallUserMessages(
+            message_criteria=message_criteria,
+            user_email=user_tuple[0],
+            user_key_id=user_tuple[1]),
+        work_items=[user_tuple for user_tuple in user_tuples
+                    if user_tuple[1] in unfinished_user_key_ids],
+        max_threads=_USER_RECALL_MAX_THREADS)
+
   def post(self):  # pylint: disable=g-bad-name
     """Handler for /backend/recall_user_messages post requests."""
     super(Phase3RecallUserMessagesHandler, self).post()
-    self._RecallUserMessages(
+    self._RecallUsersMessages(
         message_criteria=self.request.get('message_criteria'),
-        user_email=self.request.get('user_email'),
-        user_key_id=int(self.request.get('user_key_id')))
+        user_tuples=zip(self.request.get_all('user_email'),
+                        self.request.get_all('user_key_id')))
 
 
 class Phase4WaitForTaskCompletionHandler(BackendBaseHandler):
-  """Handle '/backend/wait_for_task_completion - Wait for all tasks complete."""
-
-  def _AreAllUserRecallTasksCompleted(self):
-    """Helper to check if all user entities are completed.
-
-    Returns:
-      Boolean; True if all user entities are completed (in a terminal state).
-    """
-    task = recall_task.RecallTaskModel.GetTaskByKey(self._task_key_id)
-    return (task.GetUserCountForTask() ==
-            task.GetUserCountForTaskWithTerminalUserStates())
+  """Handle '/backend/wait_for_task_completion - Watchdog for task completion.
+
+  The last user to reach a terminal state normally completes the task.  This
+  check recounts the counter shards in case a memcache counter was lost and
+  reschedules itself until the task is done.  If no user finished for
+  _MONITOR_IDLE_CHECKS_MAX checks, the counters are repaired from queries
+  (e.g. after a crash overcounted the users added) and the check stops:
+  the repaired counters let the last user complete the task.
+  """
 
   def post(self):  # pylint: disable=g-bad-name
-    """Handler for /backend/recall_user_messages post requests."""
+    """Handler for /backend/wait_for_task_completion post requests."""
     super(Phase4WaitForTaskCompletionHandler, self).post()
-    while not self._AreAllUserRecallTasksCompleted():
-      time.sleep(_MONITOR_SLEEP_PERIOD_S)
-    recall_task.RecallTaskModel.SetTaskState(task_key_id=self._task_key_id,
-                                             new_state=recall_task.TASK_DONE,
-                                             is_aborted=False)
+    if recall_task.RecallTaskModel.CompleteTaskIfUsersFinished(
+        self._task_key_id, skip_cache=True):
+      return
+    unused_users_added_count, users_terminal_count = (
+        domain_user.DomainUserToCheckModel.GetCountedUsersForTask(
+            task_key_id=self._task_key_id))
+    idle_check_count = 0
+    if users_terminal_count == int(self.request.get('users_terminal_count',
+                                                    0)):
+      idle_check_count = int(self.request.get('idle_check_count', 0)) + 1
+    if idle_check_count >= _MONITOR_IDLE_CHECKS_MAX:
+      domain_user.DomainUserToCheckModel.RecountUsersForTask(
+          task_key_id=self._task_key_id)
+      recall_task.RecallTaskModel.CompleteTaskIfUsersFinished(
+          self._task_key_id, skip_cache=True)
+      return
+    _AddTaskToMonitorRecallTaskCompletion(
+        task_key_id=self._task_key_id,
+        owner_email=self.request.get('owner_email'),
+        users_terminal_count=users_terminal_count,
+        idle_check_count=idle_check_count)
@@ -18,21 +18,38 @@ A service account is used to allow multiple 'Admin' users access to resources
 owned by multiple users in an apps domain.
 """
 
+import calendar
+import contextlib
 import os
+import threading
+import time
 
 import http_utils
 import log_utils
 from oauth2client import client
+import pool_utils
 import recall_errors
 import service_account
 
 from google.appengine.api import memcache
 
 
-_ACCESS_TOKEN_CACHE_S = 60 * 59  # Access tokens last about 1 hour.
+# Access tokens are cached with the expiry returned when minted (about 1 hour)
+# and not used in their last minute.  Tokens used in their last 5 minutes are
+# refreshed in the background so callers keep using the cached token.
+_ACCESS_TOKEN_DEFAULT_LIFETIME_S = 60 * 60
+_ACCESS_TOKEN_EXPIRY_MARGIN_S = 60
+_ACCESS_TOKEN_LRU_MAX_SIZE = 2000
+_ACCESS_TOKEN_REFRESH_AHEAD_S = 5 * 60
 _CACHE_NAMESPACE = 'messagerecall_accesstoken#ns'
 _LOG = log_utils.GetLogger('messagerecall.credentials_utils')
 
+# One access_token refresh per user runs at a time (per instance using a lock
+# and across instances using a memcache lease).  Others wait for its token.
+_REFRESH_LEASE_NAMESPACE = 'messagerecall_accesstoken_lease#ns'
+_REFRESH_LEASE_S = 15
+_REFRESH_WAIT_POLL_S = 0.1
+
 # Load the key in PKCS 12 format that you downloaded from the Google API
 # Console when you created your Service account.
 _SERVICE_ACCOUNT_PEM_FILE_NAME = os.path.join(
@@ -41,6 +58,12 @@ _SERVICE_ACCOUNT_PEM_FILE_NAME = os.path.join(
 with open(_SERVICE_ACCOUNT_PEM_FILE_NAME, 'rb') as f:
   _SERVICE_ACCOUNT_KEY = f.read()
 
+# Users are impersonated with delegated copies sharing the parsed key.
+_SERVICE_ACCOUNT_CREDENTIALS = client.SignedJwtAssertionCredentials(
+    service_account_name=service_account.SERVICE_ACCOUNT_NAME,
+    private_key=_SERVICE_ACCOUNT_KEY,
+    scope=service_account.SERVICE_SCOPES)
+
 
 def _GetSignedJwtAssertionCredentials(user_email):
   """Retrieve an OAuth2 credentials object impersonating user_email.
@@ -49,9 +72,9 @@ def _GetSignedJwtAssertionCredentials(user_email):
   used to connect with Google services such as the Admin SDK.
   Also includes an access_token that is used to connect to IMAP.
 
-  The first parameter, service_account_name,is the Email address
-  created for the Service account from the API Console.  The sub parameter
-  is the Authenticated user to impersonate.
+  The service_account_name is the Email address created for the Service
+  account from the API Console.  The sub (delegated user) is the
+  Authenticated user to impersonate.
 
   Args:
     user_email: String of the user email account to impersonate.
@@ -59,11 +82,46 @@ def _GetSignedJwtAssertionCredentials(user_email):
   Returns:
     oauth2client credentials object.
   """
-  return client.SignedJwtAssertionCredentials(
-      service_account_name=service_account.SERVICE_ACCOUNT_NAME,
-      private_key=_SERVICE_ACCOUNT_KEY,
-      scope=service_account.SERVICE_SCOPES,
-      sub=user_email)
+  return _SERVICE_ACCOUNT_CREDENTIALS.create_delegated(user_email)
+
+
+class _UserLockTable(object):
+  """Table of in-process locks by user email, dropped once unused."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._user_locks = {}  # user_email: [Lock, #threads using it]
+
+  @contextlib.contextmanager
+  def Lock(self, user_email):
+    """Hold the lock of one user.
+
+    Args:
+      user_email: String email address of the user.
+
+    Yields:
+      None once the lock is held.
+    """
+    with self._lock:
+      user_lock = self._user_locks.setdefault(user_email,
+                                              [threading.Lock(), 0])
+      user_lock[1] += 1
+    try:
+      with user_lock[0]:
+        yield
+    finally:
+      with self._lock:
+        user_lock[1] -= 1
+        if not user_lock[1]:
+          del self._user_locks[user_email]
+
+
+# Entries are tuples (String access_token, Float expiry time in seconds since
+# epoch) by user email.
+_ACCESS_TOKEN_LRU = pool_utils.LruCache(max_size=_ACCESS_TOKEN_LRU_MAX_SIZE)
+_BACKGROUND_REFRESH_LOCK = threading.Lock()
+_BACKGROUND_REFRESH_USER_EMAILS = set()
+_USER_REFRESH_LOCKS = _UserLockTable()
 
 
 def GetAuthorizedHttp(user_email):
@@ -93,6 +151,10 @@ def GetAuthorizedHttp(user_email):
 def GetUserAccessToken(user_email, force_refresh=False):
   """Helper to get a refreshed access_token for a user via service account.
 
+  Access tokens are read from an in-process cache then from memcache. Tokens
+  close to expiry are refreshed in the background and expired ones (or
+  forced refreshes) synchronously.
+
   Args:
     user_email: User email for which access_token will be retrieved.
     force_refresh: Boolean, if True force a token refresh.
@@ -100,18 +162,195 @@ def GetUserAccessToken(user_email, force_refresh=False):
   Returns:
     Cached access_token or a new one.
   """
-  access_token = memcache.get(user_email, namespace=_CACHE_NAMESPACE)
-  if access_token and not force_refresh:
-    return access_token
+  access_token_entry = _ACCESS_TOKEN_LRU.Get(user_email)
+  if not access_token_entry:
+    access_token_entry = _GetSharedAccessTokenEntry(user_email)
+    if access_token_entry:
+      _ACCESS_TOKEN_LRU.Set(user_email, access_token_entry)
+  stale_access_token = None
+  if access_token_entry:
+    stale_access_token, expiry_time = access_token_entry
+    time_left_s = expiry_time - time.time()
+    if not force_refresh and time_left_s > _ACCESS_TOKEN_EXPIRY_MARGIN_S:
+      if time_left_s < _ACCESS_TOKEN_REFRESH_AHEAD_S:
+        _StartBackgroundRefresh(user_email, stale_access_token)
+      return stale_access_token
+  return _RefreshAccessToken(user_email, stale_access_token)
+
+
+def _GetSharedAccessTokenEntry(user_email):
+  """Helper to read an access token entry from memcache.
+
+  Args:
+    user_email: User email for which access_token will be retrieved.
+
+  Returns:
+    Tuple (access_token, expiry time) or None if not cached (or cached by an
+    older version without its expiry).
+  """
+  access_token_entry = memcache.get(user_email, namespace=_CACHE_NAMESPACE)
+  if isinstance(access_token_entry, tuple):
+    return access_token_entry
+  return None
+
+
+def _IsUsable(access_token_entry):
+  """Helper to check a cached access token is not about to expire."""
+  return bool(access_token_entry and access_token_entry[1] - time.time() >
+              _ACCESS_TOKEN_REFRESH_AHEAD_S)
+
+
+def _StartBackgroundRefresh(user_email, stale_access_token):
+  """Refresh a user access_token in a thread unless already refreshing.
+
+  Args:
+    user_email: User email for which access_token will be refreshed.
+    stale_access_token: String access_token to be replaced.
+  """
+  with _BACKGROUND_REFRESH_LOCK:
+    if user_email in _BACKGROUND_REFRESH_USER_EMAILS:
+      return
+    _BACKGROUND_REFRESH_USER_EMAILS.add(user_email)
+
+  def _Refresh():
+    try:
+      _RefreshAccessToken(user_email, stale_access_token)
+    except Exception as e:  # pylint: disable=broad-except
+      _LOG.warning('[%s] Unable to refresh access token ahead of expiry: %s.',
+                   user_email, e)
+    finally:
+      with _BACKGROUND_REFRESH_LOCK:
+        _BACKGROUND_REFRESH_USER_EMAILS.discard(user_email)
+
+  refresh_thread = threading.Thread(target=_Refresh)
+  refresh_thread.daemon = True
+  refresh_thread.start()
+
+
+def _RefreshAccessToken(user_email, stale_access_token):
+  """Helper to replace a user access_token, once for concurrent callers.
+
+  Callers arriving while another thread or instance refreshes the
+  access_token wait for and reuse its new token.
+
+  Args:
+    user_email: User email for which access_token will be refreshed.
+    stale_access_token: String access_token to be replaced or None.
+
+  Returns:
+    String new access_token.
+
+  Raises:
+    MessageRecallCounterError: If the new access_token cannot be cached.
+  """
+  with _USER_REFRESH_LOCKS.Lock(user_email):
+    # Any token other than the stale one was refreshed meanwhile.
+    access_token_entry = _GetSharedAccessTokenEntry(user_email)
+    if access_token_entry and access_token_entry[0] != stale_access_token:
+      _ACCESS_TOKEN_LRU.Set(user_email, access_token_entry)
+      return access_token_entry[0]
+    has_lease = memcache.add(user_email, 1, time=_REFRESH_LEASE_S,
+                             namespace=_REFRESH_LEASE_NAMESPACE)
+    if not has_lease:
+      access_token_entry = _WaitForRefreshedAccessToken(user_email,
+                                                        stale_access_token)
+      if access_token_entry:
+        _ACCESS_TOKEN_LRU.Set(user_email, access_token_entry)
+        return access_token_entry[0]
+    try:
+      access_token_entry = MintUserAccessToken(user_email)
+      _ACCESS_TOKEN_LRU.Set(user_email, access_token_entry)
+      if memcache.set(user_email, access_token_entry,
+                      time=_GetCacheTime(access_token_entry),
+                      namespace=_CACHE_NAMESPACE):
+        return access_token_entry[0]
+    finally:
+      if has_lease:
+        memcache.delete(user_email, namespace=_REFRESH_LEASE_NAMESPACE)
+  raise recall_errors.MessageRecallCounterError(
+      'Exceeded retry limit in GetUserAccessToken: %s.' % user_email)
+
+
+def _WaitForRefreshedAccessToken(user_email, stale_access_token):
+  """Helper to wait for another instance to refresh a user access_token.
+
+  Args:
+    user_email: User email for which access_token is being refreshed.
+    stale_access_token: String access_token to be replaced or None.
+
+  Returns:
+    Tuple (access_token, expiry time) of the new access_token or None if the
+    refresh ended (or took longer than the lease) without caching one.
+  """
+  wait_end_time = time.time() + _REFRESH_LEASE_S
+  while time.time() < wait_end_time:
+    time.sleep(_REFRESH_WAIT_POLL_S)
+    access_token_entry = _GetSharedAccessTokenEntry(user_email)
+    if access_token_entry and access_token_entry[0] != stale_access_token:
+      return access_token_entry
+    if not memcache.get(user_email, namespace=_REFRESH_LEASE_NAMESPACE):
+      break
+  _LOG.debug('Gave up waiting for the access token refresh of %s.',
+             user_email)
+  return None
+
+
+def _GetCacheTime(access_token_entry):
+  """Helper to derive the memcache expiration of an access token entry."""
+  return max(1, int(access_token_entry[1] - time.time()))
+
+
+def MintUserAccessToken(user_email):
+  """Helper to get a new access_token for a user via service account.
+
+  Args:
+    user_email: User email for which access_token will be minted.
 
+  Returns:
+    Tuple (String access_token, Float expiry time in seconds since epoch);
+    not cached.
+  """
   credentials = _GetSignedJwtAssertionCredentials(user_email)
   # Have observed the following error from refresh():
   # 'Unable to fetch URL: https://accounts.google.com/o/oauth2/token'
   _LOG.debug('Refreshing access token for %s.', user_email)
   credentials.refresh(http_utils.GetHttpObject())
-  access_token = credentials.access_token
-  if memcache.set(user_email, access_token, time=_ACCESS_TOKEN_CACHE_S,
-                  namespace=_CACHE_NAMESPACE):
-    return access_token
-  raise recall_errors.MessageRecallCounterError(
-      'Exceeded retry limit in GetUserAccessToken: %s.' % user_email)
+  if credentials.token_expiry:  # UTC datetime derived from expires_in.
+    expiry_time = calendar.timegm(credentials.token_expiry.utctimetuple())
+  else:
+    expiry_time = time.time() + _ACCESS_TOKEN_DEFAULT_LIFETIME_S
+  return credentials.access_token, expiry_time
+
+
+def GetUncachedUserEmails(user_emails):
+  """Helper to find the users who have no cached access_token to use.
+
+  Args:
+    user_emails: List of user emails.
+
+  Returns:
+    List of the user emails without a cached access_token or with one
+    close to expiry.
+  """
+  access_token_entries = memcache.get_multi(user_emails,
+                                            namespace=_CACHE_NAMESPACE)
+  return [user_email for user_email in user_emails
+          if not (isinstance(access_token_entries.get(user_email), tuple) and
+                  _IsUsable(access_token_entries[user_email]))]
+
+
+def SetUserAccessTokens(access_token_entries):
+  """Cache access_tokens minted ahead of use for many users at once.
+
+  Args:
+    access_token_entries: Dictionary of user email to tuple (access_token,
+                          expiry time) from MintUserAccessToken().
+  """
+  failed_user_emails = memcache.set_multi(
+      access_token_entries,
+      time=min(_GetCacheTime(access_token_entry)
+               for access_token_entry in access_token_entries.itervalues()),
+      namespace=_CACHE_NAMESPACE)
+  if failed_user_emails:
+    _LOG.warning('Unable to cache %s pre-minted access tokens.',
+                 len(failed_user_emails))
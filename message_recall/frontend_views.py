@@ -46,6 +46,8 @@ _GET_USER_MAX_RETRIES = 2
 _LOG = log_utils.GetLogger('messagerecall.views')
 _MESSAGE_ID_REGEX = re.compile(r'^[\w+-=.]+@[\w.]+$')
 _MESSAGE_ID_MAX_LEN = 100
+_SENDER_EMAIL_REGEX = re.compile(r"^[\w.'-]+@[\w.-]+$")
+_MESSAGE_IDS_MAX_COUNT = 20
 _USER_ADMIN_CACHE_NAMESPACE = 'messagerecall_useradmin#ns'
 _USER_ADMIN_CACHE_TIMEOUT_S = 60 * 60 * 2  # 2 hours
 _USER_BILLING_CACHE_TIMEOUT_S = 60 * 60 * 24  # 24 hours
@@ -237,28 +239,76 @@ class AboutPageHandler(UIBasePageHandler):
     self._WriteTemplate('about')
 
 
+def _ValidateMessageIds(unused_form, field):
+  """wtforms validator for a list of message-ids.
+
+  Uses a Regexp on each message-id for xss protection to ensure no html tag
+  characters are allowed.
+
+  Args:
+    unused_form: wtforms.Form being validated.
+    field: wtforms field with whitespace or comma separated message-ids.
+
+  Raises:
+    ValidationError: If any message-id (or the count of them) is invalid.
+  """
+  message_ids = recall_task.SplitMessageCriteria(field.data or '')
+  if not 1 <= len(message_ids) <= _MESSAGE_IDS_MAX_COUNT:
+    raise validators.ValidationError(
+        u'Supply 1-%s message-ids.' % _MESSAGE_IDS_MAX_COUNT)
+  for message_id in message_ids:
+    if len(message_id) > _MESSAGE_ID_MAX_LEN:
+      raise validators.ValidationError(
+          u'message-id must be 1-%s characters.' % _MESSAGE_ID_MAX_LEN)
+    if not _MESSAGE_ID_REGEX.match(message_id):
+      raise validators.ValidationError(
+          u'message-id format is: local-part@domain.com (separate multiple '
+          'message-ids with spaces).')
+
+
+def _ValidateSenderEmail(unused_form, field):
+  """wtforms validator for the optional sender of the messages.
+
+  The sender's copy of the messages is read so the sender must be a user of
+  the current user's domain.
+
+  Args:
+    unused_form: wtforms.Form being validated.
+    field: wtforms field with an email address or nothing.
+
+  Raises:
+    ValidationError: If the sender is not a user of the current domain.
+  """
+  sender_email = (field.data or '').strip().lower()
+  if not sender_email:
+    return
+  if (not _SENDER_EMAIL_REGEX.match(sender_email) or
+      view_utils.GetUserDomain(sender_email) != view_utils.GetUserDomain(
+          _SafelyGetCurrentUserEmail())):
+    raise validators.ValidationError(
+        u'Sender must be an email address of your domain or left blank.')
+
+
 class CreateTaskForm(wtforms.Form):
   """Wrap and validate the form that ingests user input for a recall task.
 
-  Uses Regexp for xss protection to ensure no html tag characters are allowed.
+  Several message-ids may be supplied to recall a wave of messages together.
   """
-  message_criteria = wtforms.TextField(
-      label='Message-ID', default='', validators=[
-          validators.Length(min=1, max=_MESSAGE_ID_MAX_LEN,
-                            message=(u'message-id must be 1-%s characters.' %
-                                     _MESSAGE_ID_MAX_LEN)),
-          validators.Regexp(_MESSAGE_ID_REGEX,
-                            message=(u'message-id format is: local-part@domain.'
-                                     'com (no spaces allowed).'))])
+  message_criteria = wtforms.TextAreaField(
+      label='Message-IDs', default='', validators=[_ValidateMessageIds])
+  # When supplied, only the recipients of the sender's copy are recalled.
+  sender_email = wtforms.TextField(
+      label='Sender', default='', validators=[_ValidateSenderEmail])
 
   @property
   def sanitized_message_criteria(self):
     """Helper to ensure message-id field has no extra junk.
 
     Returns:
-      String as a safely scrubbed searchable message-id.
+      String of space separated, safely scrubbed searchable message-ids.
     """
-    return self.message_criteria.data.strip()
+    return ' '.join(
+        recall_task.SplitMessageCriteria(self.message_criteria.data))
 
 
 class CreateTaskPageHandler(UIBasePageHandler, xsrf_helper.XsrfHelper):
@@ -274,12 +324,13 @@ class CreateTaskPageHandler(UIBasePageHandler, xsrf_helper.XsrfHelper):
                                      action_id=_CREATE_TASK_ACTION))
 
   def _EnqueueMasterRecallTask(self, owner_email, message_criteria,
-                               task_key_id):
+                               sender_email, task_key_id):
     """Add master recall task with error handling.
 
     Args:
       owner_email: String email address of user running this recall.
       message_criteria: String criteria (message-id) to recall.
+      sender_email: String email address of the sender or empty.
       task_key_id: Int unique id of the parent task.
 
     Raises:
@@ -291,7 +342,8 @@ class CreateTaskPageHandler(UIBasePageHandler, xsrf_helper.XsrfHelper):
     master_task = Task(name=task_name,
                        params={'owner_email': owner_email,
                                'task_key_id': task_key_id,
-                               'message_criteria': message_criteria},
+                               'message_criteria': message_criteria,
+                               'sender_email': sender_email},
                        target='0.recall-backend',
                        url='/backend/recall_messages')
     try:
@@ -301,7 +353,7 @@ class CreateTaskPageHandler(UIBasePageHandler, xsrf_helper.XsrfHelper):
                                 reason_string='Failed to enqueue master task.')
       raise
 
-  def _CreateNewTask(self, owner_email, message_criteria):
+  def _CreateNewTask(self, owner_email, message_criteria, sender_email):
     """Helper to create new task db entity and related Task for the backend.
 
     If the master task fails creation in the db, the error will be raised
@@ -313,16 +365,20 @@ class CreateTaskPageHandler(UIBasePageHandler, xsrf_helper.XsrfHelper):
     Args:
       owner_email: String email address of the user. Used in authorization.
       message_criteria: String criteria used to find message(s) to recall.
+      sender_email: String email address of the sender or empty to recall
+                    from all domain users.
 
     Returns:
       Urlsafe (String) key for the RecallTaskModel entity that was created.
     """
     recall_task_entity = recall_task.RecallTaskModel(
         owner_email=owner_email,
-        message_criteria=message_criteria)
+        message_criteria=message_criteria,
+        sender_email=sender_email or None)
     recall_task_key = recall_task_entity.put()
     self._EnqueueMasterRecallTask(owner_email=owner_email,
                                   message_criteria=message_criteria,
+                                  sender_email=sender_email,
                                   task_key_id=recall_task_key.id())
     return recall_task_key.urlsafe()
 
@@ -347,7 +403,8 @@ class CreateTaskPageHandler(UIBasePageHandler, xsrf_helper.XsrfHelper):
       return
     self.redirect('/task/%s' % self._CreateNewTask(
         owner_email=current_user_email,
-        message_criteria=create_task_form.sanitized_message_criteria))
+        message_criteria=create_task_form.sanitized_message_criteria,
+        sender_email=create_task_form.sender_email.data.strip().lower()))
 
 
 class DebugTaskPageHandler(UIBasePageHandler):
@@ -452,6 +509,9 @@ class TaskReportPageHandler(UIBasePageHandler):
 
   This page will show summary results from a recall task including
   categories of user_state with counts and user email lists.
+
+  Counts are read from the per-task state histograms (a few cached reads)
+  instead of running a count() query for each state.
   """
 
   def get(self, task_key_urlsafe):  # pylint: disable=g-bad-name
@@ -461,13 +521,23 @@ class TaskReportPageHandler(UIBasePageHandler):
       task_key_urlsafe: String representation of task key safe for urls.
     """
     _PreventUnauthorizedAccess()
+    task = recall_task.RecallTaskModel.FetchTaskFromSafeId(
+        user_domain=view_utils.GetUserDomain(_SafelyGetCurrentUserEmail()),
+        task_key_urlsafe=task_key_urlsafe)
+    user_state_counts, message_state_counts = (
+        task.GetStateCounts() if task else ({}, {}))
     self._WriteTemplate(
         template_file='task_report',
-        tpl_task=recall_task.RecallTaskModel.FetchTaskFromSafeId(
-            user_domain=view_utils.GetUserDomain(_SafelyGetCurrentUserEmail()),
-            task_key_urlsafe=task_key_urlsafe),
-        tpl_user_states=domain_user.USER_STATES,
-        tpl_message_states=domain_user.MESSAGE_STATES,
+        tpl_task=task,
+        tpl_error_reason_count=(
+            task.GetErrorReasonCountForTask() if task else 0),
+        tpl_user_count=sum(user_state_counts.values()),
+        tpl_terminal_user_count=sum(
+            user_state_counts[user_state]
+            for user_state in domain_user.TERMINAL_USER_STATES
+            if user_state in user_state_counts),
+        tpl_user_state_counts=user_state_counts,
+        tpl_message_state_counts=message_state_counts,
         tpl_task_key_urlsafe=task_key_urlsafe)
 
 
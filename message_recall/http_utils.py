@@ -17,12 +17,138 @@
 import httplib2
 
 import log_utils
+import pool_utils
 
 
+# Google front ends drop keep-alive connections idle for a few minutes.
+_CONNECTION_POOL_IDLE_TIMEOUT_S = 60
+_CONNECTION_POOL_MAX_HOSTS = 20
+_CONNECTION_POOL_MAX_IDLE_PER_HOST = 10
 _EXTENDED_SOCKET_TIMEOUT_S = 10  # Default of 5s seems too short for Admin SDK.
 _LOG = log_utils.GetLogger('messagerecall.http_utils')
 
 
+class HttpConnectionPool(pool_utils.IdlePool):
+  """Per-instance pool of idle keep-alive http connections.
+
+  Idle connections are keyed by the httplib2 connection key (scheme:host:port)
+  so that Http objects authorized for different users share warm sockets to
+  the same API hosts.  Connections idle longer than idle_timeout_s are closed
+  instead of reused and at most max_idle_per_host are kept per host.
+
+  Connections without an open socket (e.g. served by URLFetch on App Engine)
+  are not kept since they have nothing to reuse.
+  """
+
+  def __init__(self, max_hosts, max_idle_per_host, idle_timeout_s):
+    """Initialize an empty pool.
+
+    Args:
+      max_hosts: Int maximum number of hosts with idle connections.
+      max_idle_per_host: Int maximum number of idle connections kept per host.
+      idle_timeout_s: Int seconds an idle connection may be kept.
+    """
+    super(HttpConnectionPool, self).__init__(
+        max_keys=max_hosts, max_idle_per_key=max_idle_per_host,
+        idle_timeout_s=idle_timeout_s)
+
+  def _Close(self, connection):
+    """Close a connection whose socket may already be broken.
+
+    Args:
+      connection: httplib connection to close.
+    """
+    try:
+      connection.close()
+    except Exception as e:  # pylint: disable=broad-except
+      _LOG.debug('Error closing pooled http connection: %s.', e)
+
+  def Lease(self, connection_key):
+    """Lease the most recently used idle connection to a host if any.
+
+    Args:
+      connection_key: String httplib2 connection key (scheme:host:port).
+
+    Returns:
+      httplib connection or None if no fresh idle connection is available.
+    """
+    return self.LeaseIdle(connection_key)
+
+  def Release(self, connection_key, connection, reusable=True):
+    """Return a leased (or new) connection to the pool.
+
+    Args:
+      connection_key: String httplib2 connection key (scheme:host:port).
+      connection: httplib connection.
+      reusable: Boolean; False to close rather than keep the connection.
+    """
+    if not (reusable and getattr(connection, 'sock', None)):
+      self._Close(connection)
+      return
+    self.ReleaseIdle(connection_key, connection)
+
+
+class _PooledConnections(dict):
+  """Connections of one Http object, drawn from a shared pool when missing.
+
+  httplib2.Http looks its connections up with 'in' before creating one.
+  """
+
+  def __init__(self, connection_pool):
+    super(_PooledConnections, self).__init__()
+    self._connection_pool = connection_pool
+
+  def __contains__(self, connection_key):
+    if super(_PooledConnections, self).__contains__(connection_key):
+      return True
+    connection = self._connection_pool.Lease(connection_key)
+    if connection is None:
+      return False
+    self[connection_key] = connection
+    return True
+
+  def ReleaseAll(self, reusable):
+    """Return every connection held to the shared pool.
+
+    Args:
+      reusable: Boolean; False to close rather than keep the connections.
+    """
+    for connection_key, connection in self.items():
+      self._connection_pool.Release(connection_key, connection, reusable)
+    self.clear()
+
+
+class _PooledHttp(httplib2.Http):
+  """Http object holding its connections only for the duration of a request.
+
+  Connections go back to the shared pool once a request (and its redirects)
+  completes.  After an error they are closed: a response may be partly read.
+  """
+
+  def __init__(self, connection_pool, **kwargs):
+    httplib2.Http.__init__(self, **kwargs)
+    self.connections = _PooledConnections(connection_pool)
+    self._request_depth = 0
+
+  def request(self, *args, **kwargs):  # pylint: disable=g-bad-name
+    self._request_depth += 1
+    reusable = False
+    try:
+      response = httplib2.Http.request(self, *args, **kwargs)
+      reusable = True
+      return response
+    finally:
+      self._request_depth -= 1
+      if not self._request_depth:
+        self.connections.ReleaseAll(reusable)
+
+
+_HTTP_CONNECTION_POOL = HttpConnectionPool(
+    max_hosts=_CONNECTION_POOL_MAX_HOSTS,
+    max_idle_per_host=_CONNECTION_POOL_MAX_IDLE_PER_HOST,
+    idle_timeout_s=_CONNECTION_POOL_IDLE_TIMEOUT_S)
+
+
 def GetHttpObject():
   """Helper to abstract Http connection acquisition.
 
@@ -30,7 +156,11 @@ def GetHttpObject():
   running in a scaled environment with > 900 users.  Adding
   _EXTENDED_SOCKET_TIMEOUT_S seems to mostly resolve this.
 
+  Connections are drawn from (and returned to) a pool shared by the instance
+  to save a TCP/TLS handshake per authorized user.
+
   Returns:
     Http connection object.
   """
-  return httplib2.Http(timeout=_EXTENDED_SOCKET_TIMEOUT_S)
+  return _PooledHttp(_HTTP_CONNECTION_POOL,
+                     timeout=_EXTENDED_SOCKET_TIMEOUT_S)
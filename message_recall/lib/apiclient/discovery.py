@@ -49,6 +49,8 @@ import mimeparse
 import uritemplate
 
 # Local imports
+from apiclient import discovery_cache
+from apiclient.discovery_cache import memory_cache
 from apiclient.errors import HttpError
 from apiclient.errors import InvalidJsonError
 from apiclient.errors import MediaUploadSizeError
@@ -146,7 +148,9 @@ def build(serviceName,
           discoveryServiceUrl=DISCOVERY_URI,
           developerKey=None,
           model=None,
-          requestBuilder=HttpRequest):
+          requestBuilder=HttpRequest,
+          cache_discovery=True,
+          cache=None):
   """Construct a Resource for interacting with an API.
 
   Construct a Resource object for interacting with an API. The serviceName and
@@ -166,6 +170,11 @@ def build(serviceName,
     model: apiclient.Model, converts to and from the wire format.
     requestBuilder: apiclient.http.HttpRequest, encapsulator for an HTTP
       request.
+    cache_discovery: Boolean, whether or not to cache the discovery doc.
+    cache: apiclient.discovery_cache.base.Cache, an optional cache object for
+      the discovery documents shared across processes. Autodetected (App
+      Engine memcache or a file) if None. Parsed documents are also kept in
+      an in-process LRU cache.
 
   Returns:
     A Resource object with methods for interacting with the service.
@@ -179,23 +188,60 @@ def build(serviceName,
     http = httplib2.Http()
 
   requested_url = uritemplate.expand(discoveryServiceUrl, params)
+  service = _retrieve_discovery_doc(requested_url, http, serviceName, version,
+                                    cache_discovery, cache)
 
-  # REMOTE_ADDR is defined by the CGI spec [RFC3875] as the environment
-  # variable that contains the network address of the client sending the
-  # request. If it exists then add that to the request for the discovery
-  # document to avoid exceeding the quota on discovery requests.
-  if 'REMOTE_ADDR' in os.environ:
-    requested_url = _add_query_parameter(requested_url, 'userIp',
-                                         os.environ['REMOTE_ADDR'])
-  logger.info('URL being requested: %s' % requested_url)
+  return build_from_document(service, base=discoveryServiceUrl, http=http,
+      developerKey=developerKey, model=model, requestBuilder=requestBuilder)
+
+
+def _retrieve_discovery_doc(url, http, serviceName, version, cache_discovery,
+                            cache=None):
+  """Retrieves the parsed discovery_doc from cache or the internet.
 
-  resp, content = http.request(requested_url)
+  Args:
+    url: string, the URL of the discovery document.
+    http: httplib2.Http, An instance of httplib2.Http or something that acts
+      like it through which HTTP requests will be made.
+    serviceName: string, name of the service.
+    version: string, the version of the service.
+    cache_discovery: Boolean, whether or not to cache the discovery doc.
+    cache: apiclient.discovery_cache.base.Cache, an optional cache object for
+      the discovery documents.
 
-  if resp.status == 404:
-    raise UnknownApiNameOrVersion("name: %s  version: %s" % (serviceName,
-                                                            version))
-  if resp.status >= 400:
-    raise HttpError(resp, content, uri=requested_url)
+  Returns:
+    A deserialized discovery document.
+  """
+  if cache_discovery:
+    service = memory_cache.cache.get(url)
+    if service is not None:
+      return service
+    if cache is None:
+      cache = discovery_cache.autodetect()
+
+  content = None
+  if cache_discovery and cache:
+    content = cache.get(url)
+
+  is_fetched = content is None
+  if is_fetched:
+    actual_url = url
+    # REMOTE_ADDR is defined by the CGI spec [RFC3875] as the environment
+    # variable that contains the network address of the client sending the
+    # request. If it exists then add that to the request for the discovery
+    # document to avoid exceeding the quota on discovery requests.
+    if 'REMOTE_ADDR' in os.environ:
+      actual_url = _add_query_parameter(url, 'userIp',
+                                        os.environ['REMOTE_ADDR'])
+    logger.info('URL being requested: %s' % actual_url)
+
+    resp, content = http.request(actual_url)
+
+    if resp.status == 404:
+      raise UnknownApiNameOrVersion("name: %s  version: %s" % (serviceName,
+                                                              version))
+    if resp.status >= 400:
+      raise HttpError(resp, content, uri=actual_url)
 
   try:
     service = simplejson.loads(content)
@@ -203,8 +249,15 @@ def build(serviceName,
     logger.error('Failed to parse as JSON: ' + content)
     raise InvalidJsonError()
 
-  return build_from_document(content, base=discoveryServiceUrl, http=http,
-      developerKey=developerKey, model=model, requestBuilder=requestBuilder)
+  if cache_discovery:
+    if cache and is_fetched:
+      cache.set(url, content)
+    # Resources fix up the method descriptions they use in place. Do it for
+    # every method before sharing the document so later fix-ups by
+    # concurrent builds never resize a dictionary being iterated.
+    _fix_up_resource_description(service, service)
+    memory_cache.cache.set(url, service)
+  return service
 
 
 @positional(1)
@@ -549,6 +602,22 @@ class ResourceMethodParameters(object):
           self.query_params.remove(name)
 
 
+def _fix_up_resource_description(resource_desc, root_desc):
+  """Updates every method description of a resource and its sub-resources.
+
+  SIDE EFFECTS: Same as _fix_up_method_description for each method.
+
+  Args:
+    resource_desc: Dictionary; section of the deserialized discovery document
+        that describes a resource (the top level document is a resource).
+    root_desc: Dictionary; the entire original deserialized discovery document.
+  """
+  for method_desc in resource_desc.get('methods', {}).itervalues():
+    _fix_up_method_description(method_desc, root_desc)
+  for nested_desc in resource_desc.get('resources', {}).itervalues():
+    _fix_up_resource_description(nested_desc, root_desc)
+
+
 def createMethod(methodName, methodDesc, rootDesc, schema):
   """Creates a method for attaching to a Resource.
 
@@ -854,8 +923,6 @@ class Resource(object):
     self._rootDesc = rootDesc
     self._schema = schema
 
-    self._set_service_methods()
-
   def _set_dynamic_attr(self, attr_name, value):
     """Sets an instance attribute and tracks it in a list of dynamic attributes.
 
@@ -886,74 +953,118 @@ class Resource(object):
     """
     self.__dict__.update(state)
     self._dynamic_attrs = []
-    self._set_service_methods()
-
-  def _set_service_methods(self):
-    self._add_basic_methods(self._resourceDesc, self._rootDesc, self._schema)
-    self._add_nested_resources(self._resourceDesc, self._rootDesc, self._schema)
-    self._add_next_methods(self._resourceDesc, self._schema)
-
-  def _add_basic_methods(self, resourceDesc, rootDesc, schema):
-    # Add basic methods to Resource
-    if 'methods' in resourceDesc:
-      for methodName, methodDesc in resourceDesc['methods'].iteritems():
-        fixedMethodName, method = createMethod(
-            methodName, methodDesc, rootDesc, schema)
-        self._set_dynamic_attr(fixedMethodName,
-                               method.__get__(self, self.__class__))
-        # Add in _media methods. The functionality of the attached method will
-        # change when it sees that the method name ends in _media.
-        if methodDesc.get('supportsMediaDownload', False):
-          fixedMethodName, method = createMethod(
-              methodName + '_media', methodDesc, rootDesc, schema)
-          self._set_dynamic_attr(fixedMethodName,
-                                 method.__get__(self, self.__class__))
-
-  def _add_nested_resources(self, resourceDesc, rootDesc, schema):
-    # Add in nested resources
-    if 'resources' in resourceDesc:
-
-      def createResourceMethod(methodName, methodDesc):
-        """Create a method on the Resource to access a nested Resource.
-
-        Args:
-          methodName: string, name of the method to use.
-          methodDesc: object, fragment of deserialized discovery document that
-            describes the method.
-        """
-        methodName = fix_method_name(methodName)
-
-        def methodResource(self):
-          return Resource(http=self._http, baseUrl=self._baseUrl,
-                          model=self._model, developerKey=self._developerKey,
-                          requestBuilder=self._requestBuilder,
-                          resourceDesc=methodDesc, rootDesc=rootDesc,
-                          schema=schema)
-
-        setattr(methodResource, '__doc__', 'A collection resource.')
-        setattr(methodResource, '__is_resource__', True)
-
-        return (methodName, methodResource)
-
-      for methodName, methodDesc in resourceDesc['resources'].iteritems():
-        fixedMethodName, method = createResourceMethod(methodName, methodDesc)
-        self._set_dynamic_attr(fixedMethodName,
-                               method.__get__(self, self.__class__))
-
-  def _add_next_methods(self, resourceDesc, schema):
-    # Add _next() methods
+
+  def __getattr__(self, name):
+    """Builds a service method or nested resource on first access.
+
+    Only the methods used are created (and then kept as dynamic attributes)
+    so building a Resource costs nothing per method of the API.
+
+    Args:
+      name: string, name of the attribute not found on the instance.
+
+    Returns:
+      The bound method.
+
+    Raises:
+      AttributeError: If the resource has no method with that name.
+    """
+    # Private names (also looked up while unpickling, before the instance
+    # dictionary is restored) are never methods of the service.
+    if name.startswith('_'):
+      raise AttributeError(name)
+    # Order matters: it matches which method used to win on name clashes.
+    method = (self._create_next_method(name) or
+              self._create_nested_resource(name) or
+              self._create_basic_method(name))
+    if method is None:
+      raise AttributeError("'%s' object has no attribute '%s'" %
+                           (self.__class__.__name__, name))
+    self._set_dynamic_attr(name, method.__get__(self, self.__class__))
+    return self.__dict__[name]
+
+  def __dir__(self):
+    """Lists the service methods and nested resources not yet created too.
+
+    Returns:
+      Sorted list of the attribute names of the resource.
+    """
+    names = set(dir(self.__class__)) | set(self.__dict__)
+    methods = self._resourceDesc.get('methods', {})
+    for methodName, methodDesc in methods.iteritems():
+      names.add(fix_method_name(methodName))
+      if methodDesc.get('supportsMediaDownload', False):
+        names.add(methodName + '_media')
+      if self._create_next_method(methodName + '_next') is not None:
+        names.add(methodName + '_next')
+    for resourceName in self._resourceDesc.get('resources', {}):
+      names.add(fix_method_name(resourceName))
+    return sorted(names)
+
+  def _find_description(self, descriptions, name):
+    """Finds the description a fixed method name was derived from.
+
+    Args:
+      descriptions: dict, method or resource descriptions by name.
+      name: string, fixed name of the method (see fix_method_name).
+
+    Returns:
+      Tuple (description name, description) or (None, None) if not found.
+    """
+    for description_name in (name, name[:-1]):
+      if (description_name in descriptions and
+          fix_method_name(description_name) == name):
+        return description_name, descriptions[description_name]
+    return None, None
+
+  def _create_basic_method(self, name):
+    methods = self._resourceDesc.get('methods', {})
+    methodName, methodDesc = self._find_description(methods, name)
+    if methodDesc is not None:
+      return createMethod(methodName, methodDesc, self._rootDesc,
+                          self._schema)[1]
+    # Add in _media methods. The functionality of the attached method will
+    # change when it sees that the method name ends in _media.
+    methodDesc = methods.get(name[:-len('_media')])
+    if (name.endswith('_media') and methodDesc is not None and
+        methodDesc.get('supportsMediaDownload', False)):
+      return createMethod(name, methodDesc, self._rootDesc, self._schema)[1]
+    return None
+
+  def _create_nested_resource(self, name):
+    unused_methodName, methodDesc = self._find_description(
+        self._resourceDesc.get('resources', {}), name)
+    if methodDesc is None:
+      return None
+    rootDesc = self._rootDesc
+    schema = self._schema
+
+    def methodResource(self):
+      return Resource(http=self._http, baseUrl=self._baseUrl,
+                      model=self._model, developerKey=self._developerKey,
+                      requestBuilder=self._requestBuilder,
+                      resourceDesc=methodDesc, rootDesc=rootDesc,
+                      schema=schema)
+
+    setattr(methodResource, '__doc__', 'A collection resource.')
+    setattr(methodResource, '__is_resource__', True)
+
+    return methodResource
+
+  def _create_next_method(self, name):
     # Look for response bodies in schema that contain nextPageToken, and methods
     # that take a pageToken parameter.
-    if 'methods' in resourceDesc:
-      for methodName, methodDesc in resourceDesc['methods'].iteritems():
-        if 'response' in methodDesc:
-          responseSchema = methodDesc['response']
-          if '$ref' in responseSchema:
-            responseSchema = schema.get(responseSchema['$ref'])
-          hasNextPageToken = 'nextPageToken' in responseSchema.get('properties',
-                                                                   {})
-          hasPageToken = 'pageToken' in methodDesc.get('parameters', {})
-          if hasNextPageToken and hasPageToken:
-            fixedMethodName, method = createNextMethod(methodName + '_next')
-            self._set_dynamic_attr(fixedMethodName,
-                                   method.__get__(self, self.__class__))
+    if not name.endswith('_next'):
+      return None
+    methodDesc = self._resourceDesc.get('methods', {}).get(
+        name[:-len('_next')])
+    if methodDesc is None or 'response' not in methodDesc:
+      return None
+    responseSchema = methodDesc['response']
+    if '$ref' in responseSchema:
+      responseSchema = self._schema.get(responseSchema['$ref'])
+    hasNextPageToken = 'nextPageToken' in responseSchema.get('properties', {})
+    hasPageToken = 'pageToken' in methodDesc.get('parameters', {})
+    if hasNextPageToken and hasPageToken:
+      return createNextMethod(name)[1]
+    return None
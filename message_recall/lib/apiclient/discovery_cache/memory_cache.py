@@ -0,0 +1,67 @@
+# Copyright (C) 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process LRU cache for parsed discovery documents.
+
+Sits in front of the shared (memcache or file) caches so that building a
+service again in the same process neither fetches nor parses its discovery
+document.
+"""
+
+import collections
+import threading
+import time
+
+from apiclient.discovery_cache import base
+from apiclient.discovery_cache import DISCOVERY_DOC_MAX_AGE
+
+
+MAX_SIZE = 16
+
+
+class Cache(base.Cache):
+  """A thread-safe, size bounded cache expiring entries after max_age."""
+
+  def __init__(self, max_age, max_size=MAX_SIZE):
+    """Constructor.
+
+    Args:
+      max_age: int, the cache expiration time in seconds.
+      max_size: int, the most entries kept; least recently used go first.
+    """
+    self._max_age = max_age
+    self._max_size = max_size
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, url):
+    with self._lock:
+      entry = self._entries.pop(url, None)
+      if entry is None:
+        return None
+      content, expiry = entry
+      if time.time() >= expiry:
+        return None
+      self._entries[url] = entry
+      return content
+
+  def set(self, url, content):
+    with self._lock:
+      self._entries.pop(url, None)
+      self._entries[url] = (content, time.time() + self._max_age)
+      while len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
+
+cache = Cache(max_age=DISCOVERY_DOC_MAX_AGE)
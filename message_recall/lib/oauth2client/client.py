@@ -888,6 +888,10 @@ if HAS_CRYPTO:
   # missing then don't create the SignedJwtAssertionCredentials or the
   # verify_id_token() method.
 
+  # Parsing a private key is far slower than signing with it: keep the Signer
+  # of each (base64 encoded private key, password).
+  _SIGNER_CACHE = {}
+
   class SignedJwtAssertionCredentials(AssertionCredentials):
     """Credentials object used for OAuth 2.0 Signed JWT assertion grants.
 
@@ -959,6 +963,38 @@ if HAS_CRYPTO:
       retval.access_token = data['access_token']
       return retval
 
+    def create_delegated(self, sub):
+      """Create credentials that act as another user (subject).
+
+      The new credentials share the private key (and its parsed Signer) but
+      have no access token yet.
+
+      Args:
+        sub: string, email address of the user to impersonate.
+
+      Returns:
+        SignedJwtAssertionCredentials, the delegated credentials.
+      """
+      delegated = copy.copy(self)
+      delegated.kwargs = dict(self.kwargs, sub=sub)
+      delegated.access_token = None
+      delegated.token_expiry = None
+      delegated.id_token = None
+      delegated.token_response = None
+      delegated.invalid = False
+      delegated.store = None
+      return delegated
+
+    def _get_signer(self):
+      """Returns the Signer of the private key, parsing the key only once."""
+      cache_key = (self.private_key, self.private_key_password)
+      signer = _SIGNER_CACHE.get(cache_key)
+      if signer is None:
+        signer = crypt.Signer.from_string(base64.b64decode(self.private_key),
+                                          self.private_key_password)
+        _SIGNER_CACHE[cache_key] = signer
+      return signer
+
     def _generate_assertion(self):
       """Generate the assertion that will be used in the request."""
       now = long(time.time())
@@ -972,9 +1008,7 @@ if HAS_CRYPTO:
       payload.update(self.kwargs)
       logger.debug(str(payload))
 
-      private_key = base64.b64decode(self.private_key)
-      return crypt.make_signed_jwt(crypt.Signer.from_string(
-          private_key, self.private_key_password), payload)
+      return crypt.make_signed_jwt(self._get_signer(), payload)
 
   # Only used in verify_id_token(), which is always calling to the same URI
   # for the certs.
@@ -16,13 +16,22 @@
 
 The usage pattern for GmailInterface is:
   Connect()
-  if CheckIfMessageExists(msg_id):
-    DeleteMessage(msg_id)
+  if CheckIfMessageExists(msg_ids):
+    DeleteMessage(GetFoundMessageIds())
   Disconnect()
+
+GmailHelper leases connected GmailInterface sessions from a per-instance
+GmailInterfacePool so recalls for the same users within minutes reuse their
+authenticated IMAP sessions.
 """
 
+import email.parser
+import email.utils
 import imaplib
 import logging
+import re
+import socket
+import time
 
 from credentials_utils import GetUserAccessToken
 from log_utils import GetLogger
@@ -37,12 +46,27 @@ from models.domain_user import USER_DONE
 from models.domain_user import USER_IMAP_DISABLED
 from models.domain_user import USER_RECALLING
 from models.entity_state_updater import EntityStateUpdater
+from models.recall_task import SplitMessageCriteria
+from oauth2client.client import AccessTokenRefreshError
+from pool_utils import IdlePool
+from recall_errors import MessageRecallError
 from recall_errors import MessageRecallGmailError
 
 
 _IMAP_DISABLED_STRING = 'IMAP access is disabled for your domain.'
 _LOG = GetLogger('messagerecall.gmail', logging.INFO)
 _MAX_IMAP_CONNECTION_ATTEMPTS = 2
+# User state updates are buffered and written when the helper exits. These
+# states are also written as soon as they are reached.
+_STATE_CHECKPOINTS = [MESSAGE_PURGED]
+
+# imaplib does not know the MOVE extension (RFC 6851) used when advertised.
+imaplib.Commands.setdefault('MOVE', ('SELECTED',))
+
+# Idle authenticated sessions kept per backend instance.
+_SESSION_POOL_IDLE_TIMEOUT_S = 60 * 5
+_SESSION_POOL_MAX_AGE_S = 60 * 50  # Access tokens last about 1 hour.
+_SESSION_POOL_MAX_SIZE = 20
 
 
 class GmailHelper(object):
@@ -51,7 +75,8 @@ class GmailHelper(object):
   Implemented as a context manager to support 'with ...' semantics.
 
   Uses GmailInterface and updates user state in the data store to reflect the
-  success of the Gmail operations.
+  success of the Gmail operations.  State updates are buffered and written
+  on exit (and at _STATE_CHECKPOINTS) to save data store round trips.
   """
 
   def __init__(self, task_key_id, user_key_id, user_email, message_criteria):
@@ -59,41 +84,53 @@ class GmailHelper(object):
 
     Args:
       task_key_id: Int unique id of the parent task.
-      user_key_id: Int unique id of the user entity to update state.
+      user_key_id: String unique id of the user entity to update state.
       user_email: String reflecting the user email being accessed.
-      message_criteria: String criteria (message-id) to recall.
+      message_criteria: String criteria (message-ids) to recall.
     """
-    self._state_updater = EntityStateUpdater(task_key_id=task_key_id,
-                                             user_key_id=user_key_id)
+    self._state_updater = EntityStateUpdater(
+        task_key_id=task_key_id, user_key_id=user_key_id, buffer_states=True,
+        checkpoint_states=_STATE_CHECKPOINTS)
     self._state_updater.SetUserState(new_state=USER_RECALLING)
-    self._gmail = GmailInterface()
+    self._gmail = None
     self._user_email = user_email
-    self._message_criteria = message_criteria
+    self._message_ids = SplitMessageCriteria(message_criteria)
 
   def __enter__(self):
-    """Wraps GmailInterface.Connect() with state updates.
+    """Leases a connected GmailInterface from the pool with state updates.
 
     Returns:
       True if success else False.
     """
-    if self._gmail.Connect(self._user_email):
+    self._gmail = _GMAIL_INTERFACE_POOL.Lease(self._user_email)
+    if self._gmail.IsConnected():
       return self
 
+    _GMAIL_INTERFACE_POOL.Release(self._gmail, reusable=False)
     gmail_error_string = str(self.GetLastError())
     if _IMAP_DISABLED_STRING in gmail_error_string:
       new_state = USER_IMAP_DISABLED
     else:
       new_state = USER_CONNECT_FAILED
     self._state_updater.SetUserState(new_state=new_state)
+    self._state_updater.Flush()  # __exit__() is not called when this raises.
     raise MessageRecallGmailError('Connection Error: %s.' % gmail_error_string)
 
   def CheckIfMessageExists(self):
     """Wraps GmailInterface.CheckIfMessageExists() with state updates.
 
+    Records a message state for each message-id and an overall message state.
+
     Returns:
       True if the search found at least one matching message.
     """
-    result = self._gmail.CheckIfMessageExists(self._message_criteria)
+    result = self._gmail.CheckIfMessageExists(self._message_ids)
+    found_message_ids = self._gmail.GetFoundMessageIds()
+    self._state_updater.SetMessageIdStates(dict(
+        (message_id,
+         MESSAGE_FOUND if message_id in found_message_ids else
+         MESSAGE_NOT_FOUND)
+        for message_id in self._message_ids))
     new_state = MESSAGE_FOUND if result else MESSAGE_NOT_FOUND
     self._state_updater.SetMessageState(new_state=new_state)
     return result
@@ -101,16 +138,36 @@ class GmailHelper(object):
   def DeleteMessage(self):
     """Wraps GmailInterface.DeleteMessage() with state updates.
 
+    Records a message state for each message-id found and an overall message
+    state which reflects the least successful message-id.
+
     Returns:
-      True if message successfully purged and verified else False.
+      True if messages successfully purged and verified else False.
     """
-    new_state = MESSAGE_DELETE_FAILED
-    if self._gmail.DeleteMessage(self._message_criteria):
+    found_message_ids = list(self._gmail.GetFoundMessageIds())
+    message_id_states = dict((message_id, MESSAGE_DELETE_FAILED)
+                             for message_id in found_message_ids)
+    if self._gmail.DeleteMessage(found_message_ids):
+      purged_message_ids = list(self._gmail.GetPurgedMessageIds())
+      for message_id in purged_message_ids:
+        message_id_states[message_id] = MESSAGE_PURGED
+      self._state_updater.SetMessageIdStates(message_id_states)
       self._state_updater.SetMessageState(new_state=MESSAGE_PURGED)
-      if self._gmail.CheckIfMessageExists(self._message_criteria):
-        new_state = MESSAGE_VERIFY_FAILED
-      else:
-        new_state = MESSAGE_VERIFIED_PURGED
+      self._gmail.CheckIfPurgedMessagesExist(purged_message_ids)
+      unpurged_message_ids = self._gmail.GetFoundMessageIds()
+      for message_id in purged_message_ids:
+        if message_id in unpurged_message_ids:
+          message_id_states[message_id] = MESSAGE_VERIFY_FAILED
+        else:
+          message_id_states[message_id] = MESSAGE_VERIFIED_PURGED
+    self._state_updater.SetMessageIdStates(message_id_states)
+    message_states = set(message_id_states.values())
+    if MESSAGE_DELETE_FAILED in message_states:
+      new_state = MESSAGE_DELETE_FAILED
+    elif MESSAGE_VERIFY_FAILED in message_states:
+      new_state = MESSAGE_VERIFY_FAILED
+    else:
+      new_state = MESSAGE_VERIFIED_PURGED
     self._state_updater.SetMessageState(new_state=new_state)
     return new_state == MESSAGE_VERIFIED_PURGED
 
@@ -119,17 +176,22 @@ class GmailHelper(object):
     return self._gmail.GetLastError()
 
   def __exit__(self, exc_type, exc_value, exc_traceback):
-    """Wraps GmailInterface.Disconnect() with state updates.
+    """Returns the GmailInterface to the pool with state updates.
 
-    Supplies exception information in case Exception suppression is desired.
+    Sessions which saw an Exception are disconnected rather than reused.
+    After an Exception (which is re-raised) the progress so far is written
+    but the user is left in a non-terminal state so a retried task recalls
+    the user again.
 
     Args:
       exc_type: Type of Exception if an Exception to be raised.
       exc_value: Value of Exception if an Exception to be raised.
       exc_traceback: To be used in Exception processing.
     """
-    self._gmail.Disconnect()
-    self._state_updater.SetUserState(new_state=USER_DONE)
+    _GMAIL_INTERFACE_POOL.Release(self._gmail, reusable=exc_type is None)
+    if exc_type is None:
+      self._state_updater.SetUserState(new_state=USER_DONE)
+    self._state_updater.Flush()
 
 
 class GmailInterface(object):
@@ -139,35 +201,82 @@ class GmailInterface(object):
   """
 
   _AUTH_STRING = 'user=%s\1auth=Bearer %s\1\1'
+  _FETCH_GM_MSGID = 'X-GM-MSGID'
+  _FETCH_GM_MSGID_REGEX = re.compile(r'X-GM-MSGID (\d+)')
+  _FETCH_HEADER_FIELDS = 'BODY.PEEK[HEADER.FIELDS (%s)]'
+  _FETCH_UID_REGEX = re.compile(r'UID (\d+)')
+  # Gmail IMAP extensions (X-GM-RAW, X-GM-MSGID) advertised by this capability.
+  _GMAIL_EXTENSIONS_CAPABILITY = 'X-GM-EXT-1'
   # Modify this variable to the appropriate 'Trash' label. In the U.S., it
   # should be 'Trash'. In the U.K. it should be 'Bin'.
   _LOCALIZED_TRASH_LABEL = 'Trash'
+  _MESSAGE_ID_HEADER_FIELDS = ['MESSAGE-ID']
+  _MESSAGE_ID_HEADER_REGEX = re.compile(r'^Message-ID:\s*(\S+)',
+                                       re.IGNORECASE | re.MULTILINE)
+  _RECIPIENT_HEADER_FIELDS = ['TO', 'CC', 'BCC', 'DELIVERED-TO']
+  _SEARCH_GM_MSGID = '(X-GM-MSGID %s)'
+  _SEARCH_GM_RAW_MESSAGE_ID = 'rfc822msgid:%s'
   _SEARCH_MESSAGE_ID = '(HEADER Message-ID <%s>)'
   _SERVER_ADDRESS = 'imap.gmail.com'
   _SERVER_PORT = 993
   _DEBUG_LEVEL = 0  # 0-5: 0=default, 5=verbose.
 
   def __init__(self):
+    self._connect_time = None
+    self._found_gm_msgids = {}
     self._found_indices = {}
+    self._found_message_ids = set()
     self._gmail_labels = ['[Gmail]/All Mail', '[Gmail]/Spam']
     self._imap_query = imaplib.IMAP4_SSL(self._SERVER_ADDRESS,
                                          self._SERVER_PORT)
     self._imap_query.debug = self._DEBUG_LEVEL
     self._label_selected = None
     self._last_error = None
+    self._purged_message_ids = set()
     self._user_email = None
 
+  def _MoveMessages(self, message_indices, gmail_label):
+    """Move messages from the selected label as one UID set.
+
+    Uses MOVE when the server advertises it otherwise COPY then one EXPUNGE.
+
+    Args:
+      message_indices: List of String message uids in the selected label.
+      gmail_label: String label/tag of the Gmail folder to move to.
+    """
+    message_set = ','.join(message_indices)
+    if 'MOVE' in self._imap_query.capabilities:
+      self._imap_query.uid('MOVE', message_set, gmail_label)
+    else:
+      self._imap_query.uid('COPY', message_set, gmail_label)
+      self._imap_query.expunge()
+
+  def _RefreshCapabilities(self):
+    """Re-read server capabilities which may grow once authenticated."""
+    unused_type, data = self._imap_query.capability()
+    self._imap_query.capabilities = tuple(data[-1].upper().split())
+
   def _SelectLabel(self, gmail_label):
     """Selects a folder/label for work. This is active state in the connection.
 
     Args:
       gmail_label: String label/tag of the Gmail folder to activate.
     """
+    if gmail_label == self._label_selected:
+      return
     # Have observed the following error from select():
     # 'socket error: EOF'
     self._imap_query.select(gmail_label)
     self._label_selected = gmail_label
 
+  def _UsesGmailExtensions(self):
+    """Check if the server offers Gmail's IMAP search extensions.
+
+    Returns:
+      True if X-GM-RAW and X-GM-MSGID may be used else False.
+    """
+    return self._GMAIL_EXTENSIONS_CAPABILITY in self._imap_query.capabilities
+
   def _WasMessageFound(self):
     """Determines if any messages were found by looking for found indices.
 
@@ -213,12 +322,158 @@ class GmailInterface(object):
 
     if self._user_email:
       _LOG.debug('[%s] Connected to imap.', self._user_email)
+      self._RefreshCapabilities()
+      self._connect_time = time.time()
       self._last_error = None
       return True
     return False
 
-  def CheckIfMessageExists(self, message_criteria):
-    """Search for a message based on message_criteria.
+  def _BuildSearchQuery(self, search_key, search_values):
+    """Build one IMAP search matching any of the search values.
+
+    IMAP OR takes exactly 2 search keys so n keys need n-1 prefix ORs:
+    '(OR OR key1 key2 key3)'.  The parentheses keep imaplib from quoting the
+    query as a single string.
+
+    Args:
+      search_key: String parenthesized search key with one %s for a value.
+      search_values: List of String values to search for.
+
+    Returns:
+      String IMAP search query.
+    """
+    return '(%s%s)' % ('OR ' * (len(search_values) - 1), ' '.join(
+        search_key % search_value for search_value in search_values))
+
+  def _FetchFoundMessages(self, found_indices, header_fields=None):
+    """Fetch the Gmail message ids (and some headers) of matches.
+
+    Args:
+      found_indices: List of String message uids in the selected label.
+      header_fields: List of String header names to also fetch or None.
+
+    Returns:
+      List of (String uid, String X-GM-MSGID or None,
+      String headers or None) tuples.
+    """
+    fetch_items = ['UID']
+    if self._UsesGmailExtensions():
+      fetch_items.append(self._FETCH_GM_MSGID)
+    if header_fields:
+      fetch_items.append(self._FETCH_HEADER_FIELDS % ' '.join(header_fields))
+    unused_type, data = self._imap_query.uid(
+        'FETCH', ','.join(found_indices), '(%s)' % ' '.join(fetch_items))
+    found_messages = []
+    for fetch_item in data:
+      if isinstance(fetch_item, tuple):
+        fetch_response, header = fetch_item
+      elif isinstance(fetch_item, str):
+        fetch_response, header = fetch_item, None
+      else:
+        continue
+      uid_match = self._FETCH_UID_REGEX.search(fetch_response)
+      if not uid_match:
+        continue
+      gm_msgid_match = self._FETCH_GM_MSGID_REGEX.search(fetch_response)
+      found_messages.append(
+          (uid_match.group(1), gm_msgid_match and gm_msgid_match.group(1),
+           header))
+    return found_messages
+
+  def _MatchMessageIdHeader(self, header, message_ids):
+    """Find which of the message-ids a fetched Message-ID header has.
+
+    Message-ids are compared whole (without their <> and ignoring case): one
+    message-id may be part of another.
+
+    Args:
+      header: String fetched Message-ID header or None.
+      message_ids: List of String message-ids.
+
+    Returns:
+      String message-id matched or None.
+    """
+    header_match = self._MESSAGE_ID_HEADER_REGEX.search(header or '')
+    if not header_match:
+      return None
+    header_message_id = header_match.group(1).strip('<>').lower()
+    for message_id in message_ids:
+      if message_id.strip('<>').lower() == header_message_id:
+        return message_id
+    return None
+
+  def _SearchMessageIds(self, message_ids):
+    """Search the selected label for messages matching any of the message-ids.
+
+    When the server offers Gmail's extensions, X-GM-RAW rfc822msgid: searches
+    use Gmail's own index rather than scanning headers and the X-GM-MSGID of
+    each match is recorded so later passes can address it directly.
+
+    When searching for several message-ids, the Message-ID headers of the
+    matches are fetched (one FETCH for all matches) to learn which message-id
+    each match has.
+
+    Args:
+      message_ids: List of String message-ids.
+
+    Returns:
+      Dictionary of String message uid to the String message-id it matched.
+    """
+    if self._UsesGmailExtensions():
+      # in:anywhere stops Gmail leaving out Spam and Trash; matches are still
+      # limited to the selected label.
+      search_criteria = ('X-GM-RAW', '"in:anywhere {%s}"' % ' '.join(
+          self._SEARCH_GM_RAW_MESSAGE_ID % message_id
+          for message_id in message_ids))
+    else:
+      search_criteria = (
+          self._BuildSearchQuery(self._SEARCH_MESSAGE_ID, message_ids),)
+    unused_type, data = self._imap_query.uid('SEARCH', None, *search_criteria)
+    found_indices = data[0].split()
+    fetch_header = len(message_ids) > 1
+    if not found_indices or not (fetch_header or self._UsesGmailExtensions()):
+      return dict((found_index, message_ids[0])
+                  for found_index in found_indices)
+    found_message_ids = {}
+    for found_index, gm_msgid, header in self._FetchFoundMessages(
+        found_indices,
+        self._MESSAGE_ID_HEADER_FIELDS if fetch_header else None):
+      if fetch_header:
+        message_id = self._MatchMessageIdHeader(header, message_ids)
+      else:
+        message_id = message_ids[0]
+      if not message_id:
+        continue
+      found_message_ids[found_index] = message_id
+      if gm_msgid:
+        self._found_gm_msgids[gm_msgid] = message_id
+    return found_message_ids
+
+  def _SearchGmMessageIds(self, gm_msgids):
+    """Search the selected label for messages by their X-GM-MSGID.
+
+    Args:
+      gm_msgids: Dictionary of String X-GM-MSGID to the String message-id.
+
+    Returns:
+      Dictionary of String message uid to the String message-id it matched.
+    """
+    unused_type, data = self._imap_query.uid(
+        'SEARCH', None,
+        self._BuildSearchQuery(self._SEARCH_GM_MSGID, gm_msgids.keys()))
+    found_indices = data[0].split()
+    message_ids = set(gm_msgids.values())
+    if not found_indices or len(message_ids) == 1:
+      return dict((found_index, message_id)
+                  for found_index in found_indices
+                  for message_id in message_ids)
+    return dict((found_index, gm_msgids[gm_msgid])
+                for found_index, gm_msgid, unused_header
+                in self._FetchFoundMessages(found_indices)
+                if gm_msgid in gm_msgids)
+
+  def CheckIfMessageExists(self, message_ids):
+    """Search for messages having any of the message_ids.
 
     By default, we want to search for the message in the All Mail folder since
     all messages live there. IMAP does not allow us to search for a message in
@@ -226,75 +481,320 @@ class GmailInterface(object):
     We also search for the message in the Spam label since spam messages do not
     show up in All Mail.
 
+    All message-ids are searched together with a single search per label.
+    GetFoundMessageIds() reports which message-ids were found.
+
     Args:
-      message_criteria: String criteria for a search (e.g. message-id).
+      message_ids: List of String message-ids.
 
     Returns:
       True if the search found at least one matching message.
     """
-    for gmail_label in self._gmail_labels:
+    self._found_gm_msgids = {}
+    return self._SearchLabels(self._SearchMessageIds, message_ids)
+
+  def GetMessageRecipients(self, message_ids):
+    """Read the recipients of messages from their copies in All Mail.
+
+    The sender's copy of a message also lists its Bcc recipients.
+
+    Args:
+      message_ids: List of String message-ids.
+
+    Returns:
+      Set of lowercase String recipient email addresses or None if a copy of
+      each message was not found.
+    """
+    self._SelectLabel(self._gmail_labels[0])
+    found_message_ids = self._SearchMessageIds(message_ids)
+    if set(found_message_ids.values()) != set(message_ids):
+      return None
+    recipient_emails = set()
+    header_parser = email.parser.HeaderParser()
+    for unused_uid, unused_gm_msgid, headers in self._FetchFoundMessages(
+        found_message_ids.keys(), self._RECIPIENT_HEADER_FIELDS):
+      message = header_parser.parsestr(headers or '')
+      for unused_name, address in email.utils.getaddresses(
+          [value for header_field in self._RECIPIENT_HEADER_FIELDS
+           for value in message.get_all(header_field, [])]):
+        if '@' in address:
+          recipient_emails.add(address.lower())
+    return recipient_emails
+
+  def CheckIfPurgedMessagesExist(self, message_ids):
+    """Search again for messages purged by DeleteMessage().
+
+    With Gmail's extensions the messages found earlier are looked up by their
+    X-GM-MSGID, otherwise this is the same as CheckIfMessageExists().
+
+    Args:
+      message_ids: List of String message-ids that were purged.
+
+    Returns:
+      True if the search found at least one matching message.
+    """
+    gm_msgids = dict((gm_msgid, message_id) for gm_msgid, message_id
+                     in self._found_gm_msgids.iteritems()
+                     if message_id in message_ids)
+    if not gm_msgids or set(gm_msgids.values()) != set(message_ids):
+      return self.CheckIfMessageExists(message_ids)
+    return self._SearchLabels(self._SearchGmMessageIds, gm_msgids)
+
+  def _SearchLabels(self, search_function, search_values):
+    """Run a search in each searched label recording what was found.
+
+    Labels are searched starting with one that is already selected.
+
+    Args:
+      search_function: Function(search_values) returning a dictionary of
+                       String message uid to String message-id.
+      search_values: Values to pass to search_function.
+
+    Returns:
+      True if the search found at least one matching message.
+    """
+    self._found_indices = {}
+    self._found_message_ids = set()
+    for gmail_label in self._OrderLabels(self._gmail_labels):
       _LOG.debug('[%s] Searching label %s', self._user_email, gmail_label)
       self._found_indices[gmail_label] = []
       self._SelectLabel(gmail_label)
-      search_query = self._SEARCH_MESSAGE_ID % message_criteria
-      unused_type, data = self._imap_query.uid('SEARCH', None, search_query)
-      found_indices = data[0].split()
-      found_count = len(found_indices)
+      found_message_ids = search_function(search_values)
+      found_count = len(found_message_ids)
       if found_count > 0:
-        if found_count > 1:
+        if found_count > len(set(found_message_ids.values())):
           _LOG.warning('[%s] Found %s matches in %s.', self._user_email,
                        found_count, gmail_label)
-        self._found_indices[gmail_label] = found_indices
+        self._found_indices[gmail_label] = found_message_ids.keys()
+        self._found_message_ids.update(found_message_ids.values())
         _LOG.debug('[%s] Found messages in %s: %s.', self._user_email,
-                   gmail_label, found_indices)
+                   gmail_label, found_message_ids)
     return self._WasMessageFound()
 
-  def DeleteMessage(self, message_criteria):
-    """Find and delete the message described by message_id.
+  def _OrderLabels(self, gmail_labels):
+    """Order labels so an already selected label is used first.
+
+    Args:
+      gmail_labels: List of String labels/tags of Gmail folders.
+
+    Returns:
+      List of the same labels with the selected label (if any) first.
+    """
+    return sorted(gmail_labels, key=lambda x: x != self._label_selected)
+
+  def DeleteMessage(self, message_ids):
+    """Delete the messages found by CheckIfMessageExists().
+
+    GetPurgedMessageIds() reports which message-ids were purged.
 
     Args:
-      message_criteria: String criteria for a search (e.g. message-id).
+      message_ids: List of String message-ids that were found.
 
     Returns:
-      True if message successfully purged else False.
+      True if any message successfully purged else False.
     """
-    _LOG.debug('[%s] Deleting messsage: %s.', self._user_email,
-               message_criteria)
-    for gmail_label, found_indices in self._found_indices.iteritems():
+    _LOG.debug('[%s] Deleting messsages: %s.', self._user_email, message_ids)
+    trash_label = '[Gmail]/' + self._LOCALIZED_TRASH_LABEL
+    for gmail_label in self._OrderLabels(self._found_indices.keys()):
+      found_indices = self._found_indices[gmail_label]
       if not found_indices:
         continue
       self._SelectLabel(gmail_label)
-      for message_index in found_indices:
-        self._imap_query.uid('COPY', message_index,
-                             '[Gmail]/' + self._LOCALIZED_TRASH_LABEL)
-        self._imap_query.expunge()
+      self._MoveMessages(found_indices, trash_label)
       _LOG.debug('[%s] %s messages purged from %s.', self._user_email,
                  found_indices, gmail_label)
 
-    gmail_label = '[Gmail]/' + self._LOCALIZED_TRASH_LABEL
-    self._SelectLabel(gmail_label)
-    messages_found = 0
-    search_query = self._SEARCH_MESSAGE_ID % message_criteria
-    unused_type, data = self._imap_query.uid('SEARCH', None, search_query)
-    for found_index in data[0].split():
-      messages_found += 1
-      self._imap_query.uid('STORE', found_index, '+FLAGS', '\\Deleted')
+    self._SelectLabel(trash_label)
+    found_message_ids = self._SearchMessageIds(message_ids)
+    if found_message_ids:
+      self._imap_query.uid('STORE', ','.join(found_message_ids), '+FLAGS',
+                           '\\Deleted')
       self._imap_query.expunge()
-      _LOG.debug('[%s] Message has been purged from Gmail', self._user_email)
+      _LOG.debug('[%s] Messages have been purged from Gmail',
+                 self._user_email)
     _LOG.debug('[%s] Total message(s) purged: %s', self._user_email,
-               messages_found)
-    return messages_found > 0
+               len(found_message_ids))
+    self._purged_message_ids = set(found_message_ids.values())
+    return bool(found_message_ids)
+
+  def CloseLabel(self):
+    """Close the selected folder/label leaving the session authenticated."""
+    if self._label_selected:
+      self._imap_query.close()  # Assumes select() was run.
+      self._label_selected = None
 
   def Disconnect(self):
-    """Close connections to mailbox and mail server."""
+    """Close connections to mailbox and mail server.
+
+    The socket of a session which never authenticated is closed too.
+    """
     if self._user_email:
-      if self._label_selected:
-        self._imap_query.close()  # Assumes select() was run.
-        self._label_selected = None
+      self.CloseLabel()
       self._imap_query.logout()
       _LOG.debug('[%s] Disconnected from imap.', self._user_email)
       self._user_email = None
+    else:
+      self._imap_query.shutdown()
+
+  def GetFoundMessageIds(self):
+    """Helper to retrieve the message-ids found by CheckIfMessageExists()."""
+    return self._found_message_ids
+
+  def GetPurgedMessageIds(self):
+    """Helper to retrieve the message-ids purged by DeleteMessage()."""
+    return self._purged_message_ids
+
+  def GetConnectTime(self):
+    """Helper to retrieve the time (seconds since epoch) of Connect()."""
+    return self._connect_time
+
+  def GetUserEmail(self):
+    """Helper to retrieve the user email of a connected session."""
+    return self._user_email
+
+  def IsConnected(self):
+    """Helper to check if Connect() succeeded (and no Disconnect())."""
+    return bool(self._user_email)
+
+  def IsHealthy(self):
+    """Check that a connected session still responds to the mail server.
+
+    Returns:
+      True if the session is connected and answered a NOOP else False.
+    """
+    if not self.IsConnected():
+      return False
+    try:
+      result, unused_data = self._imap_query.noop()
+    except (imaplib.IMAP4.error, socket.error) as e:
+      _LOG.debug('[%s] Pooled imap session unhealthy: %s.', self._user_email,
+                 e)
+      return False
+    return result == 'OK'
 
   def GetLastError(self):
     """Helper to retrieve last error info if any."""
     return self._last_error
+
+
+class GmailInterfacePool(IdlePool):
+  """Per-instance pool of authenticated GmailInterface sessions.
+
+  Idle sessions are keyed by user email.  Sessions idle longer than
+  idle_timeout_s, older than max_age_s or failing a health check are
+  disconnected instead of reused.  When more than max_size sessions are idle,
+  the least recently used are disconnected.
+  """
+
+  def __init__(self, max_size, idle_timeout_s, max_age_s):
+    """Initialize an empty pool.
+
+    Args:
+      max_size: Int maximum number of idle sessions kept.
+      idle_timeout_s: Int seconds an idle session may be kept.
+      max_age_s: Int seconds after Connect() a session may be reused.
+    """
+    super(GmailInterfacePool, self).__init__(
+        max_keys=max_size, max_idle_per_key=1, idle_timeout_s=idle_timeout_s)
+    self._max_age_s = max_age_s
+
+  def _Close(self, gmail):
+    """Disconnect a session whose connection may already be broken.
+
+    Args:
+      gmail: GmailInterface session to disconnect.
+    """
+    try:
+      gmail.Disconnect()
+    except (imaplib.IMAP4.error, socket.error) as e:
+      _LOG.debug('[%s] Error disconnecting pooled imap session: %s.',
+                 gmail.GetUserEmail(), e)
+
+  def _IsReusable(self, gmail):
+    """Check if an idle session is young and healthy enough to reuse.
+
+    Args:
+      gmail: GmailInterface idle session.
+
+    Returns:
+      True if the session may be leased again else False.
+    """
+    return (time.time() - gmail.GetConnectTime() < self._max_age_s and
+            gmail.IsHealthy())
+
+  def Lease(self, user_email):
+    """Lease a connected session for a user, reusing an idle one if possible.
+
+    Args:
+      user_email: String reflecting the user email being accessed.
+
+    Returns:
+      GmailInterface session. If IsConnected() is False, the connection
+      failed and GetLastError() describes the problem.
+    """
+    gmail = self.LeaseIdle(user_email)
+    if gmail:
+      _LOG.debug('[%s] Reusing pooled imap session.', user_email)
+      return gmail
+    gmail = GmailInterface()
+    try:
+      gmail.Connect(user_email)
+    except Exception:
+      self._Close(gmail)
+      raise
+    return gmail
+
+  def Release(self, gmail, reusable=True):
+    """Return a leased session to the pool.
+
+    Args:
+      gmail: GmailInterface session from Lease().
+      reusable: Boolean; False to disconnect rather than keep the session.
+    """
+    if not (reusable and gmail.IsConnected()):
+      self._Close(gmail)
+      return
+    try:
+      gmail.CloseLabel()
+    except (imaplib.IMAP4.error, socket.error):
+      self._Close(gmail)
+      return
+    self.ReleaseIdle(gmail.GetUserEmail(), gmail)
+
+
+_GMAIL_INTERFACE_POOL = GmailInterfacePool(
+    max_size=_SESSION_POOL_MAX_SIZE,
+    idle_timeout_s=_SESSION_POOL_IDLE_TIMEOUT_S,
+    max_age_s=_SESSION_POOL_MAX_AGE_S)
+
+
+def GetMessageRecipients(user_email, message_criteria):
+  """Read the recipients of messages from one user's (the sender's) copy.
+
+  Args:
+    user_email: String email address of the user holding the messages.
+    message_criteria: String criteria (message-ids) to recall.
+
+  Returns:
+    Set of lowercase String recipient email addresses or None if the
+    messages or their recipients could not be read (or the sender's mailbox
+    could not be reached).
+  """
+  gmail = None
+  try:
+    gmail = _GMAIL_INTERFACE_POOL.Lease(user_email)
+    if not gmail.IsConnected():
+      _LOG.warning('[%s] Cannot read recipients: %s.', user_email,
+                   gmail.GetLastError())
+      _GMAIL_INTERFACE_POOL.Release(gmail, reusable=False)
+      return None
+    recipient_emails = gmail.GetMessageRecipients(
+        SplitMessageCriteria(message_criteria))
+  except (AccessTokenRefreshError, imaplib.IMAP4.error, MessageRecallError,
+          socket.error) as e:
+    _LOG.warning('[%s] Error reading recipients: %s.', user_email, e)
+    if gmail:
+      _GMAIL_INTERFACE_POOL.Release(gmail, reusable=False)
+    return None
+  _GMAIL_INTERFACE_POOL.Release(gmail)
+  return recipient_emails
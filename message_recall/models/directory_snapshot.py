@@ -0,0 +1,101 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Database models to share recent domain user lists across recall tasks."""
+
+import datetime
+
+import log_utils
+
+from google.appengine.ext import ndb
+
+
+_LOG = log_utils.GetLogger('messagerecall.models.directory_snapshot')
+# Users added to the domain after a snapshot are missed until it expires.
+_SNAPSHOT_MAX_AGE = datetime.timedelta(minutes=30)
+# Entities are limited to 1MB: larger prefixes are not kept.
+_SNAPSHOT_MAX_USER_COUNT = 20000
+
+
+class DirectorySnapshotModel(ndb.Model):
+  """Model to keep the users of a domain with one email prefix.
+
+  Each email prefix (user retrieval task) has its own snapshot which is
+  refreshed independently when it expires.  Users are kept as a compressed
+  JSON list of [email, suspended] pairs.
+  """
+
+  domain = ndb.StringProperty(required=True, indexed=False)
+  email_prefix = ndb.StringProperty(required=True, indexed=False)
+  user_tuples = ndb.JsonProperty(compressed=True)
+  snapshot_datetime = ndb.DateTimeProperty(required=True, auto_now=True,
+                                           indexed=False)
+
+  @classmethod
+  def _MakeSnapshotKey(cls, user_domain, email_prefix):
+    """Helper to derive the key of a prefix snapshot."""
+    return ndb.Key(cls, '%s_%s' % (user_domain, email_prefix))
+
+  @classmethod
+  def GetFreshUserTuples(cls, user_domain, email_prefix):
+    """Retrieve the users with a prefix from a fresh snapshot if possible.
+
+    A fresh snapshot of the prefix or of any shorter prefix (e.g. 's' for
+    'sa') is used.
+
+    Args:
+      user_domain: String domain of the users.
+      email_prefix: String with the first n characters of an email address
+                    (or the full username if it ends with '@').
+
+    Returns:
+      List of tuples (1 for each user) with a String email address and the
+      suspended status or None if no fresh snapshot covers the prefix.
+    """
+    oldest_datetime = datetime.datetime.utcnow() - _SNAPSHOT_MAX_AGE
+    snapshots = ndb.get_multi([
+        cls._MakeSnapshotKey(user_domain, email_prefix[:prefix_length])
+        for prefix_length in xrange(len(email_prefix), 0, -1)])
+    for snapshot in snapshots:
+      if snapshot and snapshot.snapshot_datetime >= oldest_datetime:
+        break
+    else:
+      return None
+    if email_prefix.endswith('@'):
+      exact_email = email_prefix + user_domain
+      return [(user_email, is_suspended)
+              for user_email, is_suspended in snapshot.user_tuples
+              if user_email == exact_email]
+    return [(user_email, is_suspended)
+            for user_email, is_suspended in snapshot.user_tuples
+            if user_email.startswith(email_prefix)]
+
+  @classmethod
+  def SetUserTuples(cls, user_domain, email_prefix, user_tuples):
+    """Record a fresh snapshot of the users with a prefix.
+
+    Args:
+      user_domain: String domain of the users.
+      email_prefix: String with the first n characters of an email address
+                    (or the full username if it ends with '@').
+      user_tuples: List of tuples (1 for each user) with a String email
+                   address and the suspended status.
+    """
+    if len(user_tuples) > _SNAPSHOT_MAX_USER_COUNT:
+      _LOG.debug('Domain %s prefix %s has too many users (%s) to snapshot.',
+                 user_domain, email_prefix, len(user_tuples))
+      return
+    cls(key=cls._MakeSnapshotKey(user_domain, email_prefix),
+        domain=user_domain, email_prefix=email_prefix,
+        user_tuples=user_tuples).put()
@@ -14,13 +14,19 @@
 
 """Database models for candidate domain users to check for message presence."""
 
+import collections
+
 import log_utils
+from models import sharded_counter
 
 from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 
 _LOG = log_utils.GetLogger('messagerecall.models.domain_user')
+# New users are written in concurrent batches to keep each rpc small.
+_PUT_MULTI_BATCH_SIZE = 100
+_TRANSACTIONAL_RETRIES = 8
 _USER_ROWS_FETCH_PAGE = 10
 
 USER_STARTED = 'Started'
@@ -50,6 +56,78 @@ MESSAGE_STATES = [MESSAGE_UNKNOWN, MESSAGE_FOUND, MESSAGE_NOT_FOUND,
                   MESSAGE_PURGED, MESSAGE_VERIFIED_PURGED,
                   MESSAGE_DELETE_FAILED, MESSAGE_VERIFY_FAILED]
 
+_MESSAGE_STATE_COUNTER_TAG = 'message_state'
+_USER_STATE_COUNTER_TAG = 'user_state'
+_USERS_ADDED_COUNTER_TAG = 'users_added'
+_USERS_TERMINAL_COUNTER_TAG = 'users_terminal'
+
+
+def MakeUsersAddedCounterName(task_key_id):
+  """Wrapper to consistently create counter for users added to a task.
+
+  Args:
+    task_key_id: Int unique id of the task record.
+
+  Returns:
+    String to be used as a sharded Counter name.
+  """
+  return '%s_%s' % (task_key_id, _USERS_ADDED_COUNTER_TAG)
+
+
+def MakeUsersTerminalCounterName(task_key_id):
+  """Wrapper to consistently create counter for users in a terminal state.
+
+  Args:
+    task_key_id: Int unique id of the task record.
+
+  Returns:
+    String to be used as a sharded Counter name.
+  """
+  return '%s_%s' % (task_key_id, _USERS_TERMINAL_COUNTER_TAG)
+
+
+def _MakeStateCounterName(task_key_id, tag, state):
+  """Helper to create the sharded Counter name of one histogram bucket.
+
+  Args:
+    task_key_id: Int unique id of the task record.
+    tag: String tag of the state field (user or message state).
+    state: String state value counted.
+
+  Returns:
+    String to be used as a sharded Counter name.
+  """
+  return '%s_%s_%s' % (task_key_id, tag, state)
+
+
+def _MakeStateCounterDeltas(task_key_id, user_state_deltas,
+                            message_state_deltas):
+  """Helper to name the per-task state histogram counters to increment.
+
+  Args:
+    task_key_id: Int unique id of the task record.
+    user_state_deltas: Dictionary of String user state to Integer delta.
+    message_state_deltas: Dictionary of String message state to Integer
+                          delta.
+
+  Returns:
+    Dictionary of String counter name to Integer delta.
+  """
+  counter_deltas = {}
+  for tag, state_deltas in ((_USER_STATE_COUNTER_TAG, user_state_deltas),
+                            (_MESSAGE_STATE_COUNTER_TAG,
+                             message_state_deltas)):
+    for state, delta in state_deltas.iteritems():
+      counter_deltas[_MakeStateCounterName(task_key_id, tag, state)] = delta
+  return counter_deltas
+
+
+class MessageResultModel(ndb.Model):
+  """Model to track the message state of one message-id for one user."""
+
+  message_id = ndb.StringProperty(required=True)
+  message_state = ndb.StringProperty(required=True, choices=MESSAGE_STATES)
+
 
 class DomainUserToCheckModel(ndb.Model):
   """Model to track work against individual users in recalling messages.
@@ -69,6 +147,39 @@ class DomainUserToCheckModel(ndb.Model):
   message_state = ndb.StringProperty(required=True, default=MESSAGE_UNKNOWN,
                                      choices=MESSAGE_STATES)
   is_aborted = ndb.BooleanProperty(required=True, default=True)
+  # message_state summarizes these per message-id results.
+  message_results = ndb.LocalStructuredProperty(MessageResultModel,
+                                                repeated=True)
+
+  @classmethod
+  def CreateUserForTask(cls, task_key_id, user_email):
+    """Create (but do not put) a user entity with a deterministic key.
+
+    The key is derived from the task and user email so each user appears at
+    most once per task without needing a query to check for it.
+
+    Args:
+      task_key_id: Int unique id of the task record.
+      user_email: String email address of the user to check.
+
+    Returns:
+      The new DomainUserToCheckModel entity.
+    """
+    return cls(id=cls.MakeUserKeyId(task_key_id, user_email),
+               recall_task_id=task_key_id, user_email=user_email)
+
+  @classmethod
+  def MakeUserKeyId(cls, task_key_id, user_email):
+    """Build the deterministic unique id of a user entity for a task.
+
+    Args:
+      task_key_id: Int unique id of the task record.
+      user_email: String email address of the user.
+
+    Returns:
+      String unique id of the user entity.
+    """
+    return '%s_%s' % (task_key_id, user_email)
 
   @classmethod
   def _GetUserByKey(cls, user_key_id):
@@ -90,7 +201,8 @@ class DomainUserToCheckModel(ndb.Model):
     return user
 
   @classmethod
-  def FetchOnePageOfActiveUsersForTask(cls, task_key_id, cursor):
+  def FetchOnePageOfActiveUsersForTask(cls, task_key_id, cursor,
+                                       page_size=_USER_ROWS_FETCH_PAGE):
     """Utility to query and fetch all active users.
 
     Used to retrieve the entire list of (not suspended) domain users to process.
@@ -98,6 +210,7 @@ class DomainUserToCheckModel(ndb.Model):
     Args:
       task_key_id: Int unique id of the task record.
       cursor: Cursor from previous fetch_page() calls.
+      page_size: Int maximum number of users to fetch in the page.
 
     Returns:
       Iterable of one page of DomainUserToCheckModel users.
@@ -105,7 +218,7 @@ class DomainUserToCheckModel(ndb.Model):
     return cls.GetQueryForAllTaskUsers(
         task_key_id=task_key_id,
         user_state_filters=ACTIVE_USER_STATES).fetch_page(
-            _USER_ROWS_FETCH_PAGE, start_cursor=cursor)
+            page_size, start_cursor=cursor)
 
   @classmethod
   def FetchOneUIPageOfUsersForTask(cls, task_key_urlsafe, urlsafe_cursor,
@@ -179,18 +292,60 @@ class DomainUserToCheckModel(ndb.Model):
         message_state_filters=message_state_filters).count(keys_only=True)
 
   @classmethod
-  def IsUserEmailEntityInTask(cls, task_key_id, user_email):
-    """Checks if a user entity already exists in this task.
+  def GetStateCountsForTask(cls, task_key_id):
+    """Read the per-task user and message state histograms.
+
+    The histograms are maintained by counters as users are added and change
+    state so reading them does not require any queries.  Tasks recalled
+    before the histograms existed have none: their users are counted with
+    queries instead.
 
     Args:
       task_key_id: Int unique id of the task record.
-      user_email: String email address of a user to find.
 
     Returns:
-      Bool; True if the user already exists else False.
+      Tuple of 2 dictionaries: user_state to Integer count of users and
+      message_state to Integer count of users.
+    """
+    user_state_names = dict(
+        (state, _MakeStateCounterName(task_key_id, _USER_STATE_COUNTER_TAG,
+                                      state))
+        for state in USER_STATES)
+    message_state_names = dict(
+        (state, _MakeStateCounterName(task_key_id, _MESSAGE_STATE_COUNTER_TAG,
+                                      state))
+        for state in MESSAGE_STATES)
+    counts = sharded_counter.GetCounterCounts(
+        user_state_names.values() + message_state_names.values())
+    if not any(counts[name] for name in user_state_names.itervalues()):
+      return (dict((state, cls.GetUserCountForTask(
+                        task_key_id=task_key_id, user_state_filters=[state]))
+                   for state in USER_STATES),
+              dict((state, cls.GetUserCountForTask(
+                        task_key_id=task_key_id,
+                        message_state_filters=[state]))
+                   for state in MESSAGE_STATES))
+    return (dict((state, counts[name])
+                 for state, name in user_state_names.iteritems()),
+            dict((state, counts[name])
+                 for state, name in message_state_names.iteritems()))
+
+  @classmethod
+  def GetUnfinishedUserKeyIds(cls, user_key_ids):
+    """Find the users that have not yet reached a terminal user state.
+
+    Uses a single batch get for the whole list of users.
+
+    Args:
+      user_key_ids: List of (serializable) unique ids of users.
+
+    Returns:
+      Set of the user key ids whose entities exist and are not terminal.
     """
-    return cls.query(cls.recall_task_id == task_key_id,
-                     cls.user_email == user_email).count(keys_only=True) > 0
+    users = ndb.get_multi([ndb.Key(cls, user_key_id)
+                           for user_key_id in user_key_ids])
+    return set(user.key.id() for user in users
+               if user and user.user_state not in TERMINAL_USER_STATES)
 
   @classmethod
   def GetUserCountForTaskWithTerminalUserStates(cls, task_key_id):
@@ -207,6 +362,86 @@ class DomainUserToCheckModel(ndb.Model):
         task_key_id=task_key_id,
         user_state_filters=TERMINAL_USER_STATES).count(keys_only=True)
 
+  @classmethod
+  def GetCountedUsersForTask(cls, task_key_id, skip_cache=False):
+    """Read the counters of users added to a task and of finished users.
+
+    Args:
+      task_key_id: Int unique id of the task record.
+      skip_cache: Boolean; True to sum the counter shards instead of using
+                  the memcache counter values.
+
+    Returns:
+      Tuple of 2 Integers: #users added and #users in a terminal state.
+    """
+    return (sharded_counter.GetCounterCount(
+                name=MakeUsersAddedCounterName(task_key_id),
+                skip_cache=skip_cache),
+            sharded_counter.GetCounterCount(
+                name=MakeUsersTerminalCounterName(task_key_id),
+                skip_cache=skip_cache))
+
+  @classmethod
+  def RecountUsersForTask(cls, task_key_id):
+    """Repair the users added and finished counters of a task from queries.
+
+    Used when counters stopped progressing: a crash can leave them off by
+    the users of one page (added) or by one update (terminal).
+
+    Args:
+      task_key_id: Int unique id of the task record.
+
+    Returns:
+      Tuple of 2 Integers: #users added and #users in a terminal state.
+    """
+    user_count = cls.GetUserCountForTask(task_key_id=task_key_id)
+    terminal_user_count = cls.GetUserCountForTaskWithTerminalUserStates(
+        task_key_id=task_key_id)
+    users_added_count, users_terminal_count = cls.GetCountedUsersForTask(
+        task_key_id=task_key_id, skip_cache=True)
+    _LOG.warning('Recounted users of task %s: added %s (counted %s), '
+                 'terminal %s (counted %s).', task_key_id, user_count,
+                 users_added_count, terminal_user_count, users_terminal_count)
+    sharded_counter.IncrementCounters({
+        MakeUsersAddedCounterName(task_key_id):
+            user_count - users_added_count,
+        MakeUsersTerminalCounterName(task_key_id):
+            terminal_user_count - users_terminal_count})
+    return user_count, terminal_user_count
+
+  @classmethod
+  def PutNewUsers(cls, users):
+    """Add new user entities and count them in the state histograms.
+
+    The users are counted as added (and those already in a terminal state,
+    e.g. suspended, as finished) in the state histograms with one
+    transaction before they are written.  A crash in
+    between overcounts the users added which only delays task completion
+    until the counters are recounted: it never completes a task early.
+
+    The batches of users are written concurrently (put_multi_async).
+
+    Args:
+      users: List of new DomainUserToCheckModel entities of one task.
+    """
+    if not users:
+      return
+    task_key_id = users[0].recall_task_id
+    counter_deltas = _MakeStateCounterDeltas(
+        task_key_id,
+        collections.Counter(user.user_state for user in users),
+        collections.Counter(user.message_state for user in users))
+    counter_deltas[MakeUsersAddedCounterName(task_key_id)] = len(users)
+    counter_deltas[MakeUsersTerminalCounterName(task_key_id)] = len(
+        [user for user in users if user.user_state in TERMINAL_USER_STATES])
+    sharded_counter.IncrementCounters(counter_deltas)
+    put_futures = []
+    for batch_start in xrange(0, len(users), _PUT_MULTI_BATCH_SIZE):
+      put_futures.extend(ndb.put_multi_async(
+          users[batch_start:batch_start + _PUT_MULTI_BATCH_SIZE]))
+    for put_future in put_futures:
+      put_future.check_success()
+
   @classmethod
   def SetMessageState(cls, user_key_id, new_state):
     """Describe progress finding/purging a message for one user.
@@ -215,21 +450,75 @@ class DomainUserToCheckModel(ndb.Model):
       user_key_id: String (serializable) unique id of the user.
       new_state: String update for the ndb StringProperty field.
     """
-    user = cls._GetUserByKey(user_key_id)
-    if user:
-      user.message_state = new_state
-      user.put()
+    cls.SetUserAndMessageStates(user_key_id, new_message_state=new_state)
 
   @classmethod
   def SetUserState(cls, user_key_id, new_state):
     """Utility method to update the state of the user record.
 
+    Users in a terminal user state keep that state.
+
     Args:
       user_key_id: String (serializable) unique id of the user.
       new_state: String update for the ndb StringProperty field.
+
+    Returns:
+      Boolean; True if this update moved the user into a terminal state.
+    """
+    return cls.SetUserAndMessageStates(user_key_id, new_user_state=new_state)
+
+  @classmethod
+  @ndb.transactional(xg=True, retries=_TRANSACTIONAL_RETRIES)
+  def SetUserAndMessageStates(cls, user_key_id, new_user_state=None,
+                              new_message_state=None,
+                              new_message_id_states=None):
+    """Update the user and/or message states of the user record in one put.
+
+    Users in a terminal user state keep that state.  The user is read and
+    written in a transaction which also applies the state changes to the
+    per-task state histograms and counts the user reaching a terminal state:
+    concurrent updates of one user count it exactly once and a crash cannot
+    separate the update from its counts.
+
+    Args:
+      user_key_id: String (serializable) unique id of the user.
+      new_user_state: String update for the user_state field or None.
+      new_message_state: String update for the message_state field or None.
+      new_message_id_states: Dictionary of String message-id to String
+                             message state updates or None.
+
+    Returns:
+      Boolean; True if this update moved the user into a terminal state.
     """
     user = cls._GetUserByKey(user_key_id)
-    if user:
-      if user.user_state not in TERMINAL_USER_STATES:
-        user.user_state = new_state
-      user.put()
+    if not user:
+      return False
+    old_user_state = user.user_state
+    old_message_state = user.message_state
+    if new_user_state and user.user_state not in TERMINAL_USER_STATES:
+      user.user_state = new_user_state
+    if new_message_state:
+      user.message_state = new_message_state
+    if new_message_id_states:
+      message_id_states = collections.OrderedDict(
+          (message_result.message_id, message_result.message_state)
+          for message_result in user.message_results)
+      message_id_states.update(new_message_id_states)
+      user.message_results = [
+          MessageResultModel(message_id=message_id, message_state=state)
+          for message_id, state in message_id_states.iteritems()]
+    user.put()
+    user_state_deltas = {}
+    reached_terminal_state = False
+    if user.user_state != old_user_state:
+      user_state_deltas = {old_user_state: -1, user.user_state: 1}
+      reached_terminal_state = user.user_state in TERMINAL_USER_STATES
+    message_state_deltas = {}
+    if user.message_state != old_message_state:
+      message_state_deltas = {old_message_state: -1, user.message_state: 1}
+    counter_deltas = _MakeStateCounterDeltas(
+        user.recall_task_id, user_state_deltas, message_state_deltas)
+    if reached_terminal_state:
+      counter_deltas[MakeUsersTerminalCounterName(user.recall_task_id)] = 1
+    sharded_counter.IncrementCountersInTransaction(counter_deltas)
+    return reached_terminal_state
@@ -20,17 +20,70 @@ from models import recall_task
 
 
 class EntityStateUpdater(object):
-  """Simplify entity state update calls when they occur frequently."""
+  """Simplify entity state update calls when they occur frequently.
 
-  def __init__(self, task_key_id, user_key_id):
+  By default each user/message state update is written immediately.  With
+  buffer_states, updates are held in memory and written in a single put when
+  Flush() is called (also when used as a context manager and on exit) or when
+  a state listed in checkpoint_states is set.  Since terminal user states
+  are only written by a flush, a crash before the final flush leaves the user
+  in a non-terminal state so a retried task will pick the user up again.
+  """
+
+  def __init__(self, task_key_id, user_key_id, buffer_states=False,
+               checkpoint_states=None):
     """Save keys needed to do state updates.
 
     Args:
       task_key_id: Int unique id of the RecallTaskModel object for this recall.
-      user_key_id: Int unique id of the DomainUserToCheckModel object.
+      user_key_id: String unique id of the DomainUserToCheckModel object.
+      buffer_states: Boolean; True to hold user/message state updates in
+                     memory until Flush().
+      checkpoint_states: List of user/message states which force a Flush()
+                         when set with buffer_states.
     """
     self._task_key_id = int(task_key_id)
-    self._user_key_id = int(user_key_id)
+    self._user_key_id = user_key_id
+    self._buffer_states = buffer_states
+    self._checkpoint_states = set(checkpoint_states or [])
+    self._pending_message_id_states = {}
+    self._pending_message_state = None
+    self._pending_user_state = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, exc_traceback):
+    """Writes any buffered states.
+
+    Args:
+      exc_type: Type of Exception if an Exception to be raised.
+      exc_value: Value of Exception if an Exception to be raised.
+      exc_traceback: To be used in Exception processing.
+    """
+    self.Flush()
+
+  def Flush(self):
+    """Write buffered user and message states in a single put.
+
+    The user reaching a terminal state is counted toward task completion
+    (in the same transaction) and may complete the task.
+    """
+    if not (self._pending_user_state or self._pending_message_state or
+            self._pending_message_id_states):
+      return
+    reached_terminal_state = (
+        domain_user.DomainUserToCheckModel.SetUserAndMessageStates(
+            self._user_key_id,
+            new_user_state=self._pending_user_state,
+            new_message_state=self._pending_message_state,
+            new_message_id_states=self._pending_message_id_states))
+    self._pending_message_id_states = {}
+    self._pending_message_state = None
+    self._pending_user_state = None
+    if reached_terminal_state:
+      recall_task.RecallTaskModel.CompleteTaskIfUsersFinished(
+          self._task_key_id)
 
   def SetTaskState(self, new_state):
     """Helper to update task state.
@@ -43,11 +96,14 @@ class EntityStateUpdater(object):
   def SetUserState(self, new_state):
     """Helper to update task user state.
 
+    As in the data store, a terminal user state is not replaced.
+
     Args:
       new_state: String update for the ndb StringProperty field.
     """
-    domain_user.DomainUserToCheckModel.SetUserState(
-        self._user_key_id, new_state)
+    if self._pending_user_state not in domain_user.TERMINAL_USER_STATES:
+      self._pending_user_state = new_state
+    self._MaybeFlush(new_state)
 
   def SetMessageState(self, new_state):
     """Helper to update task user message state.
@@ -55,5 +111,27 @@ class EntityStateUpdater(object):
     Args:
       new_state: String update for the ndb StringProperty field.
     """
-    domain_user.DomainUserToCheckModel.SetMessageState(
-        self._user_key_id, new_state)
+    self._pending_message_state = new_state
+    self._MaybeFlush(new_state)
+
+  def SetMessageIdStates(self, message_id_states):
+    """Helper to update the message states of individual message-ids.
+
+    These are written with the next overall message/user state update.
+
+    Args:
+      message_id_states: Dictionary of String message-id to String message
+                         state.
+    """
+    self._pending_message_id_states.update(message_id_states)
+    if not self._buffer_states:
+      self.Flush()
+
+  def _MaybeFlush(self, new_state):
+    """Flush unless buffering states and new_state is not a checkpoint.
+
+    Args:
+      new_state: String user or message state that was just set.
+    """
+    if not self._buffer_states or new_state in self._checkpoint_states:
+      self.Flush()
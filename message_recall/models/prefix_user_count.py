@@ -0,0 +1,72 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Database models to learn how domain users spread over email prefixes."""
+
+import datetime
+
+import log_utils
+
+from google.appengine.ext import ndb
+
+
+_LOG = log_utils.GetLogger('messagerecall.models.prefix_user_count')
+# Domains change: forget counts not refreshed by a recent recall.
+_PREFIX_USER_COUNT_MAX_AGE = datetime.timedelta(days=30)
+
+
+class EmailPrefixUserCountModel(ndb.Model):
+  """Model to track the #users of a domain whose email has a prefix.
+
+  Counts are observed while retrieving users (Phase2) and used to split busy
+  prefixes into smaller user retrieval tasks on later recalls.
+  """
+
+  domain = ndb.StringProperty(required=True)
+  email_prefix = ndb.StringProperty(required=True, indexed=False)
+  user_count = ndb.IntegerProperty(required=True, indexed=False)
+  updated_datetime = ndb.DateTimeProperty(required=True, auto_now=True,
+                                          indexed=False)
+
+  @classmethod
+  def GetPrefixUserCounts(cls, user_domain):
+    """Retrieve the recently observed user counts of a domain's prefixes.
+
+    Args:
+      user_domain: String domain of the users.
+
+    Returns:
+      Dictionary of String email prefix to Integer user count.
+    """
+    oldest_datetime = datetime.datetime.utcnow() - _PREFIX_USER_COUNT_MAX_AGE
+    return dict((prefix_count.email_prefix, prefix_count.user_count)
+                for prefix_count in cls.query(cls.domain == user_domain)
+                if prefix_count.updated_datetime >= oldest_datetime)
+
+  @classmethod
+  def SetPrefixUserCount(cls, user_domain, email_prefix, user_count):
+    """Record the user count observed for one prefix of a domain.
+
+    Each prefix has its own entity so concurrent user retrieval tasks do not
+    contend.
+
+    Args:
+      user_domain: String domain of the users.
+      email_prefix: String with the first n characters of an email address.
+      user_count: Integer #users found with the prefix.
+    """
+    cls(id='%s_%s' % (user_domain, email_prefix), domain=user_domain,
+        email_prefix=email_prefix, user_count=user_count).put()
+    _LOG.debug('Domain %s has %s users with prefix %s.', user_domain,
+               user_count, email_prefix)
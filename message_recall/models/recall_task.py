@@ -14,6 +14,7 @@
 
 """Database models for root Message Recall Task entity."""
 
+import re
 import time
 
 import log_utils
@@ -21,13 +22,23 @@ from models import domain_user
 from models import error_reason
 import recall_errors
 
+from google.appengine.api import memcache
 from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 
+# Every backend task checks if its recall was aborted.  The aborted flag is
+# kept in memcache (updated by SetTaskState) and memoized in-process briefly
+# so checks rarely read the task entity while aborts propagate in seconds.
+_ABORTED_CACHE_NAMESPACE = 'messagerecall_taskaborted#ns'
+_ABORTED_CACHE_S = 60
+_ABORTED_MEMO = {}  # String task_key_id: (is_aborted, memo time).
+_ABORTED_MEMO_MAX_SIZE = 1000
+_ABORTED_MEMO_S = 2
 _GET_ENTITY_RETRIES = 5
 _GET_ENTITY_SLEEP_S = 2
 _LOG = log_utils.GetLogger('messagerecall.models.recall_task')
+_MESSAGE_CRITERIA_SEPARATOR_REGEX = re.compile(r'[\s,]+')
 _TASK_ROWS_FETCH_PAGE = 10
 
 TASK_STARTED = 'Started'
@@ -38,17 +49,41 @@ TASK_DONE = 'Done'
 TASK_STATES = [TASK_STARTED, TASK_GETTING_USERS, TASK_RECALLING, TASK_DONE]
 
 
+def SplitMessageCriteria(message_criteria):
+  """Split task message criteria into its distinct message-ids.
+
+  A task may recall several messages: message-ids are separated by
+  whitespace or commas.
+
+  Args:
+    message_criteria: String criteria (message-ids) to recall.
+
+  Returns:
+    List of distinct String message-ids in their original order.
+  """
+  message_ids = []
+  for message_id in _MESSAGE_CRITERIA_SEPARATOR_REGEX.split(message_criteria):
+    if message_id and message_id not in message_ids:
+      message_ids.append(message_id)
+  return message_ids
+
+
 class RecallTaskModel(ndb.Model):
   """Model for each running/completed message recall task."""
 
   owner_email = ndb.StringProperty(required=True)
-  message_criteria = ndb.StringProperty(required=True)
+  # Space separated message-ids (may be longer than indexed strings allow).
+  message_criteria = ndb.StringProperty(required=True, indexed=False)
+  # Set to recall only from the recipients of the sender's copy.
+  sender_email = ndb.StringProperty(indexed=False)
   domain = ndb.ComputedProperty(lambda self: self.owner_email.split('@')[1])
   start_datetime = ndb.DateTimeProperty(required=True, auto_now_add=True)
   end_datetime = ndb.DateTimeProperty(indexed=False, auto_now=True)
   task_state = ndb.StringProperty(required=True, default=TASK_STARTED,
                                   choices=TASK_STATES)
   is_aborted = ndb.BooleanProperty(required=True, default=True)
+  # Number of user retrieval tasks (email prefixes) started for the task.
+  email_partition_count = ndb.IntegerProperty(indexed=False)
 
   @classmethod
   def FetchTaskFromSafeId(cls, user_domain, task_key_urlsafe):
@@ -127,13 +162,15 @@ class RecallTaskModel(ndb.Model):
     return cls.query(cls.domain == user_domain).order(-cls.start_datetime)
 
   @classmethod
-  def SetTaskState(cls, task_key_id, new_state, is_aborted=True):
+  def SetTaskState(cls, task_key_id, new_state, is_aborted=True,
+                   email_partition_count=None):
     """Utility method to update the state of the master task record.
 
     Args:
       task_key_id: String (serializable) unique id of the task record.
       new_state: String update for the ndb StringProperty field.
       is_aborted: Boolean; False when performing final update.
+      email_partition_count: Integer #user retrieval tasks if known.
     """
     task = cls.GetTaskByKey(task_key_id)
     if task:
@@ -142,7 +179,54 @@ class RecallTaskModel(ndb.Model):
         if new_state == TASK_DONE:
           _LOG.warning('RecallTaskModel id=%s Done.', task_key_id)
       task.is_aborted = is_aborted
+      if email_partition_count is not None:
+        task.email_partition_count = email_partition_count
       task.put()
+      memcache.set(str(task_key_id), task.AmIAborted(),
+                   time=_ABORTED_CACHE_S, namespace=_ABORTED_CACHE_NAMESPACE)
+
+  @classmethod
+  def CompleteTaskIfUsersFinished(cls, task_key_id, skip_cache=False):
+    """Mark a recalling task done once every user reached a terminal state.
+
+    Completion is tracked by comparing the count of users added to the task
+    against the count of users that reached a terminal user state.  The task
+    is only completed once all user retrieval has ended (TASK_RECALLING).
+    Counts read from memcache are confirmed from the counter shards before
+    the task is marked done: a memcache value lost and restarted could read
+    low.
+
+    Args:
+      task_key_id: Int unique id of the task record.
+      skip_cache: Boolean; True to sum the counter shards instead of using the
+                  memcache counter values.
+
+    Returns:
+      Boolean; True if the task is done.
+    """
+    users_added_count, users_terminal_count = (
+        domain_user.DomainUserToCheckModel.GetCountedUsersForTask(
+            task_key_id=task_key_id, skip_cache=skip_cache))
+    if users_terminal_count < users_added_count:
+      return False
+    task = cls.GetTaskByKey(task_key_id)
+    if task.task_state == TASK_DONE:
+      return True
+    if task.task_state != TASK_RECALLING:
+      return False
+    if not skip_cache:
+      return cls.CompleteTaskIfUsersFinished(task_key_id, skip_cache=True)
+    cls.SetTaskState(task_key_id=task_key_id, new_state=TASK_DONE,
+                     is_aborted=False)
+    return True
+
+  def GetMessageIds(self):
+    """Helper to list the message-ids this task recalls.
+
+    Returns:
+      List of distinct String message-ids.
+    """
+    return SplitMessageCriteria(self.message_criteria)
 
   def GetErrorReasonCountForTask(self):
     """Count the #error reasons associated with the current task.
@@ -197,6 +281,16 @@ class RecallTaskModel(ndb.Model):
         user_state_filters=user_state_filters,
         message_state_filters=message_state_filters)
 
+  def GetStateCounts(self):
+    """Helper to read the user and message state histograms of the task.
+
+    Returns:
+      Tuple of 2 dictionaries: user_state to Integer count of users and
+      message_state to Integer count of users.
+    """
+    return domain_user.DomainUserToCheckModel.GetStateCountsForTask(
+        task_key_id=self.key.id())
+
   def GetUserCountForTaskWithTerminalUserStates(self):
     """Helper to count users who have completed processing.
 
@@ -215,11 +309,27 @@ class RecallTaskModel(ndb.Model):
   def IsTaskAborted(cls, task_key_id):
     """Convenience method to check if another task aborted the recall.
 
+    The aborted flag is read from a memo of the last few seconds, then from
+    memcache and only then from the task entity.
+
     Args:
       task_key_id: key id of the RecallTask model object for this recall.
 
     Returns:
       True if task found and aborted is True else False.
     """
-    task = cls.GetTaskByKey(task_key_id=task_key_id)
-    return task.is_aborted and (task.task_state == TASK_DONE)
+    task_key_string = str(task_key_id)
+    memo = _ABORTED_MEMO.get(task_key_string)
+    if memo and time.time() - memo[1] < _ABORTED_MEMO_S:
+      return memo[0]
+    is_aborted = memcache.get(task_key_string,
+                              namespace=_ABORTED_CACHE_NAMESPACE)
+    if is_aborted is None:
+      is_aborted = cls.GetTaskByKey(task_key_id=task_key_id).AmIAborted()
+      # add() rather than set() so a concurrent SetTaskState() wins.
+      memcache.add(task_key_string, is_aborted, time=_ABORTED_CACHE_S,
+                   namespace=_ABORTED_CACHE_NAMESPACE)
+    if len(_ABORTED_MEMO) >= _ABORTED_MEMO_MAX_SIZE:
+      _ABORTED_MEMO.clear()
+    _ABORTED_MEMO[task_key_string] = (is_aborted, time.time())
+    return is_aborted
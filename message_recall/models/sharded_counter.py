@@ -27,14 +27,19 @@ from google.appengine.ext import ndb
 
 
 _COUNTER_MEMCACHE_EXPIRATION_S = 60 * 60 * 24
+_DEFAULT_NUM_SHARDS = 20
 _LOG = log_utils.GetLogger('messagerecall.models.sharded_counter')
+# Shard counts are memoized per instance: they only ever grow so a memoized
+# count still names shards that are summed.
+_NUM_SHARDS_MEMO = {}
+_NUM_SHARDS_MEMO_MAX_SIZE = 10000
 _SHARD_KEY_TEMPLATE = 'shard-{}-{:d}'
 _TRANSACTIONAL_RETRIES = 8
 
 
 class CounterShardConfig(ndb.Model):
   """Allows customized shard count: highly used counters need more shards."""
-  num_shards = ndb.IntegerProperty(default=20)
+  num_shards = ndb.IntegerProperty(default=_DEFAULT_NUM_SHARDS)
 
   @classmethod
   def AllKeys(cls, name):
@@ -59,32 +64,55 @@ class CounterShardCount(ndb.Model):
   count = ndb.IntegerProperty(default=0)
 
 
-def GetCounterCount(name):
+def GetCounterCount(name, skip_cache=False):
   """Sums a cumulative value from all the shard counts for the given name.
 
   Args:
     name: The name of the counter.
+    skip_cache: Boolean; True to sum the shards and refresh the memcache
+                value even when a (possibly stale) value is cached.
 
   Returns:
     Integer; the cumulative count of all sharded counters for the given
     counter name.
   """
-  total = memcache.get(key=name)
-  if total is not None:
-    return total
+  if not skip_cache:
+    total = memcache.get(key=name)
+    if total is not None:
+      return total
 
   total = 0
   all_keys = CounterShardConfig.AllKeys(name)
   for counter in ndb.get_multi(all_keys):
     if counter is not None:
       total += counter.count
-  if memcache.add(key=name, value=total,
-                  time=_COUNTER_MEMCACHE_EXPIRATION_S):
+  if skip_cache:
+    if memcache.set(key=name, value=total,
+                    time=_COUNTER_MEMCACHE_EXPIRATION_S):
+      return total
+  elif memcache.add(key=name, value=total,
+                    time=_COUNTER_MEMCACHE_EXPIRATION_S):
     return total
   raise recall_errors.MessageRecallCounterError(
       'Unexpected problem adding to memcache: %s.' % name)
 
 
+def GetCounterCounts(names):
+  """Read many counters with one memcache call; sums shards of any misses.
+
+  Args:
+    names: List of counter names.
+
+  Returns:
+    Dictionary of counter name to Integer cumulative count.
+  """
+  totals = memcache.get_multi(keys=names)
+  for name in names:
+    if name not in totals:
+      totals[name] = GetCounterCount(name)
+  return totals
+
+
 @ndb.transactional
 def IncreaseCounterShards(name, num_shards):
   """Increase the number of shards for a given sharded counter.
@@ -99,6 +127,7 @@ def IncreaseCounterShards(name, num_shards):
   if config.num_shards < num_shards:
     config.num_shards = num_shards
     config.put()
+  _NUM_SHARDS_MEMO.pop(name, None)
 
 
 @ndb.transactional(retries=_TRANSACTIONAL_RETRIES)
@@ -141,5 +170,74 @@ def IncrementCounterAndGetCount(name, delta=1):
   """
   if not delta:
     return None
-  config = CounterShardConfig.get_or_insert(name)
-  return _Increment(name=name, num_shards=config.num_shards, delta=delta)
+  return _Increment(name=name, num_shards=_GetNumShards([name])[name],
+                    delta=delta)
+
+
+def _GetNumShards(names):
+  """Helper to read the number of shards of counters (memoized).
+
+  Configs not memoized yet are read with one batch get.  Counters without a
+  config (never read yet) have the default number.
+
+  Args:
+    names: List of counter names.
+
+  Returns:
+    Dictionary of counter name to Integer number of shards.
+  """
+  unknown_names = [name for name in names if name not in _NUM_SHARDS_MEMO]
+  if unknown_names:
+    configs = ndb.get_multi([ndb.Key(CounterShardConfig, name)
+                             for name in unknown_names])
+    if len(_NUM_SHARDS_MEMO) >= _NUM_SHARDS_MEMO_MAX_SIZE:
+      _NUM_SHARDS_MEMO.clear()
+    for name, config in zip(unknown_names, configs):
+      _NUM_SHARDS_MEMO[name] = (config.num_shards if config else
+                                _DEFAULT_NUM_SHARDS)
+  return dict((name, _NUM_SHARDS_MEMO[name]) for name in names)
+
+
+def IncrementCountersInTransaction(name_deltas):
+  """Increment several sharded counters within the caller's transaction.
+
+  One shard of each counter is written with the caller's entities so the
+  counts change if and only if the transaction commits.  Each counter is its
+  own entity group: the transaction must allow cross-group (xg) writes.
+
+  The memcache values are offset once the transaction commits.  Missing
+  memcache values are left missing (rather than started from 0) so the next
+  read sums the shards.
+
+  Args:
+    name_deltas: Dictionary of counter name to Integer delta (may be < 0).
+  """
+  name_deltas = dict((name, delta) for name, delta in name_deltas.iteritems()
+                     if delta)
+  if not name_deltas:
+    return
+  num_shards = _GetNumShards(name_deltas.keys())
+  shard_keys = [
+      ndb.Key(CounterShardCount, _SHARD_KEY_TEMPLATE.format(
+          name, random.randint(0, num_shards[name] - 1)))
+      for name in name_deltas]
+  counters = []
+  for shard_key, counter, delta in zip(shard_keys, ndb.get_multi(shard_keys),
+                                       name_deltas.values()):
+    if counter is None:
+      counter = CounterShardCount(key=shard_key)
+    counter.count += delta
+    counters.append(counter)
+  ndb.put_multi(counters)
+  ndb.get_context().call_on_commit(
+      lambda: memcache.offset_multi(name_deltas))
+
+
+@ndb.transactional(xg=True, retries=_TRANSACTIONAL_RETRIES)
+def IncrementCounters(name_deltas):
+  """Increment several sharded counters together (all or none).
+
+  Args:
+    name_deltas: Dictionary of counter name to Integer delta (may be < 0).
+  """
+  IncrementCountersInTransaction(name_deltas)
@@ -0,0 +1,180 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-instance caches and idle connection pools shared by request threads.
+
+An instance serves several requests (threads) at once so every structure
+here is locked.
+"""
+
+import collections
+import threading
+import time
+
+
+class LruCache(object):
+  """Bounded cache dropping the least recently used entries."""
+
+  def __init__(self, max_size):
+    """Initialize an empty cache.
+
+    Args:
+      max_size: Int maximum number of entries kept.
+    """
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._max_size = max_size
+
+  def Get(self, key):
+    """Get the value of a key, making it the most recently used.
+
+    Args:
+      key: Hashable key of the entry.
+
+    Returns:
+      The value or None if not cached.
+    """
+    with self._lock:
+      value = self._entries.pop(key, None)
+      if value is not None:
+        self._entries[key] = value
+      return value
+
+  def Pop(self, key):
+    """Remove the entry of a key.
+
+    Args:
+      key: Hashable key of the entry.
+
+    Returns:
+      The value or None if not cached.
+    """
+    with self._lock:
+      return self._entries.pop(key, None)
+
+  def Set(self, key, value):
+    """Set the value of a key, making it the most recently used.
+
+    Args:
+      key: Hashable key of the entry.
+      value: Value to cache (not None).
+
+    Returns:
+      List of the values dropped: the value replaced if any and the least
+      recently used beyond max_size.
+    """
+    with self._lock:
+      dropped_values = []
+      replaced_value = self._entries.pop(key, None)
+      if replaced_value is not None:
+        dropped_values.append(replaced_value)
+      self._entries[key] = value
+      while len(self._entries) > self._max_size:
+        dropped_values.append(self._entries.popitem(last=False)[1])
+      return dropped_values
+
+
+class IdlePool(object):
+  """Base of pools of idle connections keyed by destination (host, user).
+
+  Up to max_idle_per_key connections are kept per key, most recently
+  released first out, and the connections of the least recently used keys
+  are closed beyond max_keys.  Connections idle longer than idle_timeout_s
+  or failing _IsReusable() are closed instead of leased.
+
+  Connections are closed outside the lock: closing may wait on the network.
+  """
+
+  def __init__(self, max_keys, max_idle_per_key, idle_timeout_s):
+    """Initialize an empty pool.
+
+    Args:
+      max_keys: Int maximum number of keys with idle connections.
+      max_idle_per_key: Int maximum number of idle connections kept per key.
+      idle_timeout_s: Int seconds an idle connection may be kept.
+    """
+    # Lists of (connection, release time) by key.  Only accessed under
+    # _lock so each list is updated atomically.
+    self._idle_connections = LruCache(max_size=max_keys)
+    self._idle_timeout_s = idle_timeout_s
+    self._lock = threading.Lock()
+    self._max_idle_per_key = max_idle_per_key
+
+  def _Close(self, connection):
+    """Close a connection that may already be broken without raising.
+
+    Args:
+      connection: Connection to close.
+    """
+    raise NotImplementedError
+
+  def _IsReusable(self, unused_connection):
+    """Check a fresh idle connection is healthy enough to lease again.
+
+    Returns:
+      True if the connection may be leased again else False.
+    """
+    return True
+
+  def LeaseIdle(self, key):
+    """Lease the most recently released idle connection of a key if any.
+
+    Args:
+      key: Hashable destination of the connections.
+
+    Returns:
+      Connection or None if no fresh idle connection is available.
+    """
+    expired_connections = []
+    leased_connection = None
+    with self._lock:
+      idle_connections = self._idle_connections.Get(key) or []
+      while idle_connections:
+        connection, release_time = idle_connections.pop()
+        if time.time() - release_time < self._idle_timeout_s:
+          leased_connection = connection
+          break
+        expired_connections.append(connection)
+      if not idle_connections:
+        self._idle_connections.Pop(key)
+    for connection in expired_connections:
+      self._Close(connection)
+    if leased_connection is not None and not self._IsReusable(
+        leased_connection):
+      self._Close(leased_connection)
+      return None
+    return leased_connection
+
+  def ReleaseIdle(self, key, connection):
+    """Keep a connection idle for a later lease.
+
+    Args:
+      key: Hashable destination of the connection.
+      connection: Connection to keep.
+    """
+    evicted_connections = []
+    with self._lock:
+      idle_connections = self._idle_connections.Get(key)
+      if idle_connections is None:
+        idle_connections = []
+        for dropped_connections in self._idle_connections.Set(
+            key, idle_connections):
+          evicted_connections.extend(
+              dropped_connection for dropped_connection, unused_release_time
+              in dropped_connections)
+      idle_connections.append((connection, time.time()))
+      while len(idle_connections) > self._max_idle_per_key:
+        evicted_connections.append(idle_connections.pop(0)[0])
+    for connection in evicted_connections:
+      self._Close(connection)
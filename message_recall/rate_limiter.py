@@ -0,0 +1,120 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request rate limits shared by all instances (e.g. API quotas).
+
+Each limit is a token bucket refilled every second.  The tokens taken in the
+current second are counted in memcache (incr) so all instances and recalls
+share the limit.  Each instance takes a few tokens at a time and spends them
+locally to save memcache rpcs.
+"""
+
+import threading
+import time
+
+import log_utils
+
+from google.appengine.api import memcache
+
+
+_CACHE_NAMESPACE = 'messagerecall_ratelimit#ns'
+_LOG = log_utils.GetLogger('messagerecall.rate_limiter')
+_WINDOW_CACHE_S = 10  # Counts of past seconds are not needed for long.
+
+
+class RateLimiter(object):
+  """Limits the requests per second of one bucket (e.g. one domain).
+
+  Tokens not spent in the second they were taken expire.  If memcache is
+  unavailable requests are not limited.
+  """
+
+  def __init__(self, bucket_name, requests_per_s, prefetch_count):
+    """Initialize an empty local bucket.
+
+    Args:
+      bucket_name: String name of the bucket shared by all instances.
+      requests_per_s: Int requests allowed per second.
+      prefetch_count: Int tokens taken from memcache at a time.
+    """
+    self._bucket_name = bucket_name
+    self._local_tokens = 0
+    self._local_window = None
+    self._lock = threading.Lock()
+    self._prefetch_count = min(prefetch_count, requests_per_s)
+    self._requests_per_s = requests_per_s
+
+  def _TakeTokens(self, window, is_new_window):
+    """Take tokens of one second from the shared bucket.
+
+    Args:
+      window: Int second (since epoch) the tokens are spent in.
+      is_new_window: Boolean; True if first taking tokens in this second.
+
+    Returns:
+      Int number of tokens taken (0 if none are left this second).
+    """
+    window_key = '%s_%d' % (self._bucket_name, window)
+    if is_new_window:
+      # incr() cannot set an expiration: create the count with one.
+      memcache.add(window_key, 0, time=_WINDOW_CACHE_S,
+                   namespace=_CACHE_NAMESPACE)
+    taken_count = memcache.incr(window_key, delta=self._prefetch_count,
+                                initial_value=0, namespace=_CACHE_NAMESPACE)
+    if taken_count is None:
+      _LOG.warning('Unable to count %s requests: not limiting them.',
+                   self._bucket_name)
+      return self._prefetch_count
+    return max(0, min(self._prefetch_count,
+                      self._requests_per_s -
+                      (taken_count - self._prefetch_count)))
+
+  def Acquire(self):
+    """Wait until one request may be sent."""
+    while True:
+      with self._lock:
+        window = int(time.time())
+        is_new_window = self._local_window != window
+        if is_new_window:
+          self._local_window = window
+          self._local_tokens = 0
+        if not self._local_tokens:
+          self._local_tokens = self._TakeTokens(window, is_new_window)
+        if self._local_tokens:
+          self._local_tokens -= 1
+          return
+      time.sleep(max(0, window + 1 - time.time()))
+
+
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def GetRateLimiter(bucket_name, requests_per_s, prefetch_count):
+  """Get the instance's rate limiter of a bucket.
+
+  Args:
+    bucket_name: String name of the bucket shared by all instances.
+    requests_per_s: Int requests allowed per second.
+    prefetch_count: Int tokens taken from memcache at a time.
+
+  Returns:
+    RateLimiter of the bucket.
+  """
+  with _RATE_LIMITERS_LOCK:
+    if bucket_name not in _RATE_LIMITERS:
+      _RATE_LIMITERS[bucket_name] = RateLimiter(
+          bucket_name=bucket_name, requests_per_s=requests_per_s,
+          prefetch_count=prefetch_count)
+    return _RATE_LIMITERS[bucket_name]
@@ -24,6 +24,8 @@ SERVICE_SCOPES = [
     'https://www.googleapis.com/auth/cloud-billing.readonly',
     # For directory.
     'https://www.googleapis.com/auth/admin.directory.user.readonly',
+    # For expanding group recipients.
+    'https://www.googleapis.com/auth/admin.directory.group.member.readonly',
     # For IMAP mail API.
     'https://mail.google.com/',
     ]
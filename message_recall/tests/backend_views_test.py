@@ -0,0 +1,166 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the backend views.
+
+Tests that busy email prefixes are split into smaller user retrieval tasks
+and that user recall tasks are enqueued once per chunk of users.
+"""
+
+import unittest
+
+# setup_path required to allow imports from models.
+import setup_path  # pylint: disable=unused-import,g-bad-import-order
+
+import backend_views
+from models.domain_user import DomainUserToCheckModel
+from models.domain_user import USER_DONE
+from models.prefix_user_count import EmailPrefixUserCountModel
+from test_utils import SetupLogging
+import webapp2
+
+from google.appengine.ext import testbed
+
+
+_MESSAGE_CRITERIA = (
+    'ZZZ33ETLNd8dkrJcNJN1qDE-cOU69xVm1iZgurm37V31EoO9SZz@mail.gmail.com')
+_TASK_KEY_ID = 1234
+_USER_DOMAIN = 'mydomain.com'
+_BUSY_USER_COUNT = backend_views._EMAIL_PREFIX_SPLIT_USER_COUNT + 1
+
+
+class PartitionEmailPrefixesTests(unittest.TestCase):
+
+  def setUp(self):
+    SetupLogging()
+    self._testbed = testbed.Testbed()
+    self._testbed.activate()
+    self._testbed.init_datastore_v3_stub()
+    self._testbed.init_memcache_stub()
+
+  def tearDown(self):
+    self._testbed.deactivate()
+
+  def testPartitionWithoutDomainUsesFirstChars(self):
+    self.assertEqual(list(backend_views._EMAIL_PREFIX_FIRST_CHARS),
+                     backend_views.PartitionEmailPrefixes())
+
+  def testPrefixAtSplitUserCountIsNotSplit(self):
+    prefix_user_counts = {'a': backend_views._EMAIL_PREFIX_SPLIT_USER_COUNT}
+    self.assertEqual(['a'], backend_views._SplitEmailPrefix(
+        'a', prefix_user_counts))
+
+  def testBusyPrefixIsSplitWithExactPrefix(self):
+    email_prefixes = backend_views._SplitEmailPrefix(
+        'a', {'a': _BUSY_USER_COUNT})
+    self.assertEqual(['a@'] + ['a' + next_char for next_char in
+                               backend_views._EMAIL_PREFIX_NEXT_CHARS],
+                     email_prefixes)
+    self.assertNotIn('a', email_prefixes)
+
+  def testSplitStopsAtMaxLength(self):
+    prefix_user_counts = {'a': _BUSY_USER_COUNT, 'ab': _BUSY_USER_COUNT,
+                          'abc': _BUSY_USER_COUNT}
+    email_prefixes = backend_views._SplitEmailPrefix('a', prefix_user_counts)
+    self.assertIn('a@', email_prefixes)
+    self.assertIn('ab@', email_prefixes)
+    self.assertIn('abc', email_prefixes)
+    self.assertNotIn('abc@', email_prefixes)
+    self.assertNotIn('ab', email_prefixes)
+    self.assertFalse([email_prefix for email_prefix in email_prefixes
+                      if len(email_prefix.rstrip('@')) >
+                      backend_views._EMAIL_PREFIX_MAX_LENGTH])
+    self.assertEqual(len(email_prefixes), len(set(email_prefixes)))
+
+  def testPartitionSplitsPrefixesBusyInTheDomain(self):
+    EmailPrefixUserCountModel.SetPrefixUserCount(_USER_DOMAIN, 'b',
+                                                 _BUSY_USER_COUNT)
+    EmailPrefixUserCountModel.SetPrefixUserCount('otherdomain.com', 'c',
+                                                 _BUSY_USER_COUNT)
+    email_prefixes = backend_views.PartitionEmailPrefixes(_USER_DOMAIN)
+    self.assertNotIn('b', email_prefixes)
+    self.assertIn('b@', email_prefixes)
+    self.assertIn('c', email_prefixes)
+    self.assertEqual(len(backend_views._EMAIL_PREFIX_FIRST_CHARS) +
+                     len(backend_views._EMAIL_PREFIX_NEXT_CHARS),
+                     len(email_prefixes))
+
+
+class EnqueueUserRecallTasksTests(unittest.TestCase):
+
+  def setUp(self):
+    SetupLogging()
+    self._testbed = testbed.Testbed()
+    self._testbed.activate()
+    # Tasks targeting a backend derive their host from the default version.
+    self._testbed.setup_env(overwrite=True,
+                            DEFAULT_VERSION_HOSTNAME='localhost:8080')
+    self._testbed.init_datastore_v3_stub()
+    self._testbed.init_memcache_stub()
+    self._testbed.init_taskqueue_stub(root_path=setup_path.APP_BASE_PATH)
+    self._taskqueue_stub = self._testbed.get_stub(
+        testbed.TASKQUEUE_SERVICE_NAME)
+    self._handler = backend_views.Phase2RetrieveDomainUsersHandler(
+        webapp2.Request.blank('/backend/retrieve_domain_users'),
+        webapp2.Response())
+    self._handler._task_key_id = _TASK_KEY_ID
+    batch_size = backend_views._USER_RECALL_BATCH_SIZE
+    self._users = [
+        DomainUserToCheckModel.CreateUserForTask(
+            task_key_id=_TASK_KEY_ID,
+            user_email='user%04d@%s' % (user_index, _USER_DOMAIN))
+        for user_index in xrange(2 * batch_size + batch_size / 2)]
+    # The first chunk has finished and half of the second.
+    for user in self._users[:batch_size + batch_size / 2]:
+      user.user_state = USER_DONE
+
+  def tearDown(self):
+    self._testbed.deactivate()
+
+  def _GetUserRecallTasks(self):
+    return sorted(self._taskqueue_stub.get_filtered_tasks(
+        queue_names=['user-recall-queue']), key=lambda task: task.name)
+
+  def testFinishedUsersAreNotEnqueued(self):
+    self._handler._EnqueueUserRecallTasks(message_criteria=_MESSAGE_CRITERIA,
+                                          users=self._users)
+    user_recall_tasks = self._GetUserRecallTasks()
+    self.assertEqual(2, len(user_recall_tasks))
+    batch_size = backend_views._USER_RECALL_BATCH_SIZE
+    unfinished_users = self._users[batch_size + batch_size / 2:2 * batch_size]
+    self.assertEqual([user.user_email for user in unfinished_users],
+                     user_recall_tasks[0].extract_params()['user_email'])
+
+  def testRetriedPageIsNotEnqueuedAgain(self):
+    self._handler._EnqueueUserRecallTasks(message_criteria=_MESSAGE_CRITERIA,
+                                          users=self._users)
+    task_names = [task.name for task in self._GetUserRecallTasks()]
+    self._handler._EnqueueUserRecallTasks(message_criteria=_MESSAGE_CRITERIA,
+                                          users=self._users)
+    self.assertEqual(task_names,
+                     [task.name for task in self._GetUserRecallTasks()])
+
+  def testRetriedPageAddsChunksNotAddedBefore(self):
+    batch_size = backend_views._USER_RECALL_BATCH_SIZE
+    self._handler._EnqueueUserRecallTasks(
+        message_criteria=_MESSAGE_CRITERIA,
+        users=self._users[:2 * batch_size])
+    self.assertEqual(1, len(self._GetUserRecallTasks()))
+    self._handler._EnqueueUserRecallTasks(message_criteria=_MESSAGE_CRITERIA,
+                                          users=self._users)
+    self.assertEqual(2, len(self._GetUserRecallTasks()))
+
+
+if __name__ == '__main__':
+  unittest.main()
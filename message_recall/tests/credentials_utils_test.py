@@ -0,0 +1,188 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the access token helpers of credentials_utils.
+
+Tests that access tokens are cached with their expiry, refreshed ahead of it
+and minted once for concurrent refreshes.
+"""
+
+import threading
+import time
+import unittest
+
+# setup_path required to allow imports from the application.
+import setup_path  # pylint: disable=unused-import,g-bad-import-order
+
+import credentials_utils
+from pool_utils import LruCache
+from test_utils import SetupLogging
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+
+_USER_EMAIL = 'testuser@mydomain.com'
+
+
+class AccessTokenTests(unittest.TestCase):
+
+  def setUp(self):
+    SetupLogging()
+    self._testbed = testbed.Testbed()
+    self._testbed.activate()
+    self._testbed.init_memcache_stub()
+    self._mint_count = 0
+    self._mint_latency_s = 0
+    self._mint_lock = threading.Lock()
+    self._token_lifetime_s = 60 * 60
+    self._originals = [
+        (attribute_name, getattr(credentials_utils, attribute_name))
+        for attribute_name in ('MintUserAccessToken', '_ACCESS_TOKEN_LRU',
+                               '_REFRESH_LEASE_S', '_REFRESH_WAIT_POLL_S')]
+    credentials_utils.MintUserAccessToken = self._MintUserAccessToken
+    credentials_utils._ACCESS_TOKEN_LRU = LruCache(max_size=10)
+    credentials_utils._REFRESH_WAIT_POLL_S = 0.01
+
+  def tearDown(self):
+    for attribute_name, original in self._originals:
+      setattr(credentials_utils, attribute_name, original)
+    self._testbed.deactivate()
+
+  def _MintUserAccessToken(self, unused_user_email):
+    with self._mint_lock:
+      self._mint_count += 1
+      mint_count = self._mint_count
+    time.sleep(self._mint_latency_s)
+    return ('access_token_%s' % mint_count,
+            time.time() + self._token_lifetime_s)
+
+  def _CacheSharedAccessToken(self, access_token):
+    memcache.set(_USER_EMAIL, (access_token, time.time() + 60 * 60),
+                 namespace=credentials_utils._CACHE_NAMESPACE)
+
+  def _HoldRefreshLease(self):
+    memcache.add(_USER_EMAIL, 1, time=60,
+                 namespace=credentials_utils._REFRESH_LEASE_NAMESPACE)
+
+  def testStaleAccessTokenIsReplacedOnce(self):
+    self._CacheSharedAccessToken('stale_access_token')
+    self.assertEqual('access_token_1', credentials_utils._RefreshAccessToken(
+        _USER_EMAIL, 'stale_access_token'))
+    self.assertEqual('access_token_1', credentials_utils._RefreshAccessToken(
+        _USER_EMAIL, 'stale_access_token'))
+    self.assertEqual(1, self._mint_count)
+
+  def testConcurrentRefreshesMintOnce(self):
+    self._mint_latency_s = 0.1
+    access_tokens = []
+
+    def _Refresh():
+      access_tokens.append(
+          credentials_utils._RefreshAccessToken(_USER_EMAIL, None))
+
+    threads = [threading.Thread(target=_Refresh) for unused_index in xrange(5)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(['access_token_1'] * 5, access_tokens)
+    self.assertEqual(1, self._mint_count)
+
+  def testRefreshOfAnotherInstanceIsAwaited(self):
+    self._HoldRefreshLease()
+    refresh_timer = threading.Timer(
+        0.05, self._CacheSharedAccessToken, args=('other_access_token',))
+    refresh_timer.start()
+    try:
+      self.assertEqual('other_access_token',
+                       credentials_utils._RefreshAccessToken(_USER_EMAIL,
+                                                             None))
+    finally:
+      refresh_timer.join()
+    self.assertEqual(0, self._mint_count)
+
+  def testAccessTokenIsMintedWhenLeaseWaitTimesOut(self):
+    credentials_utils._REFRESH_LEASE_S = 0.1
+    self._HoldRefreshLease()
+    self.assertEqual('access_token_1', credentials_utils._RefreshAccessToken(
+        _USER_EMAIL, None))
+    self.assertEqual(1, self._mint_count)
+    # The lease of the other instance is left to expire.
+    self.assertTrue(memcache.get(
+        _USER_EMAIL, namespace=credentials_utils._REFRESH_LEASE_NAMESPACE))
+
+  def testAccessTokenIsMintedWhenOtherRefreshFails(self):
+    self._HoldRefreshLease()
+    release_timer = threading.Timer(
+        0.05, memcache.delete, args=(_USER_EMAIL,),
+        kwargs={'namespace': credentials_utils._REFRESH_LEASE_NAMESPACE})
+    release_timer.start()
+    try:
+      self.assertEqual('access_token_1', credentials_utils._RefreshAccessToken(
+          _USER_EMAIL, None))
+    finally:
+      release_timer.join()
+    self.assertEqual(1, self._mint_count)
+
+  def testRefreshLeaseIsReleased(self):
+    credentials_utils._RefreshAccessToken(_USER_EMAIL, None)
+    self.assertIsNone(memcache.get(
+        _USER_EMAIL, namespace=credentials_utils._REFRESH_LEASE_NAMESPACE))
+
+  def testCachedAccessTokenIsReused(self):
+    self.assertEqual('access_token_1',
+                     credentials_utils.GetUserAccessToken(_USER_EMAIL))
+    self.assertEqual('access_token_1',
+                     credentials_utils.GetUserAccessToken(_USER_EMAIL))
+    self.assertEqual(1, self._mint_count)
+
+  def testSharedAccessTokenIsReusedWhenDroppedInProcess(self):
+    credentials_utils._ACCESS_TOKEN_LRU = LruCache(max_size=1)
+    credentials_utils.GetUserAccessToken(_USER_EMAIL)
+    credentials_utils.GetUserAccessToken('otheruser@mydomain.com')
+    self.assertIsNone(credentials_utils._ACCESS_TOKEN_LRU.Get(_USER_EMAIL))
+    self.assertEqual('access_token_1',
+                     credentials_utils.GetUserAccessToken(_USER_EMAIL))
+    self.assertEqual(2, self._mint_count)
+
+  def testForcedRefreshMintsAccessToken(self):
+    credentials_utils.GetUserAccessToken(_USER_EMAIL)
+    self.assertEqual('access_token_2', credentials_utils.GetUserAccessToken(
+        _USER_EMAIL, force_refresh=True))
+
+  def testExpiringAccessTokenIsNotUsed(self):
+    self._token_lifetime_s = credentials_utils._ACCESS_TOKEN_EXPIRY_MARGIN_S
+    credentials_utils.GetUserAccessToken(_USER_EMAIL)
+    self.assertEqual('access_token_2',
+                     credentials_utils.GetUserAccessToken(_USER_EMAIL))
+
+  def testAccessTokenIsRefreshedAheadOfExpiry(self):
+    self._token_lifetime_s = credentials_utils._ACCESS_TOKEN_REFRESH_AHEAD_S - 1
+    credentials_utils.GetUserAccessToken(_USER_EMAIL)
+    self._token_lifetime_s = 60 * 60
+    # The cached token is used while a new one is minted in the background.
+    self.assertEqual('access_token_1',
+                     credentials_utils.GetUserAccessToken(_USER_EMAIL))
+    wait_end_time = time.time() + 5
+    while (_USER_EMAIL in credentials_utils._BACKGROUND_REFRESH_USER_EMAILS and
+           time.time() < wait_end_time):
+      time.sleep(0.01)
+    self.assertEqual('access_token_2',
+                     credentials_utils.GetUserAccessToken(_USER_EMAIL))
+    self.assertEqual(2, self._mint_count)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,114 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the DirectorySnapshotModel class.
+
+Tests that recent domain user lists are shared across email prefixes.
+"""
+
+import datetime
+import unittest
+
+# setup_path required to allow imports from models.
+import setup_path  # pylint: disable=unused-import,g-bad-import-order
+
+from models import directory_snapshot
+from models.directory_snapshot import DirectorySnapshotModel
+from test_utils import SetupLogging
+
+from google.appengine.ext import testbed
+
+
+_USER_DOMAIN = 'mydomain.com'
+_USER_TUPLES = [('sam@mydomain.com', False),
+                ('samuel@mydomain.com', True),
+                ('sarah@mydomain.com', False),
+                ('steve@mydomain.com', False)]
+
+
+class DirectorySnapshotModelTests(unittest.TestCase):
+
+  def setUp(self):
+    SetupLogging()
+    self._testbed = testbed.Testbed()
+    self._testbed.activate()
+    self._testbed.init_datastore_v3_stub()
+    self._testbed.init_memcache_stub()
+    self._original_max_age = directory_snapshot._SNAPSHOT_MAX_AGE
+    self._original_max_user_count = directory_snapshot._SNAPSHOT_MAX_USER_COUNT
+
+  def tearDown(self):
+    directory_snapshot._SNAPSHOT_MAX_AGE = self._original_max_age
+    directory_snapshot._SNAPSHOT_MAX_USER_COUNT = self._original_max_user_count
+    self._testbed.deactivate()
+
+  def testSnapshotOfPrefixIsUsed(self):
+    DirectorySnapshotModel.SetUserTuples(_USER_DOMAIN, 's', _USER_TUPLES)
+    self.assertEqual(_USER_TUPLES, DirectorySnapshotModel.GetFreshUserTuples(
+        _USER_DOMAIN, 's'))
+
+  def testMissingSnapshotIsNotUsed(self):
+    DirectorySnapshotModel.SetUserTuples('otherdomain.com', 's', _USER_TUPLES)
+    self.assertIsNone(DirectorySnapshotModel.GetFreshUserTuples(
+        _USER_DOMAIN, 's'))
+
+  def testShorterPrefixSnapshotCoversLongerPrefix(self):
+    DirectorySnapshotModel.SetUserTuples(_USER_DOMAIN, 's', _USER_TUPLES)
+    self.assertEqual(_USER_TUPLES[:2],
+                     DirectorySnapshotModel.GetFreshUserTuples(
+                         _USER_DOMAIN, 'sam'))
+
+  def testLongerPrefixSnapshotDoesNotCoverShorterPrefix(self):
+    DirectorySnapshotModel.SetUserTuples(_USER_DOMAIN, 'sa', _USER_TUPLES[:3])
+    self.assertIsNone(DirectorySnapshotModel.GetFreshUserTuples(
+        _USER_DOMAIN, 's'))
+
+  def testExactPrefixMatchesOneUser(self):
+    DirectorySnapshotModel.SetUserTuples(_USER_DOMAIN, 's', _USER_TUPLES)
+    self.assertEqual(_USER_TUPLES[:1],
+                     DirectorySnapshotModel.GetFreshUserTuples(
+                         _USER_DOMAIN, 'sam@'))
+
+  def testExpiredSnapshotIsNotUsed(self):
+    DirectorySnapshotModel.SetUserTuples(_USER_DOMAIN, 's', _USER_TUPLES)
+    # A snapshot taken now is already older than a negative max age.
+    directory_snapshot._SNAPSHOT_MAX_AGE = datetime.timedelta(seconds=-1)
+    self.assertIsNone(DirectorySnapshotModel.GetFreshUserTuples(
+        _USER_DOMAIN, 'sam'))
+
+  def testExpiredSnapshotFallsBackToFreshShorterPrefix(self):
+    DirectorySnapshotModel.SetUserTuples(_USER_DOMAIN, 'sa', [])
+    snapshot = DirectorySnapshotModel.get_by_id('%s_sa' % _USER_DOMAIN)
+    snapshot.snapshot_datetime = (datetime.datetime.utcnow() -
+                                  2 * directory_snapshot._SNAPSHOT_MAX_AGE)
+    # Bypass auto_now to keep the old snapshot time.
+    DirectorySnapshotModel.snapshot_datetime._auto_now = False
+    try:
+      snapshot.put()
+    finally:
+      DirectorySnapshotModel.snapshot_datetime._auto_now = True
+    DirectorySnapshotModel.SetUserTuples(_USER_DOMAIN, 's', _USER_TUPLES)
+    self.assertEqual(_USER_TUPLES[:3],
+                     DirectorySnapshotModel.GetFreshUserTuples(
+                         _USER_DOMAIN, 'sa'))
+
+  def testLargePrefixIsNotKept(self):
+    directory_snapshot._SNAPSHOT_MAX_USER_COUNT = len(_USER_TUPLES) - 1
+    DirectorySnapshotModel.SetUserTuples(_USER_DOMAIN, 's', _USER_TUPLES)
+    self.assertIsNone(DirectorySnapshotModel.GetFreshUserTuples(
+        _USER_DOMAIN, 's'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -23,15 +23,27 @@ import unittest
 import setup_path  # pylint: disable=unused-import,g-bad-import-order
 
 from models.domain_user import DomainUserToCheckModel
+from models.domain_user import MakeUsersAddedCounterName
+from models.domain_user import MakeUsersTerminalCounterName
 from models.domain_user import MESSAGE_FOUND
+from models.domain_user import MESSAGE_PURGED
 from models.domain_user import MESSAGE_UNKNOWN
+from models.domain_user import USER_CONNECT_FAILED
+from models.domain_user import USER_DONE
+from models.domain_user import USER_RECALLING
 from models.domain_user import USER_STARTED
 from models.entity_state_updater import EntityStateUpdater
 from models.recall_task import RecallTaskModel
+from models.recall_task import TASK_DONE
 from models.recall_task import TASK_GETTING_USERS
+from models.recall_task import TASK_RECALLING
 from models.recall_task import TASK_STARTED
+from models.sharded_counter import GetCounterCount
+from models.sharded_counter import IncrementCounterAndGetCount
+from models.sharded_counter import IncrementCounters
 from test_utils import SetupLogging
 
+from google.appengine.api import memcache
 from google.appengine.ext import testbed
 
 
@@ -46,8 +58,8 @@ def _CreateRecallTaskEntity(owner_email, message_criteria):
 
 
 def _CreateDomainUserEntity(task_key_id, user_email):
-  return DomainUserToCheckModel(recall_task_id=task_key_id,
-                                user_email=user_email).put()
+  return DomainUserToCheckModel.CreateUserForTask(task_key_id=task_key_id,
+                                                  user_email=user_email).put()
 
 
 def _GetRecallTaskEntity(task_key):
@@ -102,6 +114,109 @@ class EntityStateUpdaterTests(unittest.TestCase):
     self.assertEqual(MESSAGE_FOUND,
                      _GetDomainUserEntity(self._user_key).message_state)
 
+  def testTerminalUserStateIsCounted(self):
+    state_updater = EntityStateUpdater(task_key_id=self._task_key.id(),
+                                       user_key_id=self._user_key.id())
+    state_updater.SetUserState(USER_DONE)
+    state_updater.SetUserState(USER_DONE)
+    self.assertEqual(1, GetCounterCount(
+        MakeUsersTerminalCounterName(self._task_key.id())))
+    self.assertEqual(TASK_STARTED,
+                     _GetRecallTaskEntity(self._task_key).task_state)
+
+  def testLastTerminalUserCompletesRecallingTask(self):
+    IncrementCounterAndGetCount(
+        MakeUsersAddedCounterName(self._task_key.id()))
+    state_updater = EntityStateUpdater(task_key_id=self._task_key.id(),
+                                       user_key_id=self._user_key.id())
+    state_updater.SetTaskState(TASK_RECALLING)
+    state_updater.SetUserState(USER_DONE)
+    task = _GetRecallTaskEntity(self._task_key)
+    self.assertEqual(TASK_DONE, task.task_state)
+    self.assertFalse(task.is_aborted)
+
+  def testLostUsersAddedCountIsConfirmedFromShards(self):
+    users_added_name = MakeUsersAddedCounterName(self._task_key.id())
+    IncrementCounters({users_added_name: 2})
+    memcache.set(users_added_name, 0)  # e.g. evicted then restarted at 0.
+    state_updater = EntityStateUpdater(task_key_id=self._task_key.id(),
+                                       user_key_id=self._user_key.id())
+    state_updater.SetTaskState(TASK_RECALLING)
+    state_updater.SetUserState(USER_DONE)
+    self.assertEqual(TASK_RECALLING,
+                     _GetRecallTaskEntity(self._task_key).task_state)
+
+  def testRecountRepairsOvercountedUsersAdded(self):
+    IncrementCounters({MakeUsersAddedCounterName(self._task_key.id()): 3})
+    state_updater = EntityStateUpdater(task_key_id=self._task_key.id(),
+                                       user_key_id=self._user_key.id())
+    state_updater.SetTaskState(TASK_RECALLING)
+    state_updater.SetUserState(USER_DONE)
+    self.assertFalse(RecallTaskModel.CompleteTaskIfUsersFinished(
+        self._task_key.id(), skip_cache=True))
+    self.assertEqual((1, 1), DomainUserToCheckModel.RecountUsersForTask(
+        self._task_key.id()))
+    self.assertTrue(RecallTaskModel.CompleteTaskIfUsersFinished(
+        self._task_key.id()))
+    self.assertEqual(TASK_DONE,
+                     _GetRecallTaskEntity(self._task_key).task_state)
+
+  def testStateCountsAreQueriedForTasksWithoutHistograms(self):
+    user_state_counts, message_state_counts = (
+        _GetRecallTaskEntity(self._task_key).GetStateCounts())
+    self.assertEqual(1, user_state_counts[USER_STARTED])
+    self.assertEqual(0, user_state_counts[USER_DONE])
+    self.assertEqual(1, message_state_counts[MESSAGE_UNKNOWN])
+
+  def testStateCountsFollowUserStates(self):
+    user = DomainUserToCheckModel.CreateUserForTask(
+        task_key_id=self._task_key.id(), user_email='other@mydomain.com')
+    DomainUserToCheckModel.PutNewUsers([user])
+    state_updater = EntityStateUpdater(task_key_id=self._task_key.id(),
+                                       user_key_id=user.key.id())
+    state_updater.SetMessageState(MESSAGE_FOUND)
+    state_updater.SetUserState(USER_DONE)
+    user_state_counts, message_state_counts = (
+        _GetRecallTaskEntity(self._task_key).GetStateCounts())
+    self.assertEqual(0, user_state_counts[USER_STARTED])
+    self.assertEqual(1, user_state_counts[USER_DONE])
+    self.assertEqual(0, message_state_counts[MESSAGE_UNKNOWN])
+    self.assertEqual(1, message_state_counts[MESSAGE_FOUND])
+
+  def testBufferedStatesAreWrittenOnFlush(self):
+    state_updater = EntityStateUpdater(task_key_id=self._task_key.id(),
+                                       user_key_id=self._user_key.id(),
+                                       buffer_states=True)
+    state_updater.SetUserState(USER_RECALLING)
+    state_updater.SetMessageState(MESSAGE_FOUND)
+    user = _GetDomainUserEntity(self._user_key)
+    self.assertEqual(USER_STARTED, user.user_state)
+    self.assertEqual(MESSAGE_UNKNOWN, user.message_state)
+    state_updater.Flush()
+    user = _GetDomainUserEntity(self._user_key)
+    self.assertEqual(USER_RECALLING, user.user_state)
+    self.assertEqual(MESSAGE_FOUND, user.message_state)
+
+  def testBufferedStatesAreWrittenAtCheckpoints(self):
+    state_updater = EntityStateUpdater(task_key_id=self._task_key.id(),
+                                       user_key_id=self._user_key.id(),
+                                       buffer_states=True,
+                                       checkpoint_states=[MESSAGE_PURGED])
+    state_updater.SetUserState(USER_RECALLING)
+    state_updater.SetMessageState(MESSAGE_PURGED)
+    user = _GetDomainUserEntity(self._user_key)
+    self.assertEqual(USER_RECALLING, user.user_state)
+    self.assertEqual(MESSAGE_PURGED, user.message_state)
+
+  def testBufferedTerminalUserStateIsKept(self):
+    with EntityStateUpdater(task_key_id=self._task_key.id(),
+                            user_key_id=self._user_key.id(),
+                            buffer_states=True) as state_updater:
+      state_updater.SetUserState(USER_CONNECT_FAILED)
+      state_updater.SetUserState(USER_DONE)
+    self.assertEqual(USER_CONNECT_FAILED,
+                     _GetDomainUserEntity(self._user_key).user_state)
+
 
 if __name__ == '__main__':
   unittest.main()
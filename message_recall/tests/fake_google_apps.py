@@ -0,0 +1,538 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process stand-ins for the Gmail IMAP server and the Admin SDK.
+
+FakeGmailServer keeps a mailbox per user with Gmail-like labels and hands out
+FakeGmailImap4 sessions in place of imaplib.IMAP4_SSL.  FakeDirectoryService
+answers Admin SDK directory users().list() requests from a synthetic domain.
+
+Both allow latency and errors to be injected so tests and benchmarks can
+exercise mail_api, user_retriever and the backend phases without network.
+"""
+
+import bisect
+import collections
+import imaplib
+import random
+import re
+import socket
+import threading
+import time
+
+
+ALL_MAIL_LABEL = '[Gmail]/All Mail'
+SPAM_LABEL = '[Gmail]/Spam'
+TRASH_LABEL = '[Gmail]/Trash'
+
+DEFAULT_CAPABILITIES = ('IMAP4REV1', 'UNSELECT', 'IDLE', 'NAMESPACE', 'QUOTA',
+                        'ID', 'XLIST', 'CHILDREN', 'X-GM-EXT-1', 'UIDPLUS',
+                        'COMPRESS=DEFLATE', 'ENABLE', 'MOVE', 'CONDSTORE',
+                        'ESEARCH', 'UTF8=ACCEPT', 'LIST-EXTENDED',
+                        'LIST-STATUS', 'LITERAL-', 'SPECIAL-USE', 'APPENDLIMIT')
+IMAP_DISABLED_ERROR = ('[ALERT] IMAP access is disabled for your domain. '
+                       'Please contact your domain administrator (Failure)')
+INVALID_CREDENTIALS_ERROR = '[ALERT] Invalid credentials (Failure)'
+
+_AUTH_STRING_REGEX = re.compile('^user=(.*)\x01auth=Bearer (.*)\x01\x01$')
+_FETCH_HEADER_FIELDS_REGEX = re.compile(r'HEADER\.FIELDS \(([^)]*)\)')
+_PRE_AUTH_CAPABILITIES = ('IMAP4REV1', 'AUTH=XOAUTH2', 'AUTH=PLAIN')
+_SEARCH_GM_MSGID_REGEX = re.compile(r'X-GM-MSGID (\d+)')
+_SEARCH_GM_RAW_REGEX = re.compile(r'rfc822msgid:([^\s{}"]+)')
+_SEARCH_HEADER_REGEX = re.compile(r'HEADER Message-ID <([^>]+)>',
+                                  re.IGNORECASE)
+
+FakeMessage = collections.namedtuple('FakeMessage',
+                                     'gm_msgid message_id headers')
+
+
+class FakeGmailServer(object):
+  """Mailboxes for many users and the behaviour shared by their sessions.
+
+  Each mailbox maps a label to an OrderedDict of uid to FakeMessage.  As in
+  Gmail, uids are per label and a message moved to Trash leaves every other
+  label.
+  """
+
+  def __init__(self, capabilities=DEFAULT_CAPABILITIES, latency_s=0.0,
+               error_rate=0.0, error_commands=None, imap_disabled_users=(),
+               seed=0):
+    """Initialize an empty server.
+
+    Args:
+      capabilities: Tuple of String capabilities advertised once
+                    authenticated.
+      latency_s: Float seconds each command sleeps.
+      error_rate: Float probability [0-1] that a command raises socket.error.
+      error_commands: Set of String commands which may fail (None for all).
+      imap_disabled_users: Sequence of String user emails that cannot
+                           authenticate because IMAP is disabled.
+      seed: Int seed of the random error injection.
+    """
+    self.capabilities = tuple(capabilities)
+    self.command_counts = collections.Counter()
+    self.latency_s = latency_s
+    self.error_rate = error_rate
+    self.error_commands = error_commands
+    self.imap_disabled_users = set(imap_disabled_users)
+    self.invalid_tokens = set()
+    self._lock = threading.Lock()
+    self._mailboxes = {}
+    self._next_gm_msgid = 1500000000000000000
+    self._random = random.Random(seed)
+
+  def _GetMailbox(self, user_email):
+    """Retrieve (or create) a user mailbox. Caller holds self._lock."""
+    mailbox = self._mailboxes.get(user_email)
+    if mailbox is None:
+      mailbox = _FakeMailbox()
+      self._mailboxes[user_email] = mailbox
+    return mailbox
+
+  def AddMessage(self, user_email, message_id, gmail_label=ALL_MAIL_LABEL,
+                 headers=None):
+    """Deliver a message to a user's mailbox.
+
+    Args:
+      user_email: String email address of the mailbox owner.
+      message_id: String message-id without the angle brackets.
+      gmail_label: String label the message is delivered to.
+      headers: Dictionary of String header name (e.g. 'To') to String value
+               for headers other than Message-ID.
+
+    Returns:
+      FakeMessage added.
+    """
+    with self._lock:
+      self._next_gm_msgid += 1
+      message = FakeMessage(str(self._next_gm_msgid), message_id,
+                            dict((name.upper(), value) for name, value
+                                 in (headers or {}).iteritems()))
+      self._GetMailbox(user_email).Append(gmail_label, message)
+    return message
+
+  def GetMessageIds(self, user_email, gmail_label=ALL_MAIL_LABEL):
+    """List the message-ids in one label of a user's mailbox.
+
+    Args:
+      user_email: String email address of the mailbox owner.
+      gmail_label: String label to list.
+
+    Returns:
+      List of String message-ids.
+    """
+    with self._lock:
+      return [message.message_id for message
+              in self._GetMailbox(user_email).labels[gmail_label].values()]
+
+  def CreateImap4(self, host=None, port=None):
+    """Factory to substitute for imaplib.IMAP4_SSL.
+
+    Args:
+      host: String ignored server address.
+      port: Int ignored server port.
+
+    Returns:
+      FakeGmailImap4 session attached to this server.
+    """
+    self.RunCommand('CONNECT')
+    return FakeGmailImap4(self, host, port)
+
+  def RunCommand(self, command, user_email=None, work_function=None):
+    """Apply latency and error injection then run a command atomically.
+
+    Args:
+      command: String IMAP command name (counted and maybe failed).
+      user_email: String mailbox owner passed to work_function.
+      work_function: Function(mailbox) run while the server is locked.
+
+    Returns:
+      Result of work_function or None.
+
+    Raises:
+      socket.error: If the error injection chose this command.
+    """
+    with self._lock:
+      self.command_counts[command] += 1
+      fail = (self.error_rate and
+              (self.error_commands is None or
+               command in self.error_commands) and
+              self._random.random() < self.error_rate)
+    if self.latency_s:
+      time.sleep(self.latency_s)
+    if fail:
+      raise socket.error('EOF')
+    if not work_function:
+      return None
+    with self._lock:
+      return work_function(self._GetMailbox(user_email))
+
+  def Install(self):
+    """Substitute this server's sessions for imaplib.IMAP4_SSL.
+
+    Returns:
+      The replaced imaplib.IMAP4_SSL to pass to Uninstall().
+    """
+    original_imap4_ssl = imaplib.IMAP4_SSL
+    imaplib.IMAP4_SSL = self.CreateImap4
+    return original_imap4_ssl
+
+  @staticmethod
+  def Uninstall(original_imap4_ssl):
+    """Restore imaplib.IMAP4_SSL replaced by Install()."""
+    imaplib.IMAP4_SSL = original_imap4_ssl
+
+
+class _FakeMailbox(object):
+  """Labels of a user's mailbox with per-label uids and deleted flags."""
+
+  def __init__(self):
+    self.labels = dict((gmail_label, collections.OrderedDict())
+                       for gmail_label in (ALL_MAIL_LABEL, SPAM_LABEL,
+                                           TRASH_LABEL))
+    self.deleted_uids = collections.defaultdict(set)
+    self._next_uids = collections.defaultdict(lambda: 1)
+
+  def Append(self, gmail_label, message):
+    """Add a message to a label with the next uid of that label."""
+    uid = str(self._next_uids[gmail_label])
+    self._next_uids[gmail_label] += 1
+    self.labels[gmail_label][uid] = message
+
+  def Expunge(self, gmail_label):
+    """Remove the messages flagged \\Deleted from a label."""
+    for uid in self.deleted_uids.pop(gmail_label, ()):
+      self.labels[gmail_label].pop(uid, None)
+
+  def Trash(self, message):
+    """Gmail semantics: a message in Trash has no other labels."""
+    for gmail_label, messages in self.labels.iteritems():
+      if gmail_label == TRASH_LABEL:
+        continue
+      for uid, other_message in messages.items():
+        if other_message.gm_msgid == message.gm_msgid:
+          del messages[uid]
+    self.Append(TRASH_LABEL, message)
+
+
+class FakeGmailImap4(object):
+  """Stands in for an imaplib.IMAP4_SSL session with a FakeGmailServer.
+
+  Implements the subset of the imaplib interface used by mail_api with
+  responses shaped like imaplib's.  Search arguments imaplib would quote are
+  rejected, as Gmail rejects the quoted query.
+  """
+
+  def __init__(self, server, host, port):
+    self.capabilities = _PRE_AUTH_CAPABILITIES
+    self.debug = 0
+    self.host = host
+    self.port = port
+    self._selected_label = None
+    self._server = server
+    self._user_email = None
+
+  def _Run(self, command, work_function=None, needs_label=False):
+    """Check session state then run a command on the server."""
+    if not self._user_email:
+      raise imaplib.IMAP4.error('%s illegal in state NONAUTH' % command)
+    if needs_label and not self._selected_label:
+      raise imaplib.IMAP4.error('%s illegal in state AUTH' % command)
+    return self._server.RunCommand(command, self._user_email, work_function)
+
+  @staticmethod
+  def _CheckNotQuoted(arg):
+    """Reject arguments which imaplib would send as a quoted string."""
+    if (len(arg) >= 2 and (arg[0], arg[-1]) in (('(', ')'), ('"', '"')) or
+        not imaplib.IMAP4.mustquote.search(arg)):
+      return
+    raise imaplib.IMAP4.error('SEARCH command error: BAD [Could not parse '
+                              'command]')
+
+  @staticmethod
+  def _ParseUidSet(uid_set):
+    """Expand a comma separated uid set (with n:m ranges) to a set."""
+    uids = set()
+    for uid_range in uid_set.split(','):
+      first, unused_sep, last = uid_range.partition(':')
+      uids.update(str(uid) for uid in range(int(first), int(last or first) + 1))
+    return uids
+
+  def authenticate(self, mechanism, authobject):  # pylint: disable=g-bad-name
+    auth_match = _AUTH_STRING_REGEX.match(authobject(None))
+    if mechanism != 'XOAUTH2' or not auth_match:
+      raise imaplib.IMAP4.error('[AUTHENTICATIONFAILED] Invalid arguments')
+    user_email, access_token = auth_match.groups()
+    self._server.RunCommand('AUTHENTICATE')
+    if user_email in self._server.imap_disabled_users:
+      raise imaplib.IMAP4.error(IMAP_DISABLED_ERROR)
+    if access_token in self._server.invalid_tokens:
+      raise imaplib.IMAP4.error(INVALID_CREDENTIALS_ERROR)
+    self._user_email = user_email
+    return 'OK', ['%s authenticated (Success)' % user_email]
+
+  def capability(self):  # pylint: disable=g-bad-name
+    self._server.RunCommand('CAPABILITY')
+    capabilities = (self._server.capabilities if self._user_email else
+                    _PRE_AUTH_CAPABILITIES)
+    return 'OK', [' '.join(capabilities)]
+
+  def select(self, mailbox='INBOX'):  # pylint: disable=g-bad-name
+    def _Select(user_mailbox):
+      if mailbox not in user_mailbox.labels:
+        return 'NO', ['[NONEXISTENT] Unknown Mailbox: %s (Failure)' % mailbox]
+      self._selected_label = mailbox
+      return 'OK', [str(len(user_mailbox.labels[mailbox]))]
+    return self._Run('SELECT', _Select)
+
+  def uid(self, command, *args):  # pylint: disable=g-bad-name
+    command = command.upper()
+    if command == 'SEARCH':
+      return self._Search([arg for arg in args if arg is not None])
+    if command == 'FETCH':
+      return self._Fetch(*args)
+    if command in ('COPY', 'MOVE'):
+      return self._Transfer(command, *args)
+    if command == 'STORE':
+      return self._Store(*args)
+    raise imaplib.IMAP4.error('Unknown IMAP4 UID command: %s' % command)
+
+  def _Search(self, args):
+    for arg in args:
+      self._CheckNotQuoted(arg)
+    criteria = ' '.join(args)
+    if 'X-GM-RAW' in criteria:
+      match_attribute = 'message_id'
+      search_values = set(_SEARCH_GM_RAW_REGEX.findall(criteria))
+    elif 'X-GM-MSGID' in criteria:
+      match_attribute = 'gm_msgid'
+      search_values = set(_SEARCH_GM_MSGID_REGEX.findall(criteria))
+    else:
+      match_attribute = 'message_id'
+      search_values = set(_SEARCH_HEADER_REGEX.findall(criteria))
+
+    def _SearchLabel(user_mailbox):
+      return 'OK', [' '.join(
+          uid for uid, message
+          in user_mailbox.labels[self._selected_label].iteritems()
+          if getattr(message, match_attribute) in search_values)]
+    return self._Run('UID SEARCH', _SearchLabel, needs_label=True)
+
+  def _Fetch(self, uid_set, message_parts):
+    uids = self._ParseUidSet(uid_set)
+    fetch_gm_msgid = 'X-GM-MSGID' in message_parts
+    header_fields_match = _FETCH_HEADER_FIELDS_REGEX.search(message_parts)
+
+    def _FetchLabel(user_mailbox):
+      data = []
+      for sequence_number, (uid, message) in enumerate(
+          user_mailbox.labels[self._selected_label].iteritems(), 1):
+        if uid not in uids:
+          continue
+        response = '%d (UID %s' % (sequence_number, uid)
+        if fetch_gm_msgid:
+          response += ' X-GM-MSGID %s' % message.gm_msgid
+        if header_fields_match:
+          header = self._FormatHeaders(message,
+                                       header_fields_match.group(1).split())
+          data.append(('%s BODY[HEADER.FIELDS (%s)] {%d}' % (
+              response, header_fields_match.group(1), len(header)), header))
+          data.append(')')
+        else:
+          data.append(response + ')')
+      return 'OK', data
+    return self._Run('UID FETCH', _FetchLabel, needs_label=True)
+
+  @staticmethod
+  def _FormatHeaders(message, header_fields):
+    """Format the requested header fields of a message as fetched."""
+    header_lines = []
+    for header_field in header_fields:
+      if header_field.upper() == 'MESSAGE-ID':
+        header_lines.append('Message-ID: <%s>' % message.message_id)
+      elif header_field.upper() in message.headers:
+        header_lines.append('%s: %s' % (header_field.title(),
+                                        message.headers[header_field.upper()]))
+    return '\r\n'.join(header_lines + ['', ''])
+
+  def _Transfer(self, command, uid_set, gmail_label):
+    uids = self._ParseUidSet(uid_set)
+    if command == 'MOVE' and 'MOVE' not in self._server.capabilities:
+      raise imaplib.IMAP4.error('UID command error: BAD [Could not parse '
+                                'command]')
+
+    def _TransferLabel(user_mailbox):
+      if gmail_label not in user_mailbox.labels:
+        return 'NO', ['[TRYCREATE] No folder %s (Failure)' % gmail_label]
+      messages = user_mailbox.labels[self._selected_label]
+      for uid in [uid for uid in messages if uid in uids]:
+        message = messages[uid]
+        if gmail_label == TRASH_LABEL:
+          user_mailbox.Trash(message)
+        else:
+          user_mailbox.Append(gmail_label, message)
+          if command == 'MOVE':
+            del messages[uid]
+      return 'OK', ['(Success)']
+    return self._Run('UID ' + command, _TransferLabel, needs_label=True)
+
+  def _Store(self, uid_set, flag_command, flags):
+    uids = self._ParseUidSet(uid_set)
+    if flag_command != '+FLAGS' or flags != '\\Deleted':
+      raise imaplib.IMAP4.error('Unsupported STORE %s %s' % (flag_command,
+                                                              flags))
+
+    def _StoreLabel(user_mailbox):
+      user_mailbox.deleted_uids[self._selected_label].update(
+          uid for uid in user_mailbox.labels[self._selected_label]
+          if uid in uids)
+      return 'OK', []
+    return self._Run('UID STORE', _StoreLabel, needs_label=True)
+
+  def expunge(self):  # pylint: disable=g-bad-name
+    def _Expunge(user_mailbox):
+      user_mailbox.Expunge(self._selected_label)
+      return 'OK', [None]
+    return self._Run('EXPUNGE', _Expunge, needs_label=True)
+
+  def close(self):  # pylint: disable=g-bad-name
+    def _Close(user_mailbox):
+      user_mailbox.Expunge(self._selected_label)
+      self._selected_label = None
+      return 'OK', ['Returned to authenticated state. (Success)']
+    return self._Run('CLOSE', _Close, needs_label=True)
+
+  def noop(self):  # pylint: disable=g-bad-name
+    self._Run('NOOP')
+    return 'OK', ['Success']
+
+  def logout(self):  # pylint: disable=g-bad-name
+    self._server.RunCommand('LOGOUT')
+    self._user_email = None
+    self._selected_label = None
+    return 'BYE', ['LOGOUT Requested']
+
+  def shutdown(self):  # pylint: disable=g-bad-name
+    self._server.RunCommand('SHUTDOWN')
+    self._user_email = None
+    self._selected_label = None
+
+
+class FakeDirectoryService(object):
+  """Stands in for the Admin SDK directory service from apiclient build().
+
+  Holds a synthetic domain and answers users().list() with the query, paging
+  and response shapes used by user_retriever.
+  """
+
+  def __init__(self, user_tuples, latency_s=0.0):
+    """Initialize the domain.
+
+    Args:
+      user_tuples: List of tuples (1 for each user) with a String email
+                   address and a Boolean suspended flag.
+      latency_s: Float seconds each request sleeps.
+    """
+    self.latency_s = latency_s
+    self.request_count = 0
+    self._lock = threading.Lock()
+    self._user_tuples = sorted(user_tuples)
+    self._user_emails = [user_email for user_email, unused_suspended
+                         in self._user_tuples]
+
+  def users(self):  # pylint: disable=g-bad-name
+    return self
+
+  def list(self, domain=None, maxResults=100,  # pylint: disable=g-bad-name
+           query='', pageToken=None, **unused_kwargs):
+    """Build a request for one page of users matching 'email:prefix*'."""
+    email_query = query.partition('email:')[2].replace("\\'", "'")
+    if email_query.endswith('*'):
+      first = bisect.bisect_left(self._user_emails, email_query[:-1])
+      last = bisect.bisect_left(self._user_emails, email_query[:-1] + '\xff')
+    else:
+      first = bisect.bisect_left(self._user_emails, email_query)
+      last = bisect.bisect_right(self._user_emails, email_query)
+    first += int(pageToken or 0)
+    page_end = min(first + maxResults, last)
+    return _FakeDirectoryRequest(self, self._user_tuples[first:page_end],
+                                 (str(int(pageToken or 0) + maxResults)
+                                  if page_end < last else None))
+
+  def Execute(self, response):
+    """Count and delay one request execution."""
+    with self._lock:
+      self.request_count += 1
+    if self.latency_s:
+      time.sleep(self.latency_s)
+    return response
+
+
+class _FakeDirectoryRequest(object):
+  """Stands in for an apiclient HttpRequest of users().list()."""
+
+  def __init__(self, directory_service, user_tuples, next_page_token):
+    self._directory_service = directory_service
+    self._response = {'users': [{'primaryEmail': user_email,
+                                 'suspended': suspended}
+                                for user_email, suspended in user_tuples]}
+    if next_page_token:
+      self._response['nextPageToken'] = next_page_token
+
+  def execute(self, http=None):  # pylint: disable=g-bad-name
+    return self._directory_service.Execute(self._response)
+
+
+def MakeSyntheticDomainUsers(user_domain, user_count, suspended_ratio=0.01,
+                             seed=0):
+  """Generate users with a realistic spread of email address prefixes.
+
+  Args:
+    user_domain: String domain of the user emails.
+    user_count: Int number of users.
+    suspended_ratio: Float fraction [0-1] of users which are suspended.
+    seed: Int random seed so domains are repeatable.
+
+  Returns:
+    List of tuples (1 for each user) with a String email address and a
+    Boolean suspended flag.
+  """
+  rand = random.Random(seed)
+  first_chars = 'abcdefghijklmnopqrstuvwxyz0123456789'
+  # Latin names cluster on a few first letters: weight them like that.
+  first_char_weights = [8, 6, 7, 6, 4, 3, 4, 3, 2, 9, 5, 5, 9, 4, 2, 5, 1, 5,
+                        9, 5, 1, 2, 2, 1, 1, 1] + [1] * 10
+  user_tuples = []
+  user_emails = set()
+  while len(user_tuples) < user_count:
+    first_char = first_chars[_WeightedChoice(rand, first_char_weights)]
+    local_part = first_char + ''.join(
+        rand.choice('abcdefghijklmnopqrstuvwxyz0123456789._-')
+        for unused_i in range(rand.randint(3, 12)))
+    user_email = '%s@%s' % (local_part.rstrip('.'), user_domain)
+    if user_email in user_emails:
+      continue
+    user_emails.add(user_email)
+    user_tuples.append((user_email, rand.random() < suspended_ratio))
+  return user_tuples
+
+
+def _WeightedChoice(rand, weights):
+  """Pick an index with probability proportional to its weight."""
+  target = rand.uniform(0, sum(weights))
+  for index, weight in enumerate(weights):
+    target -= weight
+    if target <= 0:
+      return index
+  return len(weights) - 1
@@ -0,0 +1,108 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of signed JWT assertions minted for many users.
+
+Compares parsing the service account key for every assertion (as each token
+refresh used to) with delegated credentials sharing one parsed key.  Needs
+PyCrypto (as deployed) to generate a throwaway key.
+
+Not named *_test.py so run_tests.py does not pick it up. Run it with:
+
+  python tests/jwt_assertion_benchmark.py --assertion_count 1000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+
+_APP_BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SERVICE_ACCOUNT_NAME = 'benchmark@developer.gserviceaccount.com'
+_SCOPE = 'https://mail.google.com/'
+_USER_EMAIL_FORMAT = 'user%d@benchmark-domain.com'
+
+
+def _ParseArgs(argv):
+  """Handle command line args unique to this script.
+
+  Args:
+    argv: holds all the command line args passed.
+
+  Returns:
+    argparser args object with attributes set based on arg settings.
+  """
+  argparser = argparse.ArgumentParser(description=('Benchmark minting signed '
+                                                   'JWT assertions.'))
+  argparser.add_argument('--assertion_count', type=int, default=1000,
+                         help='Number of assertions (users) to mint.')
+  argparser.add_argument('--key_bits', type=int, default=2048,
+                         help='Size of the generated RSA key.')
+  return argparser.parse_args(argv)
+
+
+def _TimeAssertions(mint_function, assertion_count):
+  """Time minting one assertion per user.
+
+  Args:
+    mint_function: Function minting an assertion given a user email.
+    assertion_count: Int number of assertions to mint.
+
+  Returns:
+    Float assertions per second.
+  """
+  start_time = time.time()
+  for user_index in range(assertion_count):
+    mint_function(_USER_EMAIL_FORMAT % user_index)
+  return assertion_count / (time.time() - start_time)
+
+
+def main(argv):
+  args = _ParseArgs(argv)
+  sys.path.insert(0, os.path.join(_APP_BASE_PATH, 'lib'))
+  # pylint: disable=g-import-not-at-top
+  from Crypto.PublicKey import RSA
+  from oauth2client import client
+  from oauth2client import crypt
+  # pylint: enable=g-import-not-at-top
+  private_key = RSA.generate(args.key_bits).exportKey()
+  credentials = client.SignedJwtAssertionCredentials(
+      service_account_name=_SERVICE_ACCOUNT_NAME,
+      private_key=private_key,
+      scope=_SCOPE)
+
+  def _MintParsingKey(user_email):
+    payload = {'aud': client.GOOGLE_TOKEN_URI, 'scope': _SCOPE,
+               'iat': long(time.time()), 'iss': _SERVICE_ACCOUNT_NAME,
+               'sub': user_email}
+    return crypt.make_signed_jwt(crypt.Signer.from_string(private_key),
+                                 payload)
+
+  def _MintDelegated(user_email):
+    # pylint: disable=protected-access
+    return credentials.create_delegated(user_email)._generate_assertion()
+
+  print '%d assertions with a %d bit key:' % (args.assertion_count,
+                                              args.key_bits)
+  for mint_name, mint_function in (('key parsed per assertion',
+                                    _MintParsingKey),
+                                   ('delegated, shared signer',
+                                    _MintDelegated)):
+    print '  %-26s %9.1f assertions/s' % (
+        mint_name, _TimeAssertions(mint_function, args.assertion_count))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,200 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the GmailHelper class.
+
+Tests recalling messages against an in-process fake Gmail IMAP server.
+"""
+
+import socket
+import unittest
+
+# setup_path required to allow imports from models.
+import setup_path  # pylint: disable=unused-import,g-bad-import-order
+
+from fake_google_apps import ALL_MAIL_LABEL
+from fake_google_apps import FakeGmailServer
+from fake_google_apps import SPAM_LABEL
+from fake_google_apps import TRASH_LABEL
+import mail_api
+from models.domain_user import DomainUserToCheckModel
+from models.domain_user import MESSAGE_FOUND
+from models.domain_user import MESSAGE_NOT_FOUND
+from models.domain_user import MESSAGE_VERIFIED_PURGED
+from models.domain_user import USER_DONE
+from models.domain_user import USER_IMAP_DISABLED
+from models.domain_user import USER_RECALLING
+from models.recall_task import RecallTaskModel
+from oauth2client.client import AccessTokenRefreshError
+from recall_errors import MessageRecallGmailError
+from test_utils import SetupLogging
+
+from google.appengine.ext import testbed
+
+
+_MESSAGE_ID_1 = 'CAOkEN4ZZ33ETLNd8dkrJcNJN1qDE@mail.gmail.com'
+_MESSAGE_ID_2 = 'CAOkEN4YY9xVm1iZgurm37V31EoO9SZz@mail.gmail.com'
+# Holds _MESSAGE_ID_1 whole.
+_OVERLAPPING_MESSAGE_ID = '1' + _MESSAGE_ID_1
+_OTHER_MESSAGE_ID = 'CAOkEN4XXcOU69xVm1iZgurm37V31Eo@mail.gmail.com'
+_OWNER_EMAIL = 'admin@mydomain.com'
+_USER_EMAIL = 'testuser@mydomain.com'
+
+
+class GmailHelperTest(unittest.TestCase):
+
+  def setUp(self):
+    SetupLogging()
+    self._testbed = testbed.Testbed()
+    self._testbed.activate()
+    self._testbed.init_datastore_v3_stub()
+    self._testbed.init_memcache_stub()
+
+    self._gmail_server = FakeGmailServer()
+    self._original_imap4_ssl = self._gmail_server.Install()
+    self._original_get_access_token = mail_api.GetUserAccessToken
+    mail_api.GetUserAccessToken = (
+        lambda user_email, force_refresh=False: 'access_token')
+    self._original_pool = mail_api._GMAIL_INTERFACE_POOL
+    mail_api._GMAIL_INTERFACE_POOL = mail_api.GmailInterfacePool(
+        max_size=2, idle_timeout_s=60, max_age_s=60)
+
+    self._message_criteria = '%s %s' % (_MESSAGE_ID_1, _MESSAGE_ID_2)
+    self._task_key_id = RecallTaskModel(
+        owner_email=_OWNER_EMAIL,
+        message_criteria=self._message_criteria).put().id()
+    self._user_key_id = DomainUserToCheckModel.CreateUserForTask(
+        task_key_id=self._task_key_id, user_email=_USER_EMAIL).put().id()
+
+  def tearDown(self):
+    mail_api._GMAIL_INTERFACE_POOL = self._original_pool
+    mail_api.GetUserAccessToken = self._original_get_access_token
+    FakeGmailServer.Uninstall(self._original_imap4_ssl)
+    self._testbed.deactivate()
+
+  def _RecallMessages(self):
+    with mail_api.GmailHelper(self._task_key_id, self._user_key_id,
+                              _USER_EMAIL, self._message_criteria) as helper:
+      if helper.CheckIfMessageExists():
+        helper.DeleteMessage()
+
+  def _GetUser(self):
+    return DomainUserToCheckModel.get_by_id(self._user_key_id)
+
+  def _GetMessageIdStates(self):
+    return dict((message_result.message_id, message_result.message_state)
+                for message_result in self._GetUser().message_results)
+
+  def testFoundMessagesArePurgedFromAllLabels(self):
+    self._gmail_server.AddMessage(_USER_EMAIL, _MESSAGE_ID_1)
+    self._gmail_server.AddMessage(_USER_EMAIL, _MESSAGE_ID_2, SPAM_LABEL)
+    self._gmail_server.AddMessage(_USER_EMAIL, _OTHER_MESSAGE_ID)
+    self._RecallMessages()
+    self.assertEqual([_OTHER_MESSAGE_ID],
+                     self._gmail_server.GetMessageIds(_USER_EMAIL))
+    self.assertEqual([], self._gmail_server.GetMessageIds(_USER_EMAIL,
+                                                          SPAM_LABEL))
+    self.assertEqual([], self._gmail_server.GetMessageIds(_USER_EMAIL,
+                                                          TRASH_LABEL))
+    user = self._GetUser()
+    self.assertEqual(USER_DONE, user.user_state)
+    self.assertEqual(MESSAGE_VERIFIED_PURGED, user.message_state)
+    self.assertEqual({_MESSAGE_ID_1: MESSAGE_VERIFIED_PURGED,
+                      _MESSAGE_ID_2: MESSAGE_VERIFIED_PURGED},
+                     self._GetMessageIdStates())
+
+  def testMissingMessagesAreNotFound(self):
+    self._gmail_server.AddMessage(_USER_EMAIL, _OTHER_MESSAGE_ID)
+    self._RecallMessages()
+    user = self._GetUser()
+    self.assertEqual(USER_DONE, user.user_state)
+    self.assertEqual(MESSAGE_NOT_FOUND, user.message_state)
+    self.assertEqual([_OTHER_MESSAGE_ID],
+                     self._gmail_server.GetMessageIds(_USER_EMAIL))
+
+  def testMessagesArePurgedWithoutGmailExtensions(self):
+    self._gmail_server.capabilities = ('IMAP4REV1', 'UIDPLUS')
+    self._gmail_server.AddMessage(_USER_EMAIL, _MESSAGE_ID_1)
+    self._gmail_server.AddMessage(_USER_EMAIL, _MESSAGE_ID_1, TRASH_LABEL)
+    self._gmail_server.AddMessage(_USER_EMAIL, _MESSAGE_ID_2, SPAM_LABEL)
+    self._RecallMessages()
+    for gmail_label in (ALL_MAIL_LABEL, SPAM_LABEL, TRASH_LABEL):
+      self.assertEqual([], self._gmail_server.GetMessageIds(_USER_EMAIL,
+                                                            gmail_label))
+    self.assertEqual(MESSAGE_VERIFIED_PURGED, self._GetUser().message_state)
+    self.assertEqual(0, self._gmail_server.command_counts['UID MOVE'])
+
+  def testOverlappingMessageIdsAreToldApart(self):
+    self._message_criteria = '%s %s' % (_MESSAGE_ID_1, _OVERLAPPING_MESSAGE_ID)
+    self._gmail_server.AddMessage(_USER_EMAIL, _OVERLAPPING_MESSAGE_ID)
+    self._RecallMessages()
+    self.assertEqual([], self._gmail_server.GetMessageIds(_USER_EMAIL))
+    self.assertEqual({_MESSAGE_ID_1: MESSAGE_NOT_FOUND,
+                      _OVERLAPPING_MESSAGE_ID: MESSAGE_VERIFIED_PURGED},
+                     self._GetMessageIdStates())
+
+  def testUserInterruptedWhilePurgingIsRecalledAgain(self):
+    self._gmail_server.AddMessage(_USER_EMAIL, _MESSAGE_ID_1)
+    self._gmail_server.error_commands = set(['UID MOVE'])
+    self._gmail_server.error_rate = 1.0
+    self.assertRaises(socket.error, self._RecallMessages)
+    user = self._GetUser()
+    self.assertEqual(USER_RECALLING, user.user_state)
+    self.assertEqual(MESSAGE_FOUND, user.message_state)
+    self._gmail_server.error_rate = 0.0
+    self._RecallMessages()
+    self.assertEqual([], self._gmail_server.GetMessageIds(_USER_EMAIL))
+    user = self._GetUser()
+    self.assertEqual(USER_DONE, user.user_state)
+    self.assertEqual(MESSAGE_VERIFIED_PURGED, user.message_state)
+
+  def testImapDisabledUserIsRecorded(self):
+    self._gmail_server.imap_disabled_users.add(_USER_EMAIL)
+    self.assertRaises(MessageRecallGmailError, self._RecallMessages)
+    self.assertEqual(USER_IMAP_DISABLED, self._GetUser().user_state)
+    self.assertEqual(1, self._gmail_server.command_counts['SHUTDOWN'])
+
+  def testSessionIsReusedForSameUser(self):
+    self._RecallMessages()
+    self._RecallMessages()
+    self.assertEqual(1, self._gmail_server.command_counts['AUTHENTICATE'])
+
+  def testRecipientsAreReadFromSenderCopy(self):
+    self._gmail_server.AddMessage(
+        _OWNER_EMAIL, _MESSAGE_ID_1,
+        headers={'To': 'Test User <%s>' % _USER_EMAIL,
+                 'Cc': 'group@mydomain.com, outsider@example.com',
+                 'Bcc': 'hidden@mydomain.com'})
+    self._gmail_server.AddMessage(_OWNER_EMAIL, _MESSAGE_ID_2,
+                                  headers={'To': 'Other@mydomain.com'})
+    self.assertEqual(
+        set([_USER_EMAIL, 'group@mydomain.com', 'outsider@example.com',
+             'hidden@mydomain.com', 'other@mydomain.com']),
+        mail_api.GetMessageRecipients(_OWNER_EMAIL, self._message_criteria))
+
+  def testRecipientsOfOverlappingMessageIdsAreRead(self):
+    self._gmail_server.AddMessage(_OWNER_EMAIL, _MESSAGE_ID_1,
+                                  headers={'To': _USER_EMAIL})
+    self._gmail_server.AddMessage(_OWNER_EMAIL, _OVERLAPPING_MESSAGE_ID,
+                                  headers={'To': 'other@mydomain.com'})
+    self.assertEqual(
+        set([_USER_EMAIL, 'other@mydomain.com']),
+        mail_api.GetMessageRecipients(
+            _OWNER_EMAIL, '%s %s' % (_MESSAGE_ID_1, _OVERLAPPING_MESSAGE_ID)))
+
+  def testRecipientsNeedACopyOfEachMessage(self):
+    self._gmail_server.AddMessage(_OWNER_EMAIL, _MESSAGE_ID_1,
+                                  headers={'To': _USER_EMAIL})
+    self.assertIsNone(
+        mail_api.GetMessageRecipients(_OWNER_EMAIL, self._message_criteria))
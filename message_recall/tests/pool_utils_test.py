@@ -0,0 +1,124 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the LruCache and IdlePool classes.
+
+Tests the eviction and expiry of per-instance caches and idle pools.
+"""
+
+import unittest
+
+# setup_path required to allow imports from the application.
+import setup_path  # pylint: disable=unused-import,g-bad-import-order
+
+from pool_utils import IdlePool
+from pool_utils import LruCache
+from test_utils import SetupLogging
+
+
+class _FakeConnection(object):
+  """Connection recording whether it was closed."""
+
+  def __init__(self, is_healthy=True):
+    self.is_closed = False
+    self.is_healthy = is_healthy
+
+
+class _FakeIdlePool(IdlePool):
+  """Pool of fake connections."""
+
+  def _Close(self, connection):
+    connection.is_closed = True
+
+  def _IsReusable(self, connection):
+    return connection.is_healthy
+
+
+class LruCacheTests(unittest.TestCase):
+
+  def setUp(self):
+    SetupLogging()
+    self._cache = LruCache(max_size=2)
+
+  def testMissingKeyIsNone(self):
+    self.assertIsNone(self._cache.Get('a'))
+    self.assertIsNone(self._cache.Pop('a'))
+
+  def testLeastRecentlyUsedIsDropped(self):
+    self._cache.Set('a', 1)
+    self._cache.Set('b', 2)
+    self.assertEqual(1, self._cache.Get('a'))
+    self.assertEqual([2], self._cache.Set('c', 3))
+    self.assertIsNone(self._cache.Get('b'))
+    self.assertEqual(1, self._cache.Get('a'))
+    self.assertEqual(3, self._cache.Get('c'))
+
+  def testReplacedValueIsDropped(self):
+    self._cache.Set('a', 1)
+    self.assertEqual([1], self._cache.Set('a', 2))
+    self.assertEqual(2, self._cache.Get('a'))
+
+  def testPoppedKeyIsRemoved(self):
+    self._cache.Set('a', 1)
+    self.assertEqual(1, self._cache.Pop('a'))
+    self.assertIsNone(self._cache.Get('a'))
+
+
+class IdlePoolTests(unittest.TestCase):
+
+  def setUp(self):
+    SetupLogging()
+    self._pool = _FakeIdlePool(max_keys=2, max_idle_per_key=2,
+                               idle_timeout_s=60)
+
+  def testMostRecentlyReleasedIsLeasedFirst(self):
+    first_connection = _FakeConnection()
+    second_connection = _FakeConnection()
+    self._pool.ReleaseIdle('a', first_connection)
+    self._pool.ReleaseIdle('a', second_connection)
+    self.assertIs(second_connection, self._pool.LeaseIdle('a'))
+    self.assertIs(first_connection, self._pool.LeaseIdle('a'))
+    self.assertIsNone(self._pool.LeaseIdle('a'))
+
+  def testOldestConnectionOfKeyIsClosedBeyondMaxIdle(self):
+    connections = [_FakeConnection() for unused_index in xrange(3)]
+    for connection in connections:
+      self._pool.ReleaseIdle('a', connection)
+    self.assertEqual([True, False, False],
+                     [connection.is_closed for connection in connections])
+
+  def testLeastRecentlyUsedKeyIsClosedBeyondMaxKeys(self):
+    connections = [_FakeConnection() for unused_index in xrange(3)]
+    for key, connection in zip('abc', connections):
+      self._pool.ReleaseIdle(key, connection)
+    self.assertTrue(connections[0].is_closed)
+    self.assertIsNone(self._pool.LeaseIdle('a'))
+    self.assertIs(connections[2], self._pool.LeaseIdle('c'))
+
+  def testExpiredConnectionIsClosed(self):
+    pool = _FakeIdlePool(max_keys=2, max_idle_per_key=2, idle_timeout_s=-1)
+    connection = _FakeConnection()
+    pool.ReleaseIdle('a', connection)
+    self.assertIsNone(pool.LeaseIdle('a'))
+    self.assertTrue(connection.is_closed)
+
+  def testUnhealthyConnectionIsClosed(self):
+    connection = _FakeConnection(is_healthy=False)
+    self._pool.ReleaseIdle('a', connection)
+    self.assertIsNone(self._pool.LeaseIdle('a'))
+    self.assertTrue(connection.is_closed)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,91 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the RateLimiter class.
+
+Tests that request rate limits are shared through memcache.
+"""
+
+import time
+import unittest
+
+# setup_path required to allow imports from the application.
+import setup_path  # pylint: disable=unused-import,g-bad-import-order
+
+from rate_limiter import GetRateLimiter
+from rate_limiter import RateLimiter
+from test_utils import SetupLogging
+
+from google.appengine.ext import testbed
+
+
+_BUCKET_NAME = 'admin_sdk_mydomain.com'
+_WINDOW = 1400000000
+
+
+class RateLimiterTests(unittest.TestCase):
+
+  def setUp(self):
+    SetupLogging()
+    self._testbed = testbed.Testbed()
+    self._testbed.activate()
+    self._testbed.init_memcache_stub()
+
+  def tearDown(self):
+    self._testbed.deactivate()
+
+  def testTokensAreSharedByInstances(self):
+    first_limiter = RateLimiter(_BUCKET_NAME, requests_per_s=5,
+                                prefetch_count=2)
+    second_limiter = RateLimiter(_BUCKET_NAME, requests_per_s=5,
+                                 prefetch_count=2)
+    self.assertEqual(2, first_limiter._TakeTokens(_WINDOW, True))
+    self.assertEqual(2, second_limiter._TakeTokens(_WINDOW, True))
+    self.assertEqual(1, first_limiter._TakeTokens(_WINDOW, False))
+    self.assertEqual(0, second_limiter._TakeTokens(_WINDOW, False))
+
+  def testTokensAreRefilledEachWindow(self):
+    limiter = RateLimiter(_BUCKET_NAME, requests_per_s=2, prefetch_count=2)
+    self.assertEqual(2, limiter._TakeTokens(_WINDOW, True))
+    self.assertEqual(0, limiter._TakeTokens(_WINDOW, False))
+    self.assertEqual(2, limiter._TakeTokens(_WINDOW + 1, True))
+
+  def testBucketsAreIndependent(self):
+    limiter = RateLimiter(_BUCKET_NAME, requests_per_s=2, prefetch_count=2)
+    other_limiter = RateLimiter('admin_sdk_otherdomain.com',
+                                requests_per_s=2, prefetch_count=2)
+    self.assertEqual(2, limiter._TakeTokens(_WINDOW, True))
+    self.assertEqual(2, other_limiter._TakeTokens(_WINDOW, True))
+
+  def testPrefetchIsCappedByRequestRate(self):
+    limiter = RateLimiter(_BUCKET_NAME, requests_per_s=2, prefetch_count=5)
+    self.assertEqual(2, limiter._TakeTokens(_WINDOW, True))
+
+  def testRequestsBeyondRateWaitForNextSecond(self):
+    limiter = RateLimiter(_BUCKET_NAME, requests_per_s=3, prefetch_count=1)
+    acquire_windows = []
+    for unused_index in xrange(4):
+      limiter.Acquire()
+      acquire_windows.append(int(time.time()))
+    self.assertLess(acquire_windows[0], acquire_windows[-1])
+
+  def testRateLimiterIsSharedByRecalls(self):
+    limiter = GetRateLimiter(_BUCKET_NAME, requests_per_s=3,
+                             prefetch_count=1)
+    self.assertIs(limiter, GetRateLimiter(_BUCKET_NAME, requests_per_s=3,
+                                          prefetch_count=1))
+
+
+if __name__ == '__main__':
+  unittest.main()
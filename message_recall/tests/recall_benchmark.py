@@ -0,0 +1,256 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""End-to-end benchmark of a message recall against fake Google services.
+
+Runs the backend phases (Phase1-4) with GAE testbed stubs for synthetic
+domains, using fake_google_apps for the Admin SDK and Gmail IMAP.  Queued
+tasks are run in order (ignoring their countdown) until the recall finishes.
+Reports users/sec and the wall time spent in each phase.
+
+Not named *_test.py so run_tests.py does not pick it up. Run it with:
+
+  python tests/recall_benchmark.py --sdk_path=<GAE SDK> \
+      --user_counts 1000 10000 100000
+"""
+
+import argparse
+import collections
+import os
+import sys
+import time
+
+
+_MESSAGE_ID = 'CAOkEN4ZZ33ETLNd8dkrJcNJN1qDE@mail.gmail.com'
+_OWNER_EMAIL = 'admin@benchmark-domain.com'
+_PHASE_NAMES = collections.OrderedDict([
+    ('/backend/recall_messages', 'Phase1 recall_messages'),
+    ('/backend/retrieve_domain_users', 'Phase2 retrieve_domain_users'),
+    ('/backend/recall_user_messages', 'Phase3 recall_user_messages'),
+    ('/backend/wait_for_task_completion', 'Phase4 wait_for_task_completion'),
+    ])
+_QUEUE_NAMES = ('recall-messages-queue', 'retrieve-users-queue',
+                'user-recall-queue')
+_MAX_TASK_ROUNDS = 1000
+
+
+def _ParseArgs(argv):
+  """Handle command line args unique to this script.
+
+  Args:
+    argv: holds all the command line args passed.
+
+  Returns:
+    argparser args object with attributes set based on arg settings.
+  """
+  argparser = argparse.ArgumentParser(description=('Benchmark a message '
+                                                   'recall end to end.'))
+  argparser.add_argument('--sdk_path', required=True,
+                         help='Path to the GAE SDK [REQUIRED].')
+  argparser.add_argument('--user_counts', type=int, nargs='+',
+                         default=[1000, 10000, 100000],
+                         help='Sizes of the synthetic domains to recall.')
+  argparser.add_argument('--found_ratio', type=float, default=0.1,
+                         help='Fraction of users having the message.')
+  argparser.add_argument('--imap_latency_ms', type=float, default=0.0,
+                         help='Latency added to each IMAP command.')
+  argparser.add_argument('--imap_error_rate', type=float, default=0.0,
+                         help='Probability an IMAP command fails.')
+  argparser.add_argument('--directory_latency_ms', type=float, default=0.0,
+                         help='Latency added to each Admin SDK request.')
+  args = argparser.parse_args(argv)
+
+  if not os.path.isdir(args.sdk_path):
+    argparser.error('Cannot find GAE SDK at %s.' % args.sdk_path)
+  sys.path.insert(0, args.sdk_path)
+  import dev_appserver  # pylint: disable=g-import-not-at-top
+  dev_appserver.fix_sys_path()
+
+  return args
+
+
+class RecallBenchmark(object):
+  """Runs one recall over a synthetic domain and collects timings."""
+
+  def __init__(self, user_count, found_ratio, imap_latency_s, imap_error_rate,
+               directory_latency_s):
+    """Build the synthetic domain and mailboxes.
+
+    Args:
+      user_count: Int number of users in the domain.
+      found_ratio: Float fraction [0-1] of users having the message.
+      imap_latency_s: Float seconds added to each IMAP command.
+      imap_error_rate: Float probability [0-1] an IMAP command fails.
+      directory_latency_s: Float seconds added to each Admin SDK request.
+    """
+    # pylint: disable=g-import-not-at-top
+    import setup_path  # pylint: disable=unused-import,g-bad-import-order
+    import fake_google_apps
+    # pylint: enable=g-import-not-at-top
+    self.user_count = user_count
+    self.phase_times = collections.defaultdict(float)
+    self.phase_task_counts = collections.Counter()
+    self.failed_task_count = 0
+    user_tuples = fake_google_apps.MakeSyntheticDomainUsers(
+        _OWNER_EMAIL.split('@')[1], user_count)
+    self.directory_service = fake_google_apps.FakeDirectoryService(
+        user_tuples, latency_s=directory_latency_s)
+    self.gmail_server = fake_google_apps.FakeGmailServer(
+        latency_s=imap_latency_s, error_rate=imap_error_rate)
+    for user_index, (user_email, unused_suspended) in enumerate(user_tuples):
+      if user_index < user_count * found_ratio:
+        self.gmail_server.AddMessage(user_email, _MESSAGE_ID)
+
+  def _SetUp(self):
+    """Activate the testbed stubs and substitute the fake services."""
+    # pylint: disable=g-import-not-at-top
+    import setup_path  # pylint: disable=unused-import,g-bad-import-order
+    import backend_app
+    import credentials_utils
+    import mail_api
+    import user_retriever
+    import webtest
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    # pylint: enable=g-import-not-at-top
+    self._testbed = testbed.Testbed()
+    self._testbed.activate()
+    self._testbed.setup_env(overwrite=True,
+                            DEFAULT_VERSION_HOSTNAME='localhost:8080')
+    self._testbed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    self._testbed.init_memcache_stub()
+    self._testbed.init_taskqueue_stub(root_path=setup_path.APP_BASE_PATH)
+    self._taskqueue_stub = self._testbed.get_stub(
+        testbed.TASKQUEUE_SERVICE_NAME)
+    self._testapp = webtest.TestApp(backend_app.app)
+
+    self._originals = [
+        (credentials_utils, 'GetAuthorizedHttp',
+         credentials_utils.GetAuthorizedHttp),
+        (credentials_utils, 'MintUserAccessToken',
+         credentials_utils.MintUserAccessToken),
+        (mail_api, 'GetUserAccessToken', mail_api.GetUserAccessToken),
+        (mail_api, '_GMAIL_INTERFACE_POOL', mail_api._GMAIL_INTERFACE_POOL),
+        (user_retriever, 'build', user_retriever.build)]
+    credentials_utils.GetAuthorizedHttp = lambda *unused_args: None
+    credentials_utils.MintUserAccessToken = (
+        lambda unused_user_email: ('access_token', time.time() + 3600))
+    mail_api.GetUserAccessToken = (
+        lambda user_email, force_refresh=False: 'access_token')
+    mail_api._GMAIL_INTERFACE_POOL = mail_api.GmailInterfacePool(
+        max_size=mail_api._SESSION_POOL_MAX_SIZE,
+        idle_timeout_s=mail_api._SESSION_POOL_IDLE_TIMEOUT_S,
+        max_age_s=mail_api._SESSION_POOL_MAX_AGE_S)
+    user_retriever.build = (
+        lambda *unused_args, **unused_kwargs: self.directory_service)
+    self._original_imap4_ssl = self.gmail_server.Install()
+
+  def _TearDown(self):
+    """Restore the substituted services and deactivate the testbed."""
+    self.gmail_server.Uninstall(self._original_imap4_ssl)
+    for module, attribute_name, original in self._originals:
+      setattr(module, attribute_name, original)
+    self._testbed.deactivate()
+
+  def _PostTask(self, url, payload):
+    """Run one task handler recording its wall time by phase."""
+    start_time = time.time()
+    response = self._testapp.post(
+        url, payload, expect_errors=True,
+        headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    self.phase_times[url] += time.time() - start_time
+    self.phase_task_counts[url] += 1
+    if response.status_int != 200:
+      self.failed_task_count += 1
+
+  def _RunQueuedTasks(self):
+    """Run every queued task once, in queue order.
+
+    Returns:
+      Int number of tasks run.
+    """
+    task_count = 0
+    for queue_name in _QUEUE_NAMES:
+      for task in self._taskqueue_stub.get_filtered_tasks(
+          queue_names=[queue_name]):
+        self._taskqueue_stub.DeleteTask(queue_name, task.name)
+        self._PostTask(task.url, task.payload)
+        task_count += 1
+    return task_count
+
+  def Run(self):
+    """Run the recall until its task is done or no work is queued.
+
+    Returns:
+      RecallTaskModel entity after the recall.
+    """
+    # pylint: disable=g-import-not-at-top
+    import urllib
+    from models import recall_task
+    # pylint: enable=g-import-not-at-top
+    self._SetUp()
+    try:
+      task_key_id = recall_task.RecallTaskModel(
+          owner_email=_OWNER_EMAIL,
+          message_criteria=_MESSAGE_ID).put().id()
+      self.start_time = time.time()
+      self._PostTask('/backend/recall_messages', urllib.urlencode({
+          'message_criteria': _MESSAGE_ID,
+          'owner_email': _OWNER_EMAIL,
+          'task_key_id': task_key_id}))
+      for unused_round in range(_MAX_TASK_ROUNDS):
+        task = recall_task.RecallTaskModel.get_by_id(task_key_id)
+        if task.task_state == recall_task.TASK_DONE:
+          break
+        if not self._RunQueuedTasks():
+          break
+      self.elapsed_s = time.time() - self.start_time
+      return recall_task.RecallTaskModel.get_by_id(task_key_id)
+    finally:
+      self._TearDown()
+
+  def Report(self, task):
+    """Print the benchmark results.
+
+    Args:
+      task: RecallTaskModel entity after the recall.
+    """
+    print '%d users: %s in %.2fs (%.1f users/s), %d failed tasks.' % (
+        self.user_count, task.task_state, self.elapsed_s,
+        self.user_count / self.elapsed_s, self.failed_task_count)
+    for url, phase_name in _PHASE_NAMES.iteritems():
+      print '  %-33s %6d tasks %9.2fs' % (
+          phase_name, self.phase_task_counts[url], self.phase_times[url])
+    print '  Admin SDK requests: %d' % self.directory_service.request_count
+    print '  IMAP commands: %s' % ', '.join(
+        '%s=%d' % command_count for command_count
+        in sorted(self.gmail_server.command_counts.iteritems()))
+
+
+def main(argv):
+  args = _ParseArgs(argv)
+  for user_count in args.user_counts:
+    benchmark = RecallBenchmark(
+        user_count=user_count,
+        found_ratio=args.found_ratio,
+        imap_latency_s=args.imap_latency_ms / 1000.0,
+        imap_error_rate=args.imap_error_rate,
+        directory_latency_s=args.directory_latency_ms / 1000.0)
+    benchmark.Report(benchmark.Run())
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,175 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the Admin SDK request helpers of user_retriever.
+
+Tests that rate limited requests are retried with backoff and that message
+recipients resolve to one user each.
+"""
+
+import json
+import unittest
+
+# setup_path required to allow imports from the application.
+import setup_path  # pylint: disable=unused-import,g-bad-import-order
+
+from apiclient.errors import HttpError
+import httplib2
+from test_utils import SetupLogging
+import user_retriever
+
+
+def _MakeHttpError(status, reason):
+  return HttpError(httplib2.Response({'status': status}), json.dumps(
+      {'error': {'code': status, 'errors': [{'reason': reason}]}}))
+
+
+class _FakeRequest(object):
+  """Request raising queued errors before answering."""
+
+  def __init__(self, errors, response=None):
+    self.errors = list(errors)
+    self.execute_count = 0
+    self.response = response or {'users': []}
+
+  def execute(self, http=None):  # pylint: disable=g-bad-name
+    self.execute_count += 1
+    if self.errors:
+      raise self.errors.pop(0)
+    return self.response
+
+
+class _FakeDirectoryService(object):
+  """Admin SDK directory with users (by email or alias) and groups."""
+
+  def __init__(self, users, group_members):
+    self._users = users
+    self._group_members = group_members
+
+  def members(self):  # pylint: disable=g-bad-name
+    return self
+
+  def users(self):  # pylint: disable=g-bad-name
+    return self
+
+  def get(self, userKey=None, **unused_kwargs):  # pylint: disable=g-bad-name
+    if userKey not in self._users:
+      return _FakeRequest([_MakeHttpError(404, 'notFound')])
+    return _FakeRequest([], self._users[userKey])
+
+  def list(self, groupKey=None, **unused_kwargs):  # pylint: disable=g-bad-name
+    if groupKey not in self._group_members:
+      return _FakeRequest([_MakeHttpError(404, 'notFound')])
+    return _FakeRequest([], {'members': self._group_members[groupKey]})
+
+
+class _FakeRateLimiter(object):
+  """Rate limiter counting the turns taken."""
+
+  def __init__(self):
+    self.acquire_count = 0
+
+  def Acquire(self):
+    self.acquire_count += 1
+
+
+class _FakeTime(object):
+  """Replaces the time module of user_retriever to record sleeps."""
+
+  def __init__(self):
+    self.sleeps = []
+
+  def sleep(self, sleep_s):  # pylint: disable=g-bad-name
+    self.sleeps.append(sleep_s)
+
+
+class ExecuteRequestTests(unittest.TestCase):
+
+  def setUp(self):
+    SetupLogging()
+    self._original_time = user_retriever.time
+    self._fake_time = _FakeTime()
+    user_retriever.time = self._fake_time
+    self._rate_limiter = _FakeRateLimiter()
+
+  def tearDown(self):
+    user_retriever.time = self._original_time
+
+  def testRateLimitedRequestIsRetriedWithBackoff(self):
+    request = _FakeRequest([_MakeHttpError(403, 'rateLimitExceeded'),
+                            _MakeHttpError(429, 'rateLimitExceeded')])
+    self.assertEqual({'users': []}, user_retriever._ExecuteRequest(
+        request, None, self._rate_limiter))
+    self.assertEqual(3, request.execute_count)
+    self.assertEqual(3, self._rate_limiter.acquire_count)
+    self.assertEqual(2, len(self._fake_time.sleeps))
+    self.assertLess(self._fake_time.sleeps[0], self._fake_time.sleeps[1])
+
+  def testForbiddenRequestIsNotRetried(self):
+    request = _FakeRequest([_MakeHttpError(403, 'forbidden')])
+    self.assertRaises(HttpError, user_retriever._ExecuteRequest, request,
+                      None, self._rate_limiter)
+    self.assertEqual(1, request.execute_count)
+    self.assertEqual([], self._fake_time.sleeps)
+
+  def testRetriesAreLimited(self):
+    request = _FakeRequest(
+        [_MakeHttpError(403, 'userRateLimitExceeded')] *
+        (user_retriever._RATE_LIMIT_RETRIES + 1))
+    self.assertRaises(HttpError, user_retriever._ExecuteRequest, request,
+                      None, self._rate_limiter)
+    self.assertEqual(user_retriever._RATE_LIMIT_RETRIES + 1,
+                     request.execute_count)
+
+
+class RecipientUserRetrieverTests(unittest.TestCase):
+
+  def setUp(self):
+    SetupLogging()
+    self._originals = [
+        (user_retriever, 'build', user_retriever.build),
+        (user_retriever, '_GetAdminSdkRateLimiter',
+         user_retriever._GetAdminSdkRateLimiter),
+        (user_retriever.credentials_utils, 'GetAuthorizedHttp',
+         user_retriever.credentials_utils.GetAuthorizedHttp)]
+    self._directory_service = _FakeDirectoryService(
+        users={'testuser@mydomain.com': {
+            'primaryEmail': 'TestUser@mydomain.com', 'suspended': False}},
+        group_members={'group@mydomain.com': [
+            {'email': 'TestUser@MyDomain.com', 'type': 'USER'},
+            {'email': 'Other@mydomain.com', 'type': 'USER',
+             'status': 'SUSPENDED'}]})
+    user_retriever.build = (
+        lambda *unused_args, **unused_kwargs: self._directory_service)
+    user_retriever._GetAdminSdkRateLimiter = (
+        lambda unused_user_domain: _FakeRateLimiter())
+    user_retriever.credentials_utils.GetAuthorizedHttp = (
+        lambda unused_user_email: None)
+
+  def tearDown(self):
+    for module, attribute_name, original in self._originals:
+      setattr(module, attribute_name, original)
+
+  def testMixedCaseAddressesResolveToOneUser(self):
+    retriever = user_retriever.RecipientUserRetriever(
+        owner_email='admin@mydomain.com', user_domain='mydomain.com')
+    self.assertEqual(
+        [('other@mydomain.com', True), ('testuser@mydomain.com', False)],
+        sorted(retriever.RetrieveRecipientUsers(
+            ['testuser@mydomain.com', 'group@mydomain.com'],
+            max_user_count=10)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -15,25 +15,111 @@
 """Functions to search users using the Google Admin SDK API."""
 
 import httplib
+import json
+import random
+import time
 
 from apiclient.discovery import build
 from apiclient.errors import HttpError
 import credentials_utils
 import log_utils
+import rate_limiter
 
 
+# There is a 15 request/s quota on the Admin SDK API. Requests of all recalls
+# of a domain take their turn from one rate limiter.
+_ADMIN_SDK_PREFETCH_COUNT = 3
+_ADMIN_SDK_REQUESTS_PER_S = 15
 _LOG = log_utils.GetLogger('messagerecall.user_retriever')
 _MAX_RESULT_PAGE_SIZE = 500  # Default is 100.
+_MAX_MEMBER_PAGE_SIZE = 200  # Default is 200.
+# Requests rejected for exceeding the quota anyway (e.g. while memcache is
+# unavailable) are retried with exponential backoff (1s, 2s, 4s... + jitter).
+_RATE_LIMIT_ERROR_REASONS = frozenset(['rateLimitExceeded',
+                                       'userRateLimitExceeded'])
+_RATE_LIMIT_RETRIES = 5
+# Partial response of user list pages: full user resources (names, orgs,
+# phones...) are ~10x larger to transfer and parse.
+# https://developers.google.com/admin-sdk/directory/v1/guides/performance
+_USER_LIST_FIELDS = 'users(primaryEmail,suspended),nextPageToken'
+
+
+def _GetAdminSdkRateLimiter(user_domain):
+  """Helper to get the Admin SDK request rate limiter of a domain.
+
+  Args:
+    user_domain: String domain for our apps domain.
+
+  Returns:
+    RateLimiter shared by the Admin SDK requests for the domain.
+  """
+  return rate_limiter.GetRateLimiter(
+      bucket_name='admin_sdk_%s' % user_domain,
+      requests_per_s=_ADMIN_SDK_REQUESTS_PER_S,
+      prefetch_count=_ADMIN_SDK_PREFETCH_COUNT)
+
+
+def _IsRateLimitError(http_error):
+  """Helper to check if an Admin SDK request failed for exceeding the quota.
+
+  Args:
+    http_error: apiclient HttpError of the request.
+
+  Returns:
+    True if the request may succeed if retried later else False.
+  """
+  if http_error.resp.status == 429:
+    return True
+  if http_error.resp.status != 403:
+    return False
+  try:
+    errors = json.loads(http_error.content)['error']['errors']
+  except (KeyError, TypeError, ValueError):
+    return False
+  return any(error.get('reason') in _RATE_LIMIT_ERROR_REASONS
+             for error in errors)
+
+
+def _ExecuteRequest(request, http, request_rate_limiter):
+  """Send an Admin SDK request in its turn, backing off while rate limited.
+
+  Args:
+    request: apiclient HttpRequest to send.
+    http: Authorized http connection to send the request with.
+    request_rate_limiter: RateLimiter the request takes its turn from.
+
+  Returns:
+    Deserialized response of the request.
+
+  Raises:
+    HttpError: If the request failed (or was still rate limited after
+               _RATE_LIMIT_RETRIES retries).
+  """
+  retry_count = 0
+  while True:
+    request_rate_limiter.Acquire()
+    try:
+      return request.execute(http=http)
+    except HttpError as e:
+      if retry_count >= _RATE_LIMIT_RETRIES or not _IsRateLimitError(e):
+        raise
+      sleep_s = 2 ** retry_count + random.random()
+      retry_count += 1
+      _LOG.warning('Admin SDK rate limit exceeded: retry %s in %.1fs.',
+                   retry_count, sleep_s)
+      time.sleep(sleep_s)
 
 
 class DomainUserRetriever(object):
   """Class to organize large, multi-page user searches.
 
-  Uses http_utils to add error handling and retry using backoff.
+  Uses http_utils to add error handling and retry using backoff.  Requests
+  are spaced to respect the domain's Admin SDK quota and retried with
+  backoff if rejected for exceeding it.
   """
 
   def __init__(self, owner_email, user_domain, email_query_prefix,
-               use_glob=False):
+               use_glob=False, user_list_fields=_USER_LIST_FIELDS):
     """Initialize the search class.
 
     Build the items needed to page through domain user lists which are expected
@@ -46,13 +132,19 @@ class DomainUserRetriever(object):
       user_domain: String domain for our apps domain.
       email_query_prefix: Admin SDK search query prefix (used in email:%s*).
       use_glob: True if need to add * to the end of the search query.
+      user_list_fields: Admin SDK fields (projection) of user list pages.
+                        Must include users(primaryEmail,suspended) and
+                        nextPageToken. None to retrieve full user resources.
     """
     self._http = credentials_utils.GetAuthorizedHttp(owner_email)
+    self._rate_limiter = _GetAdminSdkRateLimiter(user_domain)
     self._user_domain = user_domain
     self._email_query_prefix = email_query_prefix
-    self._search_query = 'email:%s' % email_query_prefix
+    # Single quotes (allowed in usernames) are escaped in search queries.
+    self._search_query = 'email:%s' % email_query_prefix.replace("'", "\\'")
     if use_glob:
       self._search_query += '*'
+    self._user_list_fields = user_list_fields
 
     # Have seen the following error from build():
     # 'DeadlineExceededError: The API call urlfetch.Fetch() took too long '
@@ -74,14 +166,15 @@ class DomainUserRetriever(object):
     request = self._users_collection.list(domain=self._user_domain,
                                           maxResults=_MAX_RESULT_PAGE_SIZE,
                                           query=self._search_query,
-                                          pageToken=next_page_token)
+                                          pageToken=next_page_token,
+                                          fields=self._user_list_fields)
     # Not infrequently seeing:
     # 'HTTPException: Deadline exceeded while waiting for HTTP response '
     # 'from URL: https://www.googleapis.com/admin/directory/v1/users'
     # '?query=email%3A6%2A&domain=capgsfishing.com&alt=json&maxResults=500'
     # Default socket timeout seems to be 5s so increasing it to 10s
     # in GetAuthorizedHttp() seems to have helped.
-    return request.execute(http=self._http)
+    return _ExecuteRequest(request, self._http, self._rate_limiter)
 
   def GetUserAttributes(self, user_email):
     """Helper to retrieve user attributes from the Admin SDK API.
@@ -97,8 +190,9 @@ class DomainUserRetriever(object):
     """
     request = self._users_collection.get(userKey=user_email)
     try:
-      return request.execute(
-          http=credentials_utils.GetAuthorizedHttp(user_email))
+      return _ExecuteRequest(
+          request, credentials_utils.GetAuthorizedHttp(user_email),
+          self._rate_limiter)
     except (HttpError, httplib.HTTPException) as e:
       if e.resp.status == 403:  # If user is not an admin...
         return {}
@@ -125,10 +219,125 @@ class DomainUserRetriever(object):
     next_page_token = None
     while True:
       users_list = self._FetchUserListPage(next_page_token=next_page_token)
-      yield [(user['primaryEmail'], user['suspended'])
+      yield [(user['primaryEmail'], user.get('suspended', False))
              for user in users_list.get('users', [])
              if user['primaryEmail'] and user['primaryEmail'].startswith(
                self._email_query_prefix)]
       next_page_token = users_list.get('nextPageToken')
       if not next_page_token:
         break
+
+
+class RecipientUserRetriever(object):
+  """Class to resolve message recipients to the domain users to check.
+
+  Recipient addresses may be users (or their aliases) or groups whose members
+  are expanded recursively.
+  """
+
+  def __init__(self, owner_email, user_domain):
+    """Initialize the directory collections.
+
+    Args:
+      owner_email: String email address of the user who owns the task.
+      user_domain: String domain for our apps domain.
+    """
+    self._http = credentials_utils.GetAuthorizedHttp(owner_email)
+    self._rate_limiter = _GetAdminSdkRateLimiter(user_domain)
+    self._user_domain = user_domain
+    directory_service = build('admin', 'directory_v1', http=self._http)
+    self._members_collection = directory_service.members()
+    self._users_collection = directory_service.users()
+
+  def _GetUser(self, user_email):
+    """Helper to retrieve a user by email address or alias.
+
+    Args:
+      user_email: String email address of the form user@domain.com.
+
+    Returns:
+      Dictionary of user attributes or None if not a user.
+    """
+    request = self._users_collection.get(
+        userKey=user_email, fields='primaryEmail,suspended')
+    try:
+      return _ExecuteRequest(request, self._http, self._rate_limiter)
+    except HttpError as e:
+      if e.resp.status == 404:
+        return None
+      raise
+
+  def _ListGroupMembers(self, group_email):
+    """Helper to retrieve all (direct) members of a group.
+
+    Args:
+      group_email: String email address of the group.
+
+    Returns:
+      List of member dictionaries or None if not a group.
+    """
+    members = []
+    next_page_token = None
+    while True:
+      request = self._members_collection.list(
+          groupKey=group_email, maxResults=_MAX_MEMBER_PAGE_SIZE,
+          pageToken=next_page_token)
+      try:
+        members_list = _ExecuteRequest(request, self._http,
+                                       self._rate_limiter)
+      except HttpError as e:
+        if e.resp.status == 404:
+          return None
+        raise
+      members.extend(members_list.get('members', []))
+      next_page_token = members_list.get('nextPageToken')
+      if not next_page_token:
+        return members
+
+  def RetrieveRecipientUsers(self, recipient_emails, max_user_count):
+    """Resolve recipient addresses to the domain users who received them.
+
+    Addresses outside the domain are ignored.
+
+    Args:
+      recipient_emails: Iterable of String recipient email addresses.
+      max_user_count: Integer most users worth resolving individually.
+
+    Returns:
+      List of tuples (1 for each user) with a String email address and the
+      suspended status, or None if the recipients include the whole domain,
+      more than max_user_count users or could not be resolved.
+    """
+    user_tuples = {}
+    pending_emails = [recipient_email for recipient_email in recipient_emails
+                      if recipient_email.endswith('@' + self._user_domain)]
+    seen_emails = set(pending_emails)
+    try:
+      while pending_emails:
+        recipient_email = pending_emails.pop()
+        user = self._GetUser(recipient_email)
+        if user:
+          # Members are lowercase: keep one tuple per mailbox.
+          user_email = user['primaryEmail'].lower()
+          user_tuples[user_email] = user.get('suspended', False)
+        else:
+          members = self._ListGroupMembers(recipient_email) or []
+          for member in members:
+            if member.get('type') == 'CUSTOMER':
+              _LOG.info('Group %s includes the whole domain.',
+                        recipient_email)
+              return None
+            member_email = member.get('email', '').lower()
+            if member.get('type') == 'GROUP':
+              if member_email not in seen_emails:
+                seen_emails.add(member_email)
+                pending_emails.append(member_email)
+            elif member_email.endswith('@' + self._user_domain):
+              user_tuples[member_email] = member.get('status') == 'SUSPENDED'
+        if len(user_tuples) > max_user_count:
+          _LOG.info('Recipients include more than %s users.', max_user_count)
+          return None
+    except (HttpError, httplib.HTTPException) as e:
+      _LOG.warning('Error resolving recipients: %s.', e)
+      return None
+    return user_tuples.items()
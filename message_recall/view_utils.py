@@ -28,17 +28,18 @@ _RETRIEVAL_ENDED_COUNTER_TAG = 'retrieval_ended'
 
 
 def CreateSafeUserEmailForTaskName(user_email):
-  """Tasks have naming rules that exclude '@' and '.'.
+  """Tasks have naming rules that exclude '@', '.' and "'".
 
   Task names must match: ^[a-zA-Z0-9_-]{1,500}$
 
   Args:
-    user_email: String user email of the task owner.
+    user_email: String user email (or email prefix) for the task name.
 
   Returns:
     String with unacceptable chars swapped.
   """
-  return user_email.replace('@', '-AT-').replace('.', '-DOT-')
+  return user_email.replace('@', '-AT-').replace('.', '-DOT-').replace(
+      "'", '-APOS-')
 
 
 def FailRecallTask(task_key_id, reason_string, user_email=None,
@@ -49,7 +50,7 @@ def FailRecallTask(task_key_id, reason_string, user_email=None,
     task_key_id: Int unique id of the parent task.
     reason_string: String explanation to show users.
     user_email: String email address of the user that failed.
-    user_key_id: Int unique id of the user entity to update state.
+    user_key_id: String unique id of the user entity to update state.
     raise_exception: Boolean; True if exception should be raised.
   """
   error_reason.ErrorReasonModel.AddTaskErrorReason(task_key_id=task_key_id,